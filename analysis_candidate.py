@@ -0,0 +1,42 @@
+"""取数候选的代码执行，供多候选取数（candidates.py）在独立的子进程中调用。
+
+本模块只依赖 pandas / numpy / statsmodels，子进程导入时不会加载智能体与界面模块。
+"""
+import re
+import warnings
+
+import numpy as np
+import pandas as pd
+# 统计和时间序列分析库
+import statsmodels.api as sm
+from statsmodels.tsa import api as tsa
+
+
+def extract_code(python_code):
+    """从回复的 python代码 字段取出要执行的代码（与取数流程中的取法相同）"""
+    match = re.search(r'```python(.*?)```', python_code, re.DOTALL)
+    if match is not None:
+        return match.group(1).strip().lstrip('\n')
+    return python_code.split('```python')[-1].rstrip('```')
+
+
+def run_analysis_candidate(df, fields):
+    """执行一个取数候选的代码，result_df 为非空 DataFrame 时通过，返回 (是否通过, (代码, result_df))。
+    df 为子进程收到的数据副本，每次执行再复制一份，避免候选代码修改后影响同一进程中的下一次检验"""
+    if 'Y' not in fields.get('feasibility', ''):
+        return False, None
+    code_to_execute = extract_code(fields.get('python_code', ''))
+    if not code_to_execute:
+        return False, None
+    exec_namespace = {
+        'pd': pd,
+        'np': np,
+        'sm': sm,
+        'tsa': tsa,
+        'df': df.copy() if df is not None else None
+    }
+    # 只在本子进程中生效，不影响界面进程里其他线程的警告过滤器
+    warnings.simplefilter("ignore")
+    exec(code_to_execute, exec_namespace)
+    result_df = exec_namespace.get('result_df')
+    return isinstance(result_df, pd.DataFrame) and not result_df.empty, (code_to_execute, result_df)
@@ -0,0 +1,218 @@
+"""data_sumary 性能基准脚本
+
+用法：
+    python benchmark.py                 # 运行全部基准
+    python benchmark.py item_documents  # 只运行指定基准
+
+各基准只依赖随机生成的数据，不需要 Excel 文件，也不会调用大模型接口。
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import data_sumary
+
+
+def make_frame(rows, cardinality, extra_columns=6, seed=0):
+    """生成测试用 DataFrame：一列指定基数的分类列，以及若干数值、文本、日期列"""
+    rng = np.random.default_rng(seed)
+    data = {
+        '类别': [f"品类{i}" for i in rng.integers(0, cardinality, rows)],
+        '日期': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D'),
+    }
+    for j in range(extra_columns):
+        if j % 2 == 0:
+            data[f"数值{j}"] = rng.integers(0, 1000, rows)
+        else:
+            data[f"地区{j}"] = [f"城市{i}" for i in rng.integers(0, 50, rows)]
+    return pd.DataFrame(data)
+
+
+def _timeit(func, *args, repeat=1):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _legacy_item_features(column_data, df):
+    """原实现：逐元素筛选 + iterrows，仅用于对照"""
+    result = []
+    for item in column_data.drop_duplicates():
+        item_data = df[column_data == item]
+        features = set()
+        for _, row in item_data.iterrows():
+            features.update([str(val) for val in row])
+        result.append((item, sorted(' '.join(features).split(' '))))
+    return result
+
+
+def _vectorized_item_features(column_data, df):
+    documents, _ = data_sumary.build_item_documents(column_data, df)
+    result = []
+    for doc in documents:
+        features = doc.page_content.split(' 特征: ', 1)[1]
+        result.append((doc.metadata['item'], sorted(features.split(' '))))
+    return result
+
+
+def bench_item_documents():
+    """按行数与基数对比逐元素构建与向量化构建元素特征文档的耗时，并校验结果一致"""
+    print("== build_item_documents：逐元素 iterrows vs 一次 groupby ==")
+    print(f"{'行数':>8} {'基数':>8} {'原实现(s)':>12} {'向量化(s)':>12} {'加速比':>8}")
+    for rows, cardinality in [(2000, 50), (2000, 1000), (20000, 200), (20000, 5000), (100000, 2000)]:
+        df = make_frame(rows, cardinality)
+        column = df['类别']
+        # 原实现在高基数下耗时很长，只在可接受的规模上运行对照
+        if rows * cardinality <= 2e7:
+            legacy_time, legacy = _timeit(_legacy_item_features, column, df)
+        else:
+            legacy_time, legacy = float('nan'), None
+        # 只计构建特征本身的耗时，不含分词
+        tokenizer = data_sumary.preprocess_text
+        data_sumary.preprocess_text = lambda text: text
+        try:
+            fast_time, fast = _timeit(_vectorized_item_features, column, df)
+        finally:
+            data_sumary.preprocess_text = tokenizer
+        if legacy is not None:
+            assert [item for item, _ in legacy] == [item for item, _ in fast]
+            assert all(a == b for (_, a), (_, b) in zip(legacy, fast))
+        speedup = legacy_time / fast_time if legacy is not None else float('nan')
+        print(f"{rows:>8} {cardinality:>8} {legacy_time:>12.3f} {fast_time:>12.3f} {speedup:>8.1f}")
+
+
+def bench_summary_cold_warm():
+    """对比冷启动（每次临时构建索引与列画像）与热路径（复用导入时构建的索引与画像）生成概述的耗时"""
+    print("== summarize_data：冷启动 vs 复用索引与列画像 ==")
+    print(f"{'行数':>8} {'列数':>6} {'冷启动(s)':>12} {'仅复用索引(s)':>14} {'索引+画像(s)':>14}")
+    query = "品类12 在城市3 的销量"
+    for rows, extra_columns in [(5000, 6), (50000, 6), (50000, 30)]:
+        df = make_frame(rows, 500, extra_columns=extra_columns)
+        data_sumary.token_cache.clear()
+        cold_time, _ = _timeit(data_sumary.summarize_data, df, "测试数据", query)
+        index = data_sumary.RetrievalIndex.build(df, row_sample_size=200)
+        profile = data_sumary.DatasetProfile(df)
+        index_time, _ = _timeit(lambda: data_sumary.summarize_data(df, "测试数据", query, index), repeat=3)
+        warm_time, _ = _timeit(lambda: data_sumary.summarize_data(df, "测试数据", query, index, profile), repeat=3)
+        print(f"{rows:>8} {len(df.columns):>6} {cold_time:>12.3f} {index_time:>14.3f} {warm_time:>14.3f}")
+
+
+def bench_parallel_build():
+    """对比串行与多进程并行构建各列检索索引的耗时（每次都清空分词缓存，按冷启动计），并校验结果一致"""
+    import os
+    print(f"== RetrievalIndex.build：串行 vs 多进程（CPU 核数 {os.cpu_count()}） ==")
+    print(f"{'行数':>8} {'列数':>6} {'进程数':>6} {'耗时(s)':>10} {'加速比':>8}")
+    for rows, extra_columns in [(20000, 8), (50000, 16)]:
+        df = make_frame(rows, 2000, extra_columns=extra_columns)
+        data_sumary.token_cache.clear()
+        serial_time, serial = _timeit(lambda: data_sumary.RetrievalIndex.build(df, random_state=0, workers=0))
+        print(f"{rows:>8} {len(df.columns):>6} {1:>6} {serial_time:>10.3f} {1.0:>8.1f}")
+        for workers in (2, 4):
+            data_sumary.token_cache.clear()
+            parallel_time, parallel = _timeit(lambda: data_sumary.RetrievalIndex.build(df, random_state=0, workers=workers))
+            assert list(serial.item_indexes) == list(parallel.item_indexes)
+            for col, index in serial.item_indexes.items():
+                assert index.vectorizer.vocabulary_ == parallel.item_indexes[col].vectorizer.vocabulary_
+                assert (index.tfidf_matrix != parallel.item_indexes[col].tfidf_matrix).nnz == 0
+            print(f"{rows:>8} {len(df.columns):>6} {workers:>6} {parallel_time:>10.3f} {serial_time / parallel_time:>8.1f}")
+
+
+def bench_approx_profile():
+    """对比精确与近似（概要数据结构）两种方式计算列画像的耗时，并并排打印两者的描述以便核对；
+    再对比大表上精确与近似两种方式构建检索索引的耗时"""
+    print("== DatasetProfile：精确统计 vs 近似统计 ==")
+    print(f"{'行数':>8} {'精确(s)':>10} {'近似(s)':>10} {'加速比':>8}")
+    for rows in (1000000, 3000000):
+        df = make_frame(rows, 500000)
+        # 订单号一类几乎全不重复的列是精确去重最慢的情形
+        df['订单号'] = [f"订单{i:09d}" for i in range(rows)]
+        exact_time, exact = _timeit(lambda: data_sumary.DatasetProfile(df, approximate=False))
+        approx_time, approx = _timeit(lambda: data_sumary.DatasetProfile(df, approximate=True))
+        print(f"{rows:>8} {exact_time:>10.3f} {approx_time:>10.3f} {exact_time / approx_time:>8.1f}")
+    for col in exact.columns:
+        print(f"  {col}\n    精确: {exact.descriptions[col]}\n    近似: {approx.descriptions[col]}")
+
+    print("== RetrievalIndex.build：精确去重 vs 抽样（近似模式） ==")
+    print(f"{'行数':>8} {'精确(s)':>10} {'近似(s)':>10} {'加速比':>8}")
+    df = make_frame(1000000, 5000)
+    exact_time, _ = _timeit(lambda: data_sumary.RetrievalIndex.build(df, random_state=0, approximate=False))
+    approx_time, _ = _timeit(lambda: data_sumary.RetrievalIndex.build(df, random_state=0, approximate=True))
+    print(f"{len(df):>8} {exact_time:>10.3f} {approx_time:>10.3f} {exact_time / approx_time:>8.1f}")
+
+
+def bench_row_retrievers():
+    """对比 TF-IDF 抽样与 BM25 全量倒排两种整行检索后端：构建耗时、单次查询耗时，以及稀有实体的命中率"""
+    print("== 整行检索：TF-IDF（抽样）vs BM25（全部行） ==")
+    print(f"{'行数':>8} {'后端':>6} {'构建(s)':>10} {'查询(ms)':>10} {'稀有实体命中':>12}")
+    rng = np.random.default_rng(0)
+    for rows in (20000, 100000):
+        df = make_frame(rows, 5000)
+        # 在随机 20 行中放入只出现一次的客户名，检索时查询这些客户
+        df['客户'] = "普通客户"
+        rare_rows = rng.choice(rows, size=20, replace=False)
+        for i, row in enumerate(rare_rows):
+            df.loc[row, '客户'] = f"稀有客户{i}号"
+        queries = [data_sumary.preprocess_text(f"稀有客户{i}号 的订单") for i in range(len(rare_rows))]
+        for retriever in ("tfidf", "bm25"):
+            build_time, index = _timeit(lambda: data_sumary.RetrievalIndex.build(df, row_sample_size=200, random_state=0, retriever=retriever))
+            start = time.perf_counter()
+            results = [index.related_rows(query, top_k=10) for query in queries]
+            query_ms = (time.perf_counter() - start) / len(queries) * 1000
+            hits = sum(f"稀有客户{i}号 |" in "\n".join(result) for i, result in enumerate(results))
+            print(f"{rows:>8} {retriever:>6} {build_time:>10.3f} {query_ms:>10.2f} {hits:>9}/{len(queries)}")
+
+
+def bench_top_k():
+    """对比 argsort 全排序与 argpartition 部分选择在 1 万与 100 万候选上的耗时（正确性见 tests/test_top_k.py）"""
+    rng = np.random.default_rng(0)
+    print("== top-k 选择：argsort vs argpartition ==")
+    print(f"{'候选数':>10} {'top_k':>6} {'argsort(ms)':>12} {'argpartition(ms)':>17} {'稀疏(ms)':>10} {'加速比':>8}")
+    for size in (10000, 1000000):
+        scores = rng.random(size)
+        # 稀疏情形：只有 1% 的候选与查询有共同词
+        sparse_scores = scores * (rng.random(size) < 0.01)
+        positions = np.flatnonzero(sparse_scores)
+        for top_k in (10, 100):
+            full_time, _ = _timeit(lambda: np.argsort(scores)[-top_k:][::-1], repeat=5)
+            partial_time, _ = _timeit(lambda: data_sumary.top_k_indices(scores, top_k), repeat=5)
+            sparse_time, _ = _timeit(lambda: data_sumary.sparse_top_k(positions, sparse_scores[positions], size, top_k), repeat=5)
+            print(f"{size:>10} {top_k:>6} {full_time * 1000:>12.3f} {partial_time * 1000:>17.3f} {sparse_time * 1000:>10.3f} {full_time / partial_time:>8.1f}")
+
+
+def bench_summary_budget():
+    """不同宽度的表在不同 token 预算下生成的概述长度（按 token_budget.estimate_tokens 估算）与耗时"""
+    from token_budget import estimate_tokens
+    print("== summarize_data：token 预算 ==")
+    print(f"{'列数':>6} {'预算':>8} {'概述tokens':>12} {'耗时(s)':>10}")
+    query = "品类12 在城市3 的销量"
+    for extra_columns in (6, 40, 120):
+        df = make_frame(3000, 300, extra_columns=extra_columns)
+        index = data_sumary.RetrievalIndex.build(df, row_sample_size=200, random_state=0)
+        profile = data_sumary.DatasetProfile(df)
+        for budget in (0, 6000, 2000, 500):
+            elapsed, summary = _timeit(lambda: data_sumary.summarize_data(df, "测试数据", query, index, profile, token_budget=budget))
+            print(f"{len(df.columns):>6} {budget:>8} {estimate_tokens(summary):>12} {elapsed:>10.3f}")
+
+
+BENCHMARKS = {
+    'item_documents': bench_item_documents,
+    'summary_cold_warm': bench_summary_cold_warm,
+    'parallel_build': bench_parallel_build,
+    'approx_profile': bench_approx_profile,
+    'row_retrievers': bench_row_retrievers,
+    'top_k': bench_top_k,
+    'summary_budget': bench_summary_budget,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
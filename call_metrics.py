@@ -0,0 +1,155 @@
+"""逐次调用的耗时与用量指标，用于查看一轮对话的时间花在哪里：数据概况、排队、等待首字、生成、解析、执行代码。
+
+- 每次智能体调用（astream）记录一条 kind 为 call 的记录：
+  agent、stage（工作流类名:状态）、attempt（重试引擎中的第几次尝试）、route、routes_tried、
+  source（model / cache / 结构化输出模式）、prompt_chars、prompt_tokens、cached_tokens、completion_tokens
+  （接口返回 usage 时为实际值，否则按字符估算，此时 tokens_estimated 为 True）、queued（限流排队秒数）、
+  ttft、generation_seconds、tokens_per_second、early_stop、parse_seconds、latency（从生成提示词到解析完成）、
+  outcome（ok / parse_error / request_error / cancelled）与 error；
+- 工作流中不调用模型的步骤（数据概况、执行代码）用 step() 记录 kind 为 step 的记录；
+- 工作流线程在 run 循环中设置 workflow（正在运行的工作流），记录时按它当时的 status 标记 stage；
+  重试引擎设置 attempt；AgentLoop 提交协程时把它们带进事件循环中的调用；
+- path 返回非空路径时每条记录追加写入该 JSONL 文件；内存中保留最近 limit 条，stats() 按 (stage, agent) 汇总。
+"""
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 当前线程正在运行的工作流，记录时读取其 status
+workflow = contextvars.ContextVar('metrics_workflow', default=None)
+# 重试引擎中的第几次尝试
+attempt = contextvars.ContextVar('metrics_attempt', default=1)
+# 正在进行的调用记录：astream 中设置，iter_response / stream_completion 通过 note 填写
+current_call = contextvars.ContextVar('metrics_call', default=None)
+
+
+def note(**fields):
+    """填写当前调用记录的字段（不在智能体调用中时忽略）"""
+    record = current_call.get()
+    if record is not None:
+        record.update(fields)
+
+
+def current_stage():
+    """当前的工作流状态，形如 "Workflow:3"；不在工作流中时为 None"""
+    running = workflow.get()
+    if running is None:
+        return None
+    return f"{type(running).__name__}:{running.status}"
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+class CallMetrics:
+    def __init__(self, path=lambda: "", limit=2000):
+        self.path = path
+        self._records = deque(maxlen=limit)
+        self._lock = threading.Lock()
+
+    def begin(self, agent):
+        """开始一次调用的记录并设为当前调用"""
+        record = {
+            'kind': 'call', 'time': time.time(), 'agent': agent, 'stage': current_stage(), 'attempt': attempt.get(),
+            'route': None, 'routes_tried': 0, 'source': 'model',
+            'prompt_chars': 0, 'prompt_tokens': None, 'cached_tokens': None, 'completion_tokens': None,
+            'tokens_estimated': True, 'queued': 0.0, 'ttft': None, 'generation_seconds': None,
+            'tokens_per_second': None, 'early_stop': False, 'parse_seconds': None, 'latency': None,
+            'outcome': None, 'error': None, '_started': time.perf_counter()
+        }
+        current_call.set(record)
+        return record
+
+    def finish(self, record, outcome, error=None):
+        """结束记录（已结束的记录再次调用时忽略）"""
+        if record['outcome'] is not None:
+            return
+        record['latency'] = time.perf_counter() - record.pop('_started')
+        record['outcome'] = outcome
+        record['error'] = error
+        if record['completion_tokens'] and record['generation_seconds']:
+            record['tokens_per_second'] = record['completion_tokens'] / record['generation_seconds']
+        self._add(record)
+        ttft = "无" if record['ttft'] is None else f"{record['ttft']:.2f} s"
+        speed = "" if record['tokens_per_second'] is None else f"，生成 {record['tokens_per_second']:.1f} tokens/s"
+        print(f"\n[调用指标] {record['stage'] or '-'} {record['agent']}（第 {record['attempt']} 次）{outcome}："
+              f"提示 {record['prompt_tokens']} tokens，首字 {ttft}{speed}，总耗时 {record['latency']:.2f} s")
+
+    @contextmanager
+    def step(self, name):
+        """记录工作流中一个不调用模型的步骤的耗时，出错时 ok 为 False 并照常抛出"""
+        record = {'kind': 'step', 'time': time.time(), 'name': name, 'stage': current_stage(), 'seconds': None, 'ok': False}
+        started = time.perf_counter()
+        try:
+            yield
+            record['ok'] = True
+        finally:
+            record['seconds'] = time.perf_counter() - started
+            self._add(record)
+
+    def _add(self, record):
+        path = self.path()
+        with self._lock:
+            self._records.append(record)
+            if not path:
+                return
+            try:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            except OSError as e:
+                print(f"[调用指标] 写入失败: {e}")
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def export(self, path):
+        """把内存中保留的记录写入 JSONL 文件，返回写入的条数"""
+        records = self.records()
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        return len(records)
+
+    def stats(self):
+        """按 (stage, agent) 汇总调用，按 (stage, name) 汇总步骤"""
+        calls = {}
+        steps = {}
+        for record in self.records():
+            if record['kind'] == 'step':
+                steps.setdefault(f"{record['stage'] or '-'} | {record['name']}", []).append(record)
+            else:
+                calls.setdefault(f"{record['stage'] or '-'} | {record['agent']}", []).append(record)
+        return {
+            'calls': {
+                key: {
+                    'calls': len(records),
+                    'retries': sum(1 for record in records if record['attempt'] > 1),
+                    'parse_errors': sum(1 for record in records if record['outcome'] == 'parse_error'),
+                    'request_errors': sum(1 for record in records if record['outcome'] == 'request_error'),
+                    'cancelled': sum(1 for record in records if record['outcome'] == 'cancelled'),
+                    'avg_prompt_tokens': _mean(record['prompt_tokens'] for record in records),
+                    'avg_completion_tokens': _mean(record['completion_tokens'] for record in records),
+                    'avg_queued': _mean(record['queued'] for record in records),
+                    'avg_ttft': _mean(record['ttft'] for record in records),
+                    'avg_tokens_per_second': _mean(record['tokens_per_second'] for record in records),
+                    'avg_latency': _mean(record['latency'] for record in records),
+                    'total_latency': sum(record['latency'] for record in records)
+                }
+                for key, records in calls.items()
+            },
+            'steps': {
+                key: {
+                    'calls': len(records),
+                    'failures': sum(1 for record in records if not record['ok']),
+                    'avg_seconds': _mean(record['seconds'] for record in records),
+                    'total_seconds': sum(record['seconds'] for record in records)
+                }
+                for key, records in steps.items()
+            }
+        }
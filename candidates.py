@@ -0,0 +1,162 @@
+"""多候选并发：同一请求同时发起多个智能体调用，某个字段一完整就交给该候选的工作进程检验，
+第一个检验通过的候选胜出，其余候选的流立即取消。
+
+每个候选在竞赛开始时启动一个独立的子进程（spawn），进程启动时收到一份 context（例如数据）的副本，
+之后每次检验调用 evaluate(context, fields)，fields 为该候选截至目前的字段字典，返回 (是否通过, 附带结果)。
+evaluate 须是可在子进程中导入的模块级函数。检验超过 timeout 秒、或竞赛已经决出胜负时直接结束其进程，
+因此陷入死循环或运行很慢的候选代码不会拖住程序，也不会与程序共享模块与全局状态。
+"""
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from stream_parser import FieldEvent
+
+
+class RaceResult(NamedTuple):
+    # 胜出候选的序号，没有候选通过时为 None
+    winner: object
+    # 胜出候选检验时的字段字典与检验函数的附带结果
+    fields: object
+    payload: object
+    # 各候选的最终结果（process_query 的返回值；被取消的候选为 None）
+    results: list
+
+
+class CandidateTimeout(Exception):
+    pass
+
+
+def _serve(evaluate, context, conn):
+    """工作进程：准备好后发送 None，之后依次检验收到的字段字典，回复 (True, 检验结果) 或 (False, 错误信息)"""
+    conn.send(None)
+    while True:
+        try:
+            fields = conn.recv()
+        except EOFError:
+            return
+        try:
+            reply = (True, evaluate(context, fields))
+        except BaseException as e:
+            reply = (False, f"{type(e).__name__}: {e}")
+        try:
+            conn.send(reply)
+        except Exception as e:
+            conn.send((False, f"检验结果无法传回: {e}"))
+
+
+class CandidateWorker:
+    """一个候选的工作进程；check 在线程中调用，同一进程的检验依次进行"""
+
+    def __init__(self, evaluate, context, timeout):
+        mp_context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(target=_serve, args=(evaluate, context, child_conn), daemon=True)
+        self.process.start()
+        # 关闭本进程中的子进程端，子进程结束后 poll/recv 才能读到 EOF
+        child_conn.close()
+        self.timeout = timeout
+        self.ready = False
+        self.timed_out = False
+        self.lock = threading.Lock()
+
+    def check(self, fields):
+        with self.lock:
+            if self.timed_out:
+                # 本候选已因超时结束了工作进程，之后的检验一律不通过
+                return False, None
+            if not self.ready:
+                # 等待子进程导入与接收数据完成，这段时间不计入检验超时
+                self.conn.recv()
+                self.ready = True
+            self.conn.send(fields)
+            if not self.conn.poll(self.timeout):
+                self.timed_out = True
+                self.terminate()
+                raise CandidateTimeout(f"检验超过 {self.timeout} s，已结束其工作进程")
+            ok, value = self.conn.recv()
+        if not ok:
+            raise RuntimeError(value)
+        return value
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+async def race_candidates(agents, args, field, evaluate, context=None, timeout=None):
+    loop = asyncio.get_running_loop()
+    winner = loop.create_future()
+    workers = [CandidateWorker(evaluate, context, timeout) for _ in agents]
+    # 线程只负责等待工作进程的回复，进程结束后立即返回；每个候选至多同时提交两次检验
+    executor = ThreadPoolExecutor(max_workers=2 * len(agents), thread_name_prefix="candidate")
+    results = [None] * len(agents)
+    started = time.perf_counter()
+
+    def on_evaluated(index, fields, future):
+        if future.cancelled():
+            return
+        try:
+            ok, payload = future.result()
+        except (EOFError, OSError):
+            # 竞赛决出胜负后工作进程被结束时属于正常情况
+            if not winner.done():
+                print(f"\n[多候选] 候选 {index} 的工作进程意外退出")
+            return
+        except Exception as e:
+            print(f"\n[多候选] 候选 {index} 检验出错: {e}")
+            return
+        if ok and not winner.done():
+            winner.set_result((index, fields, payload))
+
+    async def run(index, agent):
+        fields = {}
+        evaluated = None
+        evaluations = []
+
+        def submit(values):
+            future = loop.run_in_executor(executor, workers[index].check, values)
+            future.add_done_callback(lambda f: on_evaluated(index, values, f))
+            evaluations.append(future)
+
+        async for event in agent.astream(*args):
+            if isinstance(event, FieldEvent):
+                fields[event.field] = event.value
+                if event.field == field and evaluated is None:
+                    evaluated = event.value
+                    submit(dict(fields))
+            else:
+                results[index] = event.result
+                # 流结束后的最终取值与提前检验的不同（例如遇到重新定位标记）时再检验一次
+                if isinstance(event.result, dict) and field in event.result and event.result[field] != evaluated:
+                    submit(dict(event.result))
+        await asyncio.gather(*evaluations, return_exceptions=True)
+
+    tasks = [asyncio.ensure_future(run(index, agent)) for index, agent in enumerate(agents)]
+    finished = asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        await asyncio.wait([winner, finished], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await asyncio.gather(finished, return_exceptions=True)
+        # 结束所有工作进程（包括仍在执行代码的落选候选），等待中的线程随之读到 EOF 返回
+        for worker in workers:
+            worker.terminate()
+        executor.shutdown(wait=True, cancel_futures=True)
+        for worker in workers:
+            worker.conn.close()
+    elapsed = time.perf_counter() - started
+    if winner.done():
+        index, fields, payload = winner.result()
+        cancelled = sum(1 for task in pending if task is not tasks[index])
+        print(f"\n[多候选] 候选 {index} 胜出（{elapsed:.1f} s），取消其余 {cancelled} 个仍在生成的候选")
+        return RaceResult(index, fields, payload, results)
+    print(f"\n[多候选] {len(agents)} 个候选都未通过检验（{elapsed:.1f} s）")
+    return RaceResult(None, None, None, results)
@@ -5,6 +5,11 @@ from typing import Dict, List
 import re
 import json
 import appdirs
+import threading
+import asyncio
+import contextvars
+import time
+import httpx
 
 # --- 配置应用程序信息 ---
 APP_NAME = "DataConnie"
@@ -14,6 +19,38 @@ APP_AUTHOR = "xiezhenyuan"
 KEY_MODEL = "model"
 KEY_BASE_URL = "base_url"
 KEY_API_KEY = "api_key"
+KEY_HTTP_MAX_CONNECTIONS = "http_max_connections"
+KEY_HTTP_MAX_KEEPALIVE = "http_max_keepalive_connections"
+KEY_HTTP_KEEPALIVE_EXPIRY = "http_keepalive_expiry"
+KEY_RESPONSE_CACHE_MODE = "response_cache_mode"
+KEY_RESPONSE_CACHE_MAX_MB = "response_cache_max_mb"
+KEY_EARLY_STOP = "early_stop"
+KEY_STRUCTURED_OUTPUT = "structured_output"
+KEY_PROMPT_LAYOUT = "prompt_layout"
+KEY_STREAM_USAGE = "stream_usage"
+KEY_PROMPT_COMPACTION = "prompt_compaction"
+KEY_SESSION_RECORD_PATH = "session_record_path"
+KEY_HISTORY_COMPACTION = "history_compaction"
+KEY_HISTORY_RECENT_MESSAGES = "history_recent_messages"
+KEY_HISTORY_MAX_TOKENS = "history_max_tokens"
+KEY_HISTORY_SUMMARY_CHARS = "history_summary_chars"
+KEY_MODEL_ROUTES = "model_routes"
+KEY_RETRY_MAX_ATTEMPTS = "retry_max_attempts"
+KEY_RETRY_BASE_DELAY = "retry_base_delay"
+KEY_RETRY_MAX_DELAY = "retry_max_delay"
+KEY_RETRY_BUDGET_RATIO = "retry_budget_ratio"
+KEY_RETRY_BUDGET_CAPACITY = "retry_budget_capacity"
+KEY_CIRCUIT_FAILURE_THRESHOLD = "circuit_failure_threshold"
+KEY_CIRCUIT_COOLDOWN = "circuit_cooldown"
+KEY_RATE_LIMIT_RPM = "rate_limit_rpm"
+KEY_RATE_LIMIT_TPM = "rate_limit_tpm"
+KEY_MAX_IN_FLIGHT = "max_in_flight"
+KEY_RATE_LIMIT_COMPLETION_TOKENS = "rate_limit_completion_tokens"
+KEY_BEST_OF_N = "best_of_n"
+KEY_BEST_OF_N_TEMPERATURE = "best_of_n_temperature"
+KEY_BEST_OF_N_TIMEOUT = "best_of_n_timeout"
+KEY_SPECULATIVE_PIPELINE = "speculative_pipeline"
+KEY_METRICS_PATH = "metrics_path"
 # 添加其他设置的键名...
 
 # --- 初始空设置 (当配置文件不存在时创建) ---
@@ -132,7 +169,874 @@ print(f"[应用] API Key: {api_key if api_key else '未设置'}") # 不直接显
 
 
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APIError, BadRequestError, RateLimitError
+from response_cache import ResponseCache
+from stream_parser import SectionParser, Section, FieldEvent, ResultEvent, code_compiles
+from token_budget import estimate_tokens
+from history_manager import HistoryCompactor, message_tokens
+from model_routes import resolve_routes, RouteStats
+from retry_engine import AgentFailure, CircuitOpenError, CircuitBreaker, RetryBudget, RetryEngine, classify_error
+from rate_limiter import RateLimiter
+from call_metrics import CallMetrics, note
+
+
+def _setting(key, default):
+    """取可选设置项，未设置或为空字符串时使用默认值"""
+    value = current_config.get(key)
+    return default if value in (None, "") else value
+
+
+def parse_bool(value):
+    """把设置值解析为布尔值：接受 JSON 的 true/false 与数字，以及不区分大小写的
+    "true"/"false"、"1"/"0"、"yes"/"no"、"on"/"off" 字符串；无法识别时返回 None"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    text = str(value).strip().lower()
+    if text in ("true", "1", "yes", "on"):
+        return True
+    if text in ("false", "0", "no", "off"):
+        return False
+    return None
+
+
+def _bool_setting(key, default):
+    """取布尔设置项（解析规则见 parse_bool），未设置或无法识别时使用默认值"""
+    value = parse_bool(_setting(key, default))
+    if value is None:
+        print(f"[配置] 无法识别的布尔设置 {key}={current_config.get(key)!r}，使用默认值 {default}")
+        return default
+    return value
+
+
+class _KeepAliveStream(httpx.SyncByteStream):
+    """openai 的流式响应读到 [DONE] 就直接关闭，分块传输的结束标记还没读，httpx 会因此丢弃这条连接。
+    这里在已经读到 [DONE] 时先把剩余的结束标记读完再关闭，连接即可放回连接池；提前中止的流仍直接关闭。"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._iterator = None
+        self._tail = b""
+        self._done = False
+
+    def __iter__(self):
+        # 关闭时要在同一个迭代器上继续读，不能重新开始迭代
+        self._iterator = iter(self._stream)
+        for chunk in self._iterator:
+            if b"data: [DONE]" in self._tail + chunk:
+                self._done = True
+            self._tail = chunk[-16:]
+            yield chunk
+
+    def close(self):
+        try:
+            if self._done:
+                for _ in self._iterator:
+                    pass
+        finally:
+            self._stream.close()
+
+
+class _KeepAliveTransport(httpx.HTTPTransport):
+    def handle_request(self, request):
+        response = super().handle_request(request)
+        response.stream = _KeepAliveStream(response.stream)
+        return response
+
+
+class _AsyncKeepAliveStream(httpx.AsyncByteStream):
+    """_KeepAliveStream 的异步版本"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._iterator = None
+        self._tail = b""
+        self._done = False
+
+    async def __aiter__(self):
+        self._iterator = self._stream.__aiter__()
+        async for chunk in self._iterator:
+            if b"data: [DONE]" in self._tail + chunk:
+                self._done = True
+            self._tail = chunk[-16:]
+            yield chunk
+
+    async def aclose(self):
+        try:
+            if self._done:
+                async for _ in self._iterator:
+                    pass
+        finally:
+            await self._stream.aclose()
+
+
+class _AsyncKeepAliveTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request):
+        response = await super().handle_async_request(request)
+        response.stream = _AsyncKeepAliveStream(response.stream)
+        return response
+
+
+class ClientRegistry:
+    """进程内共享的 OpenAI 客户端注册表。
+
+    按 (base_url, api_key) 各保留一个客户端，所有智能体共用其连接池，
+    一轮多智能体调用可以复用已建立的 HTTP/TLS 连接；重新创建智能体也不会丢弃连接。
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._async_clients = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _limits():
+        return httpx.Limits(
+            max_connections=int(_setting(KEY_HTTP_MAX_CONNECTIONS, 20)),
+            max_keepalive_connections=int(_setting(KEY_HTTP_MAX_KEEPALIVE, 10)),
+            keepalive_expiry=float(_setting(KEY_HTTP_KEEPALIVE_EXPIRY, 120))
+        )
+
+    def get(self, base_url, api_key):
+        key = (base_url, api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = OpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    # 重试统一由 retry_engine 与路由链负责，SDK 内部不再重试
+                    max_retries=0,
+                    http_client=httpx.Client(transport=_KeepAliveTransport(limits=self._limits()), timeout=httpx.Timeout(600.0, connect=10.0))
+                )
+                self._clients[key] = client
+                print(f"[连接池] 新建客户端: {base_url}")
+            return client
+
+    def get_async(self, base_url, api_key):
+        """异步客户端的连接池绑定在共享事件循环上，只应在 agent_loop 中使用"""
+        key = (base_url, api_key)
+        with self._lock:
+            client = self._async_clients.get(key)
+            if client is None:
+                client = AsyncOpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    # 重试统一由 retry_engine 与路由链负责，SDK 内部不再重试
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(transport=_AsyncKeepAliveTransport(limits=self._limits()), timeout=httpx.Timeout(600.0, connect=10.0))
+                )
+                self._async_clients[key] = client
+                print(f"[连接池] 新建异步客户端: {base_url}")
+            return client
+
+    def close_all(self):
+        """关闭全部客户端及其连接（例如退出程序时）"""
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+            async_clients = list(self._async_clients.values())
+            self._async_clients.clear()
+        for client in async_clients:
+            agent_loop.run(client.close())
+
+
+client_registry = ClientRegistry()
+
+
+class AgentLoop:
+    """所有智能体共用的事件循环，运行在一个后台守护线程中。
+
+    各工作流线程通过 submit 提交协程、通过 run 阻塞等待结果，
+    不同工作流的请求因此可以在同一个循环里并发进行（例如分析尚未结束时发起绘图）。
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="agent-loop", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def submit(self, coro):
+        """提交协程，立即返回 concurrent.futures.Future；协程沿用提交线程的 contextvars（如调用指标的工作流状态）"""
+        return asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), self._ensure_started())
+
+    def run(self, coro):
+        """提交协程并阻塞等待结果；不能在事件循环线程内调用"""
+        self._ensure_started()
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("不能在智能体事件循环线程内同步等待，请直接 await 对应的异步方法")
+        return self.submit(coro).result()
+
+
+async def _in_context(coro, context):
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+agent_loop = AgentLoop()
+
+
+def _create_response_cache():
+    """回复缓存：response_cache_mode 为 off（默认）/ readwrite / replay，见 response_cache.py；
+    模式设置无效时打印警告并关闭缓存，不影响程序启动"""
+    cache_dir = os.path.join(appdirs.user_config_dir(APP_NAME, APP_AUTHOR), "response_cache")
+    max_bytes = int(float(_setting(KEY_RESPONSE_CACHE_MAX_MB, 256)) * 1024 * 1024)
+    try:
+        return ResponseCache(cache_dir, max_bytes, mode=_setting(KEY_RESPONSE_CACHE_MODE, "off"))
+    except ValueError as e:
+        print(f"[回复缓存] {e}，已关闭回复缓存")
+        return ResponseCache(cache_dir, max_bytes, mode="off")
+
+
+response_cache = _create_response_cache()
+
+
+class EarlyStopStats:
+    """提前结束的统计（按智能体）。
+
+    未开启 early_stop 时照常读完整个流，记录完整代码块之后模型又生成了多少 token、用了多少秒，作为基线；
+    开启后记录提前关闭的次数，并按基线的平均值估算节省的 token 与时间。
+    """
+
+    def __init__(self):
+        self._agents = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, agent):
+        return self._agents.setdefault(agent, {'stops': 0, 'tail_samples': 0, 'tail_tokens': 0, 'tail_seconds': 0.0})
+
+    def record_tail(self, agent, tokens, seconds):
+        with self._lock:
+            entry = self._entry(agent)
+            entry['tail_samples'] += 1
+            entry['tail_tokens'] += tokens
+            entry['tail_seconds'] += seconds
+
+    def record_stop(self, agent):
+        with self._lock:
+            self._entry(agent)['stops'] += 1
+
+    def stats(self):
+        result = {}
+        with self._lock:
+            for agent, entry in self._agents.items():
+                samples = entry['tail_samples']
+                avg_tokens = entry['tail_tokens'] / samples if samples else None
+                avg_seconds = entry['tail_seconds'] / samples if samples else None
+                result[agent] = {
+                    'stops': entry['stops'],
+                    'tail_samples': samples,
+                    'avg_tail_tokens': avg_tokens,
+                    'avg_tail_seconds': avg_seconds,
+                    'est_saved_tokens': None if avg_tokens is None else entry['stops'] * avg_tokens,
+                    'est_saved_seconds': None if avg_seconds is None else entry['stops'] * avg_seconds
+                }
+        return result
+
+
+early_stop_stats = EarlyStopStats()
+
+
+STRUCTURED_MODES = ("off", "json_schema", "tool")
+STRUCTURED_TOOL_NAME = "submit_reply"
+STRUCTURED_INSTRUCTION = """
+
+***本次请不要使用上面的文本回复格式，而是按给定的 JSON 结构输出：analysis 填写你的思考与分析，其余字段分别填写回复格式中对应一项的内容（见各字段说明），字段取值中不要再带格式标记或[]。***"""
+
+
+class ParseStats:
+    """按智能体、回复格式统计解析成败。
+
+    文本格式的失败率作为基线，结构化输出的调用按该失败率估算避免了多少次解析失败
+    （每次解析失败都意味着工作流要重新请求一轮）。
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, agent, mode, ok):
+        with self._lock:
+            entry = self._counts.setdefault((agent, mode), {'calls': 0, 'failures': 0})
+            entry['calls'] += 1
+            entry['failures'] += 0 if ok else 1
+
+    def stats(self):
+        result = {}
+        with self._lock:
+            for (agent, mode), entry in self._counts.items():
+                result.setdefault(agent, {})[mode] = dict(entry)
+        for agent, modes in result.items():
+            text = modes.get("off")
+            structured = [entry for mode, entry in modes.items() if mode != "off"]
+            if text and text['calls'] and structured:
+                failure_rate = text['failures'] / text['calls']
+                expected = sum(entry['calls'] for entry in structured) * failure_rate
+                modes['est_failures_avoided'] = max(0.0, expected - sum(entry['failures'] for entry in structured))
+            else:
+                modes['est_failures_avoided'] = None
+        return result
+
+
+parse_stats = ParseStats()
+
+
+class PromptCacheStats:
+    """按智能体统计提示词 token、服务端前缀缓存命中的 token 与首字延迟（TTFT），
+    分别给出有无缓存命中时的平均首字延迟，用于衡量提示词布局的效果"""
+
+    def __init__(self):
+        self._agents = {}
+        self._lock = threading.Lock()
+
+    def record(self, agent, ttft, prompt_tokens=None, cached_tokens=None):
+        with self._lock:
+            entry = self._agents.setdefault(agent, {
+                'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0,
+                'cached_calls': 0, 'cached_ttft': 0.0, 'uncached_calls': 0, 'uncached_ttft': 0.0
+            })
+            entry['calls'] += 1
+            entry['prompt_tokens'] += prompt_tokens or 0
+            entry['cached_tokens'] += cached_tokens or 0
+            if ttft is not None:
+                bucket = 'cached' if cached_tokens else 'uncached'
+                entry[f'{bucket}_calls'] += 1
+                entry[f'{bucket}_ttft'] += ttft
+
+    def stats(self):
+        result = {}
+        with self._lock:
+            for agent, entry in self._agents.items():
+                result[agent] = {
+                    'calls': entry['calls'],
+                    'prompt_tokens': entry['prompt_tokens'],
+                    'cached_tokens': entry['cached_tokens'],
+                    'cached_ratio': entry['cached_tokens'] / entry['prompt_tokens'] if entry['prompt_tokens'] else 0.0,
+                    'avg_ttft_cached': entry['cached_ttft'] / entry['cached_calls'] if entry['cached_calls'] else None,
+                    'avg_ttft_uncached': entry['uncached_ttft'] / entry['uncached_calls'] if entry['uncached_calls'] else None
+                }
+        return result
+
+
+prompt_cache_stats = PromptCacheStats()
+
+
+class CompactionStats:
+    """按智能体统计提示词压缩前后的估算 token 数"""
+
+    def __init__(self):
+        self._agents = {}
+        self._lock = threading.Lock()
+
+    def record(self, agent, full_tokens, compact_tokens):
+        with self._lock:
+            entry = self._agents.setdefault(agent, {'calls': 0, 'full_tokens': 0, 'compact_tokens': 0})
+            entry['calls'] += 1
+            entry['full_tokens'] += full_tokens
+            entry['compact_tokens'] += compact_tokens
+
+    def stats(self):
+        with self._lock:
+            return {
+                agent: {
+                    **entry,
+                    'saved_tokens': entry['full_tokens'] - entry['compact_tokens'],
+                    'saved_ratio': 1 - entry['compact_tokens'] / entry['full_tokens'] if entry['full_tokens'] else 0.0
+                }
+                for agent, entry in self._agents.items()
+            }
+
+
+compaction_stats = CompactionStats()
+
+
+# 按 (智能体, 路由) 的调用耗时，见 model_routes.py
+route_stats = RouteStats()
+
+# 逐次调用的耗时与用量（按智能体与工作流状态），metrics_path 非空时导出为 JSONL，见 call_metrics.py
+call_metrics = CallMetrics(path=lambda: _setting(KEY_METRICS_PATH, ""))
+
+# 可能改用备用路由的错误；其中 classify_error 判为 fatal 的（请求本身不合法、鉴权失败、模型不存在等）
+# 换路由也无济于事，直接抛出，只有连接错误、超时、限流与服务端错误才改用下一条路由
+_ROUTE_FALLBACK_ERRORS = (APIError, asyncio.TimeoutError)
+
+# 按路由熔断与工作流共用的重试入口，见 retry_engine.py
+circuit_breaker = CircuitBreaker(
+    failure_threshold=int(_setting(KEY_CIRCUIT_FAILURE_THRESHOLD, 5)),
+    cooldown=float(_setting(KEY_CIRCUIT_COOLDOWN, 30))
+)
+retry_engine = RetryEngine(
+    max_attempts=int(_setting(KEY_RETRY_MAX_ATTEMPTS, 3)),
+    base_delay=float(_setting(KEY_RETRY_BASE_DELAY, 1.0)),
+    max_delay=float(_setting(KEY_RETRY_MAX_DELAY, 30)),
+    budget=RetryBudget(
+        ratio=float(_setting(KEY_RETRY_BUDGET_RATIO, 0.2)),
+        capacity=float(_setting(KEY_RETRY_BUDGET_CAPACITY, 10))
+    )
+)
+
+# 各路由的客户端限流（见 rate_limiter.py），只在 agent_loop 中使用
+_rate_limiters = {}
+
+
+def rate_limiter_for(route):
+    """路由对应的限流器；rpm / tpm 为 0 表示不限，限额修改后换用新的限流器"""
+    limits = (
+        int(route.rpm if route.rpm is not None else _setting(KEY_RATE_LIMIT_RPM, 0)),
+        int(route.tpm if route.tpm is not None else _setting(KEY_RATE_LIMIT_TPM, 0)),
+        int(route.max_in_flight if route.max_in_flight is not None else _setting(KEY_MAX_IN_FLIGHT, 8))
+    )
+    key = (route.label, *limits)
+    limiter = _rate_limiters.get(key)
+    if limiter is None:
+        limiter = _rate_limiters[key] = RateLimiter(route.label, *limits)
+    return limiter
+
+
+class SessionRecorder:
+    """把每次智能体调用的输入追加到 session_record_path 指定的 jsonl 文件（未设置时不记录），
+    供 prompt_ab.py 等脚本用同样的输入重放、对比不同的提示词设置"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def record(self, agent, args):
+        path = _setting(KEY_SESSION_RECORD_PATH, "")
+        if not path:
+            return
+        line = json.dumps({'agent': agent, 'args': list(args), 'time': time.time()}, ensure_ascii=False, default=str)
+        with self._lock:
+            try:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                print(f"[会话记录] 写入失败: {e}")
+
+
+session_recorder = SessionRecorder()
+
+
+def _cached_tokens(usage):
+    """从 usage 中取出命中服务端前缀缓存的 token 数（OpenAI / 通义为 prompt_tokens_details.cached_tokens，
+    DeepSeek 为 prompt_cache_hit_tokens），接口未返回时为 None"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+    return cached
+
+
+# 已确认不支持某种结构化输出的 (base_url, model, 模式)，之后直接使用文本格式
+_structured_unsupported = set()
+
+
+def _load_json_reply(text):
+    """从回复中取出 JSON 对象（容忍思考过程与 ```json 围栏）"""
+    text = text.split('</think>')[-1]
+    start, end = text.find('{'), text.rfind('}')
+    if start < 0 or end < start:
+        raise ValueError("回复中没有 JSON 对象")
+    data = json.loads(text[start:end + 1])
+    if not isinstance(data, dict):
+        raise ValueError("回复不是 JSON 对象")
+    return data
+
+
+class AgentBase:
+    """各智能体的公共基类。
+
+    子类提供 build_messages（生成消息列表）与 parse_response（把回复解析为字典），
+    一次调用的流程（请求、流式读取、清理回复、解析、出错时返回错误文本）都在 astream 中完成，
+    需要在字段完整时提前行动的调用方直接迭代 astream，其余调用方使用只返回最终结果的 aprocess。
+    同步的 process_query 只是把对应的 aprocess_query 交给 agent_loop 执行并等待结果。
+    客户端在每次使用时从共享注册表按当前设置取得，设置界面修改 base_url / api_key 后自动换用对应的客户端。
+    各智能体使用的模型、接口与采样参数由设置项 model_routes 决定（见 model_routes.py），未配置时使用全局设置。
+    """
+
+    # 各智能体的采样参数，子类按需覆盖
+    SAMPLING = {
+        'temperature': 0.05,
+        'top_p': 0.3,
+        'max_tokens': 8192,
+        'presence_penalty': 0.5,
+        'frequency_penalty': 0.3
+    }
+    # 为 True 时无论回复中是否出现固定格式标记，都去掉结尾的 ```
+    ALWAYS_STRIP_FENCE = False
+    # 回复格式中按顺序出现的各段，供流式解析提前发出字段事件
+    SECTIONS = ()
+    # 除 </think> 与固定格式标记外，出现后需要从其后重新解析的标记
+    RESETS = ()
+    # 该字段是一个能通过 compile 的完整代码块时即可结束读取（需在设置中开启 early_stop）
+    EARLY_STOP_FIELD = None
+    # 提示词中随每次调用变化的部分：从第一个标题开始到第二个标题之前（数据库概况在前，对话与任务在后）
+    PROMPT_DATA = ("\n# 二、", "\n# 三、")
+    # 提示词生成函数是否支持 compact（去掉重复强调的段落）
+    COMPACTABLE = False
+    # 所属流水线，限流排队时按流水线轮转放行
+    PIPELINE = "default"
+
+    def routes(self):
+        """本智能体的路由链（首选路由在前），每次调用时按当前设置生成"""
+        return resolve_routes(_setting(KEY_MODEL_ROUTES, {}), type(self).__name__, model, base_url, api_key)
+
+    @property
+    def client(self):
+        route = self.routes()[0]
+        return client_registry.get(route.base_url, route.api_key)
+
+    @property
+    def async_client(self):
+        route = self.routes()[0]
+        return client_registry.get_async(route.base_url, route.api_key)
+
+    def build_messages(self, *args):
+        raise NotImplementedError
+
+    def parse_response(self, response_text, *args):
+        raise NotImplementedError
+
+    def format_prompt(self, prompt_format, *args):
+        """生成提示词；开启 prompt_compaction 且本智能体支持时去掉重复的段落，并记录节省的 token"""
+        if not (self.COMPACTABLE and _bool_setting(KEY_PROMPT_COMPACTION, False)):
+            return prompt_format(*args)
+        full_tokens = estimate_tokens(prompt_format(*args, compact=False))
+        prompt = prompt_format(*args, compact=True)
+        compact_tokens = estimate_tokens(prompt)
+        compaction_stats.record(type(self).__name__, full_tokens, compact_tokens)
+        print(f"[提示词压缩] {type(self).__name__} 节省约 {full_tokens - compact_tokens} tokens（{full_tokens} -> {compact_tokens}）")
+        return prompt
+
+    def layout_messages(self, prompt):
+        """把完整提示词排成消息列表。
+
+        prompt_layout 为 split（默认）时，固定的任务说明、执行要求、回复格式与示例放在 system 消息中，
+        每次调用都完全相同，可以命中服务端的前缀缓存；PROMPT_DATA 范围内的数据库概况、对话与任务
+        放在 user 消息中（数据库概况在前），system 中原位置只保留标题与一句说明，各部分的编号引用不受影响。
+        为 single 时与原来一样整段作为一条 user 消息。
+        """
+        if _setting(KEY_PROMPT_LAYOUT, "split") == "single":
+            return [{"role": "user", "content": prompt}]
+        start_header, end_header = self.PROMPT_DATA
+        start = prompt.index(start_header)
+        end = prompt.index(end_header, start)
+        header_end = prompt.index('\n', start + 1)
+        system_prompt = prompt[:header_end + 1] + "    （本部分内容见用户消息）" + prompt[end:]
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt[start + 1:end]}
+        ]
+
+    def finalize_response(self, response_dict, *args):
+        """文本解析与结构化输出共用的收尾处理（如保存对话历史），默认原样返回"""
+        return response_dict
+
+    def structured_mode(self):
+        """本智能体的结构化输出模式：structured_output 设置为字符串时对全部智能体生效，
+        为字典时按类名取值（可用 default 指定其余智能体的模式）"""
+        mode = _setting(KEY_STRUCTURED_OUTPUT, "off")
+        if isinstance(mode, dict):
+            mode = mode.get(type(self).__name__, mode.get("default", "off"))
+        if mode not in STRUCTURED_MODES:
+            raise ValueError(f"未知的结构化输出模式: {mode}，可选 {STRUCTURED_MODES}")
+        return mode
+
+    def output_schema(self):
+        """由 SECTIONS 生成的 JSON schema，analysis 放在最前，让模型先写思考再填写各字段"""
+        properties = {'analysis': {'type': 'string', 'description': '你的思考与分析'}}
+        for section in self.SECTIONS:
+            prop = {'type': 'string', 'description': f'回复格式中「{section.marker}」一项的内容'}
+            if section.choices is not None:
+                prop['enum'] = list(section.choices)
+            properties[section.field] = prop
+        return {
+            'type': 'object',
+            'properties': properties,
+            'required': list(properties),
+            'additionalProperties': False
+        }
+
+    def structured_request(self, mode):
+        """结构化输出需要附加的请求参数"""
+        name = type(self).__name__
+        if mode == "json_schema":
+            return {'response_format': {'type': 'json_schema', 'json_schema': {'name': name, 'schema': self.output_schema(), 'strict': True}}}
+        return {
+            'tools': [{'type': 'function', 'function': {'name': STRUCTURED_TOOL_NAME, 'description': f'{name} 的回复', 'parameters': self.output_schema()}}],
+            'tool_choice': {'type': 'function', 'function': {'name': STRUCTURED_TOOL_NAME}}
+        }
+
+    def clean_response(self, response):
+        """去掉思考过程与回复格式外层的标记"""
+        response = response.split('</think>')[-1].strip()
+        if self.ALWAYS_STRIP_FENCE or '```你的回复固定格式' in response:
+            response = response.split('```你的回复固定格式')[-1].strip()
+            response = response.rstrip('```').strip()
+        return response
+
+    def estimate_request_tokens(self, messages, route, extra=None):
+        """限流时一次请求预占的 token：提示词估算加上预留的回复长度（不超过 max_tokens）"""
+        sampling = {**self.SAMPLING, **route.sampling, **(extra or {})}
+        reserve = int(_setting(KEY_RATE_LIMIT_COMPLETION_TOKENS, 1024))
+        if sampling.get('max_tokens'):
+            reserve = min(reserve, int(sampling['max_tokens']))
+        return sum(estimate_tokens(message['content']) for message in messages) + reserve
+
+    async def stream_completion(self, messages, extra=None, route=None, permit=None):
+        """流式请求，逐段产出回复文本（工具调用时为参数文本）；提前停止迭代时关闭连接。
+        route 为使用的路由（默认首选路由）；stream_usage 开启（默认）时请求接口在流末尾返回 usage，
+        记录缓存命中的 token 与首字延迟，并把实际用量填入限流的 permit"""
+        route = route or self.routes()[0]
+        stream_usage = _bool_setting(KEY_STREAM_USAGE, True)
+        started = time.perf_counter()
+        ttft = None
+        usage = None
+        generated = []
+        completion = await client_registry.get_async(route.base_url, route.api_key).chat.completions.create(
+            model=route.model,
+            messages=messages,
+            stream=True,
+            **({'stream_options': {'include_usage': True}} if stream_usage else {}),
+            **{**self.SAMPLING, **route.sampling, **(extra or {})}
+        )
+        try:
+            async for chunk in completion:
+                if getattr(chunk, 'usage', None) is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                text = delta.content
+                if text is None and delta.tool_calls:
+                    text = delta.tool_calls[0].function.arguments
+                if text:
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                    print(text, end="")
+                    generated.append(text)
+                    yield text
+        finally:
+            await completion.close()
+            if permit is not None and usage is not None:
+                permit.used_tokens = usage.total_tokens
+            self._record_usage(ttft, usage)
+            generation = None if ttft is None else time.perf_counter() - started - ttft
+            if usage is not None:
+                note(ttft=ttft, generation_seconds=generation, prompt_tokens=usage.prompt_tokens,
+                     cached_tokens=_cached_tokens(usage), completion_tokens=usage.completion_tokens, tokens_estimated=False)
+            else:
+                note(ttft=ttft, generation_seconds=generation, completion_tokens=estimate_tokens("".join(generated)))
+
+    def _record_usage(self, ttft, usage):
+        agent_name = type(self).__name__
+        if usage is None:
+            prompt_cache_stats.record(agent_name, ttft)
+            return
+        cached = _cached_tokens(usage)
+        prompt_cache_stats.record(agent_name, ttft, usage.prompt_tokens, cached)
+        ttft_text = "未知" if ttft is None else f"{ttft:.2f} s"
+        print(f"\n[前缀缓存] {agent_name} 提示 {usage.prompt_tokens} tokens，缓存命中 {cached if cached is not None else '未返回'}，首字延迟 {ttft_text}")
+
+    async def iter_response(self, messages, should_stop=None, extra=None):
+        """逐段产出回复：启用回复缓存时先查缓存（命中时一次产出全部文本），未命中再请求模型。
+        每产出一段后调用 should_stop，返回 True 时关闭连接、不再读取后续内容；extra 为附加的请求参数。
+        按路由链依次尝试：首字超时或请求失败时改用下一条路由，开始输出后不再切换；熔断中的路由直接跳过。
+        请求发出前先经过该路由的限流器排队"""
+        routes = self.routes()
+        primary = routes[0]
+        key = response_cache.make_key(primary.model, {**self.SAMPLING, **primary.sampling, **(extra or {})}, messages) if response_cache.enabled else None
+        if key is not None:
+            response = response_cache.get(key)
+            if response is not None:
+                print(response, end="")
+                print(f"\n[回复缓存] 命中 {key[:12]}，命中率 {response_cache.stats()['hit_rate']:.0%}")
+                note(source='cache', completion_tokens=estimate_tokens(response))
+                yield response
+                return
+        agent_name = type(self).__name__
+        parts = []
+        open_for = []
+        queued = 0.0
+        for index, route in enumerate(routes):
+            is_last = index == len(routes) - 1
+            allowed, remaining = circuit_breaker.allow(route.label)
+            if not allowed:
+                open_for.append(remaining)
+                print(f"\n[模型路由] {agent_name} -> {route.label} 熔断中（还需 {remaining:.0f} s），跳过")
+                if is_last:
+                    raise CircuitOpenError(f"所有路由都处于熔断状态: {[r.label for r in routes]}", min(open_for))
+                continue
+            limiter = rate_limiter_for(route)
+            permit = await limiter.acquire(self.PIPELINE, self.estimate_request_tokens(messages, route, extra))
+            if permit.waited >= 1:
+                print(f"\n[限流] {agent_name} 在 {route.label} 排队 {permit.waited:.1f} s")
+            queued += permit.waited
+            note(route=route.label, routes_tried=index + 1, queued=queued)
+            try:
+                started = time.perf_counter()
+                stream = self.stream_completion(messages, extra, route, permit)
+                try:
+                    try:
+                        text = await asyncio.wait_for(stream.__anext__(), None if is_last else route.first_token_timeout)
+                    except StopAsyncIteration:
+                        text = None
+                except _ROUTE_FALLBACK_ERRORS as e:
+                    await stream.aclose()
+                    route_stats.record(agent_name, route.label, False)
+                    if classify_error(e)[0] == "fatal":
+                        # 例如结构化输出请求的 400 需要原样抛给 structured_response 记录为不支持
+                        raise
+                    circuit_breaker.record_failure(route.label)
+                    if isinstance(e, RateLimitError):
+                        limiter.pause(classify_error(e)[1] or 2.0)
+                    if is_last:
+                        raise
+                    reason = f"{route.first_token_timeout:g} s 内没有输出" if isinstance(e, asyncio.TimeoutError) else f"请求失败（{type(e).__name__}: {e}）"
+                    print(f"\n[模型路由] {agent_name} -> {route.label} {reason}，改用 {routes[index + 1].label}")
+                    continue
+                ttft = time.perf_counter() - started if text is not None else None
+                failed = False
+                try:
+                    if text is not None:
+                        parts.append(text)
+                        yield text
+                        if should_stop is None or not should_stop():
+                            async for text in stream:
+                                parts.append(text)
+                                yield text
+                                if should_stop is not None and should_stop():
+                                    break
+                except Exception as e:
+                    failed = True
+                    # 只有接口本身的故障计入熔断，鉴权失败等配置错误应直接失败而不是熔断后等待
+                    if classify_error(e)[0] == "transient":
+                        circuit_breaker.record_failure(route.label)
+                    raise
+                finally:
+                    await stream.aclose()
+                    if not failed:
+                        circuit_breaker.record_success(route.label)
+                    latency = time.perf_counter() - started
+                    route_stats.record(agent_name, route.label, not failed, ttft, latency)
+                    ttft_text = "无输出" if ttft is None else f"{ttft:.2f} s"
+                    print(f"\n[模型路由] {agent_name} -> {route.label} 首字 {ttft_text}，总耗时 {latency:.2f} s")
+            finally:
+                limiter.release(permit)
+            break
+        if key is not None:
+            if route is primary:
+                response_cache.put(key, primary.model, "".join(parts))
+                print(f"\n[回复缓存] 未命中 {key[:12]}，已写入缓存，命中率 {response_cache.stats()['hit_rate']:.0%}")
+            else:
+                print(f"\n[回复缓存] 未命中 {key[:12]}，回复来自备用路由，不写入缓存")
+
+    async def astream(self, *args):
+        """流式处理：每个字段一完整就产出 FieldEvent，最后产出 ResultEvent（见 stream_parser.py）"""
+        parser = SectionParser(self.SECTIONS, self.RESETS)
+        early_stop = _bool_setting(KEY_EARLY_STOP, False)
+        agent_name = type(self).__name__
+        # 代码块完整时的 (时刻, 位置)
+        complete_at = None
+        session_recorder.record(agent_name, args)
+        call = call_metrics.begin(agent_name)
+        try:
+            messages = self.build_messages(*args)
+            call['prompt_chars'] = sum(len(message['content']) for message in messages)
+            call['prompt_tokens'] = sum(estimate_tokens(message['content']) for message in messages)
+            print(messages[-1]["content"])
+            mode = self.structured_mode()
+            if mode != "off":
+                result = await self.structured_response(mode, messages, args)
+                if result is not None:
+                    if call['source'] == 'model':
+                        call['source'] = mode
+                    call_metrics.finish(call, "ok")
+                    for event in parser.finish(result):
+                        yield event
+                    yield ResultEvent(result)
+                    return
+            async for text in self.iter_response(messages, should_stop=lambda: early_stop and complete_at is not None):
+                for event in parser.feed(text):
+                    if event.field == self.EARLY_STOP_FIELD and complete_at is None and code_compiles(event.value):
+                        complete_at = (time.perf_counter(), parser.end)
+                    yield event
+            if complete_at is not None and early_stop:
+                early_stop_stats.record_stop(agent_name)
+                call['early_stop'] = True
+                print(f"\n[提前结束] {agent_name} 已收到完整代码块，关闭连接（已接收约 {estimate_tokens(parser.text)} tokens）")
+                response = parser.truncated_text()
+            else:
+                response = parser.text
+                if complete_at is not None:
+                    tail_tokens = estimate_tokens(parser.text[complete_at[1]:])
+                    early_stop_stats.record_tail(agent_name, tail_tokens, time.perf_counter() - complete_at[0])
+            parse_started = time.perf_counter()
+            try:
+                result = self.parse_response(self.clean_response(response), *args)
+            except Exception:
+                parse_stats.record(agent_name, "off", False)
+                raise
+            finally:
+                call['parse_seconds'] = time.perf_counter() - parse_started
+            parse_stats.record(agent_name, "off", True)
+            call_metrics.finish(call, "ok")
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            result = AgentFailure(f"抱歉，处理您的请求时出现错误: {str(e)}", e)
+            call_metrics.finish(call, "parse_error" if result.kind == "parse" else "request_error", type(e).__name__)
+        except BaseException:
+            # 被取消（多候选、推测执行）或调用方提前关闭了流
+            call_metrics.finish(call, "cancelled")
+            raise
+        for event in parser.finish(result):
+            yield event
+        yield ResultEvent(result)
+
+    async def structured_response(self, mode, messages, args):
+        """以结构化输出请求并解析；接口不支持该模式时返回 None，由调用方改用文本格式。
+        回复不是合法 JSON 时再按文本格式解析同一回复，两者都失败才抛出异常"""
+        agent_name = type(self).__name__
+        primary = self.routes()[0]
+        if (primary.base_url, primary.model, mode) in _structured_unsupported:
+            return None
+        messages = messages[:-1] + [{**messages[-1], "content": messages[-1]["content"] + STRUCTURED_INSTRUCTION}]
+        try:
+            response = "".join([text async for text in self.iter_response(messages, extra=self.structured_request(mode))])
+        except BadRequestError as e:
+            _structured_unsupported.add((primary.base_url, primary.model, mode))
+            print(f"\n[结构化输出] 当前接口不支持 {mode}，改用文本格式: {e}")
+            return None
+        try:
+            data = _load_json_reply(response)
+            response_dict = {section.field: str(data[section.field]).strip() for section in self.SECTIONS}
+        except (ValueError, KeyError) as e:
+            print(f"\n[结构化输出] {agent_name} 的回复不是预期的 JSON（{e}），按文本格式解析")
+            try:
+                result = self.parse_response(self.clean_response(response), *args)
+            except Exception:
+                parse_stats.record(agent_name, mode, False)
+                raise
+            parse_stats.record(agent_name, mode, True)
+            return result
+        parse_stats.record(agent_name, mode, True)
+        return self.finalize_response(response_dict, *args)
+
+    async def aprocess(self, *args):
+        async for event in self.astream(*args):
+            if isinstance(event, ResultEvent):
+                return event.result
 
 
 
@@ -226,109 +1130,88 @@ def customerservice_prompt_format(database_info: str, conversationhistory_with_c
     """
 
 
-class CustomerServiceAgent:
+class CustomerServiceAgent(AgentBase):
+    PIPELINE = "customer_service"
+    SAMPLING = {
+        'temperature': 0.05,
+        'top_p': 0.1,
+        'max_tokens': 4096,
+        'presence_penalty': 2,
+        'frequency_penalty': 2
+    }
+    ALWAYS_STRIP_FENCE = True
+    SECTIONS = (Section('need_clarity', 'pass_to_DA', '\n2.', ('Y', 'N')), Section('to_customer', 'to_customer'))
+    # 转交取数时固定的回复，本轮结束后的历史因此在 pass_to_DA 确定时就已确定（见 speculation.py）
+    CONFIRM_REPLY = "好的，正在为您操作，请稍等片刻"
+
     def __init__(self, max_history: int = 15):
 
         self.max_history = max_history
         self.history = []
+        # 写入提示词的历史视图（self.history 本身不压缩，工作流仍可直接追加、回退）
+        self.compactor = HistoryCompactor(
+            recent_messages=int(_setting(KEY_HISTORY_RECENT_MESSAGES, 6)),
+            max_tokens=int(_setting(KEY_HISTORY_MAX_TOKENS, 3000)),
+            summary_chars=int(_setting(KEY_HISTORY_SUMMARY_CHARS, 200))
+        )
         
         '''# 初始化API
         dashscope.api_key = os.getenv('QWEN_API_KEY')
         self.api = dashscope.Generation'''
-        self.client = OpenAI(
-        base_url =  base_url,
-        api_key = api_key
-        )
-
-    def process_query(self, database_info, query_from_customer_this_turn) -> str:
-        """处理用户输入"""
-        #conversationhistory_with_customer传入self.history
-        try:
-            # 生成完整prompt
-            system_prompt = customerservice_prompt_format(database_info, self.history, query_from_customer_this_turn)
-            print(system_prompt)
-            messages = [
-                {"role": "user", "content": system_prompt}
-            ]
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.05,
-                top_p=0.1,
-                max_tokens=4096,
-                presence_penalty=2,
-                frequency_penalty=2,
-                stream=True
-            )
-            response = ""
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="")
-                    response += chunk.choices[0].delta.content
-            
-            response = response.split('</think>')[-1].strip()
-            response = response.split('```你的回复固定格式')[-1].strip()
-            response = response.rstrip('```').strip()
 
+    def prompt_history(self, history=None):
+        """写入提示词的对话历史：开启 history_compaction（默认）时较早的消息改为摘要、去掉代码与表格，
+        总长度不超过 history_max_tokens。history 默认为当前的 self.history"""
+        if history is None:
+            history = self.history
+        if not _bool_setting(KEY_HISTORY_COMPACTION, True):
+            return history
+        rendered = self.compactor.render(history)
+        if rendered != history:
+            before = sum(message_tokens(message) for message in history)
+            after = sum(message_tokens(message) for message in rendered)
+            print(f"[对话压缩] {len(history)} 条历史约 {before} tokens -> {len(rendered)} 条约 {after} tokens")
+        return rendered
+
+    def history_after(self, query_from_customer_this_turn, to_customer):
+        """本轮对话结束后的历史（不修改 self.history），finalize_response 与推测执行共用"""
+        history = self.history + [
+            {"role": "    顾客", "content": query_from_customer_this_turn},
+            {"role": "    数据库前台", "content": to_customer}
+        ]
+        # 如果历史记录过长，删除最早的对话
+        if len(history) > self.max_history * 2:  # 因为每轮对话有两条消息
+            history = history[-self.max_history * 2:]
+        return history
+
+    def build_messages(self, database_info, query_from_customer_this_turn):
+        #conversationhistory_with_customer传入压缩后的历史视图
+        system_prompt = customerservice_prompt_format(database_info, self.prompt_history(), query_from_customer_this_turn)
+        return self.layout_messages(system_prompt)
+
+    def parse_response(self, response_text, database_info, query_from_customer_this_turn):
+        response_dict = {
+            'need_clarity': re.search(r'pass_to_DA(.*?)to_customer', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n2.').strip().rstrip(']'),
+            'to_customer': re.search(r'to_customer(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']')
+        }
+        return self.finalize_response(response_dict, database_info, query_from_customer_this_turn)
+
+    def finalize_response(self, response_dict, database_info, query_from_customer_this_turn):
+        if response_dict["need_clarity"] == "Y":
+            response_dict["to_customer"] = self.CONFIRM_REPLY
+
+        # 保存与客户的对话历史
+        self.history = self.history_after(query_from_customer_this_turn, response_dict["to_customer"])
+        
+        return response_dict
 
-            # 调用API
-            """response = self.api.call(
-                model='qwen-max-2025-01-25',
-                prompt=prompt
-            )
-                        # 定义完整思考过程
-            reasoning_content = ""
-            # 定义完整回复
-            answer_content = ""
-            # 判断是否结束思考过程并开始回复
-            is_answering = False
-            for chunk in response:
-                # 如果思考过程与回复皆为空，则忽略
-                if (chunk.output.choices[0].message.content == "" and 
-                    chunk.output.choices[0].message.reasoning_content == ""):
-                    pass
-                else:
-                    # 如果当前为思考过程
-                    if (chunk.output.choices[0].message.reasoning_content != "" and 
-                        chunk.output.choices[0].message.content == ""):
-
-                        reasoning_content += chunk.output.choices[0].message.reasoning_content
-                    # 如果当前为回复
-                    elif chunk.output.choices[0].message.content != "":
-                        if not is_answering:
-
-                            is_answering = True
-
-                        answer_content += chunk.output.choices[0].message.content"""
-
-            response_text = response
-            response_dict = {
-                'need_clarity': re.search(r'pass_to_DA(.*?)to_customer', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n2.').strip().rstrip(']'),
-                'to_customer': re.search(r'to_customer(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']')
-            }
-
-            if response_dict["need_clarity"] == "Y":
-                response_dict["to_customer"] = "好的，正在为您操作，请稍等片刻"
+    async def aprocess_query(self, database_info, query_from_customer_this_turn) -> str:
+        """处理用户输入"""
+        return await self.aprocess(database_info, query_from_customer_this_turn)
 
-            # 保存与客户的对话历史
-            self.history.append({
-                "role": "    顾客",
-                "content": query_from_customer_this_turn
-            })
-            self.history.append({
-                "role": "    数据库前台",
-                "content": response_dict["to_customer"]
-            })
-            
-            # 如果历史记录过长，删除最早的对话
-            if len(self.history) > self.max_history * 2:  # 因为每轮对话有两条消息
-                self.history = self.history[-self.max_history * 2:]
-            
-            return response_dict
-            
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            return f"抱歉，处理您的请求时出现错误: {str(e)}"
+    def process_query(self, database_info, query_from_customer_this_turn) -> str:
+        """处理用户输入（同步版本）"""
+        return agent_loop.run(self.aprocess_query(database_info, query_from_customer_this_turn))
 
 
 
@@ -343,12 +1226,18 @@ class CustomerServiceAgent:
 
 
 #conversationhistory传入CustomerServiceAgent的self.history
-def tasksummary_prompt_format(database_info: str, conversationhistory: List[Dict]) -> str:
+def tasksummary_prompt_format(database_info: str, conversationhistory: List[Dict], compact: bool = False) -> str:
     # 格式化历史对话
     history_text = "\n".join([
         f"{msg['role']}: {msg['content']}"
         for msg in conversationhistory
     ])
+    # compact 为 True 时对话历史只出现一遍
+    repeat_note = "" if compact else "由于该部分的重要性，以下将复述两遍。"
+    second_copy = "" if compact else f"""    ```对话历史信息（第二遍）
+{history_text}
+    ```
+"""
     
     return f"""
 # 一、任务背景
@@ -360,14 +1249,11 @@ def tasksummary_prompt_format(database_info: str, conversationhistory: List[Dict
         ```
     - ***理解数据分析：数据分析主要两大板块是取数和预测，取数是数据分析的基础，预测是数据分析的进阶。取数不仅仅是将数据从数据库中提取出来，其中还可能涉及到数据清洗和数据计算；预测则需要在取出数据的基础上，通过一些统计方法来预测数据未来的变化趋势。***
 # 三、公司前台与顾客的历史对话
-    ***你需要着重关注以下对话历史记录，你将从该对话历史信息中提取任务纲要。由于该部分的重要性，以下将复述两遍。***
+    ***你需要着重关注以下对话历史记录，你将从该对话历史信息中提取任务纲要。{repeat_note}***
     ```对话历史信息
 {history_text}
     ```
-    ```对话历史信息（第二遍）
-{history_text}
-    ```
-# 四、任务的具体执行要求（请在理解任务背景与相关信息后，在执行任务时谨记并严格执行该要求）
+{second_copy}# 四、任务的具体执行要求（请在理解任务背景与相关信息后，在执行任务时谨记并严格执行该要求）
     - **首先复述一遍客户本次的需求，你需要着重回顾第三板块中“对话历史信息”模块。**
     - 你只关注客户的最近一次的需求，而不要把客户之前的需求和当前的需求给搞混了（为越近的对话赋予越重的关注度）
     - 当客户对我们提出数据分析的咨询时，客户的需求不外乎“取数”或“预测”两种情况。做取数任务时，重点考虑我们的数据库范围；做预测任务时，我们仅做简单的预测方法，比如线性回归、时间序列分析等，且预测时无需提前进行各种检验，直接开始预测算法即可，首选可行的预测方法而非最精确的预测方法。最后提醒数据分析师需要将已有数据和预测结果（主要就是期望和标准差）固定赋值到result_df中。
@@ -415,7 +1301,21 @@ def tasksummary_prompt_format(database_info: str, conversationhistory: List[Dict
     """
 
 
-class TaskSummaryAgent:
+class TaskSummaryAgent(AgentBase):
+    PIPELINE = "customer_service"
+    SAMPLING = {
+        'temperature': 0.05,
+        'top_p': 0.1,
+        'presence_penalty': 2,
+        'frequency_penalty': 2,
+        'max_tokens': 8192,
+        'logit_bias': None
+    }
+    ALWAYS_STRIP_FENCE = True
+    SECTIONS = (Section('task_summary', '正式任务指令'),)
+    PROMPT_DATA = ("\n# 二、", "\n# 四、")
+    COMPACTABLE = True
+
     def __init__(self, max_history: int = 10):
 
         self.max_history = max_history
@@ -424,77 +1324,24 @@ class TaskSummaryAgent:
         '''# 初始化API
         dashscope.api_key = os.getenv('QWEN_API_KEY')
         self.api = dashscope.Generation'''
-        self.client = OpenAI(
-        base_url =  base_url,
-        api_key = api_key
-        )
 
-    def process_query(self, database_info, conversationhistory) -> str:
+    def build_messages(self, database_info, conversationhistory):
+        system_prompt = self.format_prompt(tasksummary_prompt_format, database_info, conversationhistory)
+        return self.layout_messages(system_prompt)
+
+    def parse_response(self, response_text, database_info, conversationhistory):
+        response_dict = {
+            'task_summary': re.search(r'正式任务指令(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']')
+        }
+        return response_dict
+
+    async def aprocess_query(self, database_info, conversationhistory) -> str:
         """处理输入"""
-        try:
-            # 生成完整prompt
-            system_prompt = tasksummary_prompt_format(database_info, conversationhistory)
-            print(system_prompt)
-            '''# 调用API
-            response = self.api.call(
-                model='qwen-max-2025-01-25',
-                prompt=prompt
-            )'''
-            messages = [
-                {"role": "user", "content": system_prompt}
-            ]
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.05,
-                top_p=0.1,
-                presence_penalty=2,
-                frequency_penalty=2,
-                max_tokens=8192,
-                logit_bias=None,
-                stream=True
-            )
-            response = ""
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="")
-                    response += chunk.choices[0].delta.content
-            response = response.split('</think>')[-1].strip()
-            response = response.split('```你的回复固定格式')[-1].strip()
-            response = response.rstrip('```').strip()
-            # 定义完整思考过程
-            """reasoning_content = ""
-            # 定义完整回复
-            answer_content = ""
-            # 判断是否结束思考过程并开始回复
-            is_answering = False
-            for chunk in response:
-                # 如果思考过程与回复皆为空，则忽略
-                if (chunk.output.choices[0].message.content == "" and 
-                    chunk.output.choices[0].message.reasoning_content == ""):
-                    pass
-                else:
-                    # 如果当前为思考过程
-                    if (chunk.output.choices[0].message.reasoning_content != "" and 
-                        chunk.output.choices[0].message.content == ""):
-                        print(chunk.output.choices[0].message.reasoning_content, end="")
-                        reasoning_content += chunk.output.choices[0].message.reasoning_content
-                    # 如果当前为回复
-                    elif chunk.output.choices[0].message.content != "":
-                        if not is_answering:
-                            print(chunk.output.choices[0].message.content, end="")
-                            is_answering = True
-
-                        answer_content += chunk.output.choices[0].message.content"""
-
-            response_text = response
-            response_dict = {
-                'task_summary': re.search(r'正式任务指令(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']')
-            }
-            return response_dict
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            return f"抱歉，处理您的请求时出现错误: {str(e)}"
+        return await self.aprocess(database_info, conversationhistory)
+
+    def process_query(self, database_info, conversationhistory) -> str:
+        """处理输入（同步版本）"""
+        return agent_loop.run(self.aprocess_query(database_info, conversationhistory))
 
 
 #task传入tasksummaryagent的response_dict['task_summary']
@@ -578,7 +1425,19 @@ def dataanalysis_prompt_format(database_info: str, task) -> str:
 
     """
 
-class DataAnalysisAgent:
+class DataAnalysisAgent(AgentBase):
+    PIPELINE = "analysis"
+    SAMPLING = {
+        'temperature': 0.05,
+        'top_p': 0.1,
+        'max_tokens': 8192,
+        'presence_penalty': 0.5,
+        'frequency_penalty': 0.3
+    }
+    SECTIONS = (Section('feasibility', '该任务是否可实现', choices=('Y', 'N')), Section('python_code', 'python代码', None))
+    RESETS = ('正式的判断与代码',)
+    EARLY_STOP_FIELD = 'python_code'
+
     def __init__(self, max_history: int = 10):
 
         self.max_history = max_history
@@ -587,88 +1446,63 @@ class DataAnalysisAgent:
         '''# 初始化API
         dashscope.api_key = os.getenv('QWEN_API_KEY')
         self.api = dashscope.Generation'''
-        self.client = OpenAI(
-        base_url = base_url,
-        api_key = api_key
-        )
 
-    def process_query(self, database_info, task) -> str:
-        """处理输入"""
+    def build_messages(self, database_info, task):
+        system_prompt = dataanalysis_prompt_format(database_info, task)
+        return self.layout_messages(system_prompt)
+
+    def parse_response(self, response_text, database_info, task):
+        response_text = response_text.split('正式的判断与代码')[-1].strip()
         try:
-            # 生成完整prompt
-            system_prompt = dataanalysis_prompt_format(database_info, task)
-            print(system_prompt)
-            messages = [
-                {"role": "user", "content": system_prompt}
-            ]
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.05,
-                top_p=0.1,
-                max_tokens=8192,
-                presence_penalty=0.5,
-                frequency_penalty=0.3,
-                stream=True
-            )
-            response = ""
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="")
-                    response += chunk.choices[0].delta.content
-            response = response.split('</think>')[-1].strip()
-            if '```你的回复固定格式' in response:
-                response = response.split('```你的回复固定格式')[-1].strip()
-                response = response.rstrip('```').strip()
-            '''# 调用API
-            response = self.api.call(
-                model='qwen-max-2025-01-25',
-                prompt=prompt
-            )'''
-
-            """# 定义完整思考过程
-            reasoning_content = ""
-            # 定义完整回复
-            answer_content = ""
-            # 判断是否结束思考过程并开始回复
-            is_answering = False
-            for chunk in response:
-                # 如果思考过程与回复皆为空，则忽略
-                if (chunk.output.choices[0].message.content == "" and 
-                    chunk.output.choices[0].message.reasoning_content == ""):
-                    pass
-                else:
-                    # 如果当前为思考过程
-                    if (chunk.output.choices[0].message.reasoning_content != "" and 
-                        chunk.output.choices[0].message.content == ""):
+            pycode = re.search(r'python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+        except:
+            try:
+                pycode = re.search(r'原因(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+            except:
+                pycode = re.search(r'不可实现(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
 
-                        reasoning_content += chunk.output.choices[0].message.reasoning_content
-                    # 如果当前为回复
-                    elif chunk.output.choices[0].message.content != "":
-                        if not is_answering:
+        response_dict = {
+            'feasibility': re.search(r'该任务是否可实现(.*?)python代码', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']'),
+            'python_code': pycode
+        }
+        print(response_dict)
+        return response_dict
 
-                            is_answering = True
+    async def aprocess_query(self, database_info, task) -> str:
+        """处理输入"""
+        return await self.aprocess(database_info, task)
 
-                        answer_content += chunk.output.choices[0].message.content"""
+    def process_query(self, database_info, task) -> str:
+        """处理输入（同步版本）"""
+        return agent_loop.run(self.aprocess_query(database_info, task))
 
-            response_text = response.split('正式的判断与代码')[-1].strip()
-            try:
-                pycode = re.search(r'python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
-            except:
-                try:
-                    pycode = re.search(r'原因(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
-                except:
-                    pycode = re.search(r'不可实现(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
 
-            response_dict = {
-                'feasibility': re.search(r'该任务是否可实现(.*?)python代码', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']'),
-                'python_code': pycode
-            }
-            print(response_dict)
-            return response_dict
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            return f"抱歉，处理您的请求时出现错误: {str(e)}"
+def best_of_n():
+    return int(_setting(KEY_BEST_OF_N, 1))
+
+
+def best_of_n_timeout():
+    """多候选取数时单次检验（执行候选代码）的超时秒数，超时的候选工作进程被结束"""
+    return float(_setting(KEY_BEST_OF_N_TIMEOUT, 60))
+
+
+def speculative_pipeline():
+    """speculative_pipeline 开启时工作流提前启动需求梳理与取数（见 speculation.py），默认关闭"""
+    return _bool_setting(KEY_SPECULATIVE_PIPELINE, False)
+
+
+def data_analysis_candidates():
+    """best_of_n 大于 1 时返回对应数量的取数智能体，供工作流并发生成多个候选（见 candidates.py），否则返回空列表。
+    第一个候选使用原来的采样参数，其余提高温度（best_of_n_temperature）以得到不同的代码"""
+    n = best_of_n()
+    if n <= 1:
+        return []
+    agents = [DataAnalysisAgent() for _ in range(n)]
+    temperature = float(_setting(KEY_BEST_OF_N_TEMPERATURE, 0.7))
+    for agent in agents[1:]:
+        # 原来的 top_p 很小，只提高温度几乎不会改变输出
+        agent.SAMPLING = {**DataAnalysisAgent.SAMPLING, 'temperature': temperature, 'top_p': 0.95}
+    return agents
 
 
 #运行后就告诉前台 数已取好，请转告顾客查看数据
@@ -714,7 +1548,11 @@ def bugfinder_prompt_format(database_info: str, task ,problem,problemds, wrongco
     ***以上是你的回复格式，你仅能将你的回复按要求填充在[]中，其他内容严格保持不变，不要在前端与后端增添无关语句，回答时需要确保完整输出以上结构，不要遗漏，且以上2点的逻辑不能相悖。***
     """
 
-class BugFinderAgent:
+class BugFinderAgent(AgentBase):
+    PIPELINE = "analysis"
+    SECTIONS = (Section('diagnose', '诊断结果', choices=('可通过修改代码来解决', '不能通过修改代码来解决')), Section('python_code', '更正后的python代码', None))
+    EARLY_STOP_FIELD = 'python_code'
+
     def __init__(self, max_history: int = 10):
 
         self.max_history = max_history
@@ -723,82 +1561,33 @@ class BugFinderAgent:
         '''# 初始化API
         dashscope.api_key = os.getenv('QWEN_API_KEY')
         self.api = dashscope.Generation'''
-        self.client = OpenAI(
-        base_url =  base_url,
-        api_key = api_key
-        )
 
-    def process_query(self, database_info, task,problem,problemds, wrongcode) -> str:
-        """处理输入"""
+    def build_messages(self, database_info, task, problem, problemds, wrongcode):
+        system_prompt = bugfinder_prompt_format(database_info, task,problem,problemds, wrongcode)
+        return self.layout_messages(system_prompt)
+
+    def parse_response(self, response_text, database_info, task, problem, problemds, wrongcode):
         try:
-            # 生成完整prompt
-            system_prompt = bugfinder_prompt_format(database_info, task,problem,problemds, wrongcode)
-            print(system_prompt)
-            messages = [
-                {"role": "user", "content": system_prompt}
-            ]
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.05,
-                top_p=0.3,
-                max_tokens=8192,
-                presence_penalty=0.5,
-                frequency_penalty=0.3,
-                stream=True
-            )
-            response = ""
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="")
-                    response += chunk.choices[0].delta.content
-            response = response.split('</think>')[-1].strip()
-            if '```你的回复固定格式' in response:
-                response = response.split('```你的回复固定格式')[-1].strip()
-                response = response.rstrip('```').strip()
-            '''# 调用API
-            response = self.api.call(
-                model='qwen-max-2025-01-25',
-                prompt=prompt
-            )'''
-            """# 定义完整思考过程
-            reasoning_content = ""
-            # 定义完整回复
-            answer_content = ""
-            # 判断是否结束思考过程并开始回复
-            is_answering = False
-            for chunk in response:
-                # 如果思考过程与回复皆为空，则忽略
-                if (chunk.output.choices[0].message.content == "" and 
-                    chunk.output.choices[0].message.reasoning_content == ""):
-                    pass
-                else:
-                    # 如果当前为思考过程
-                    if (chunk.output.choices[0].message.reasoning_content != "" and 
-                        chunk.output.choices[0].message.content == ""):
-                        reasoning_content += chunk.output.choices[0].message.reasoning_content
-                    # 如果当前为回复
-                    elif chunk.output.choices[0].message.content != "":
-                        if not is_answering:
-                            is_answering = True
-                        answer_content += chunk.output.choices[0].message.content"""
-            response_text = response
+            pycode = re.search(r'更正后的python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+        except:
             try:
-                pycode = re.search(r'更正后的python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+                pycode = re.search(r'原因(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
             except:
-                try:
-                    pycode = re.search(r'原因(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
-                except:
-                    pycode = re.search(r'不可实现(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+                pycode = re.search(r'不可实现(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
 
-            response_dict = {
-                'diagnose': re.search(r'诊断结果(.*?)更正后的python代码', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']'),
-                'python_code': pycode
-            }
-            return response_dict
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            return f"抱歉，处理您的请求时出现错误: {str(e)}"
+        response_dict = {
+            'diagnose': re.search(r'诊断结果(.*?)更正后的python代码', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']'),
+            'python_code': pycode
+        }
+        return response_dict
+
+    async def aprocess_query(self, database_info, task,problem,problemds, wrongcode) -> str:
+        """处理输入"""
+        return await self.aprocess(database_info, task, problem, problemds, wrongcode)
+
+    def process_query(self, database_info, task,problem,problemds, wrongcode) -> str:
+        """处理输入（同步版本）"""
+        return agent_loop.run(self.aprocess_query(database_info, task, problem, problemds, wrongcode))
 
 
 
@@ -901,7 +1690,12 @@ def Adjustment_prompt_format(database_info: str, previous_code, adjustment_reque
 
     """
 
-class AdjustmentAgent:
+class AdjustmentAgent(AgentBase):
+    PIPELINE = "adjustment"
+    SECTIONS = (Section('feasibility', '该调整任务是否可实现', choices=('Y', 'N')), Section('python_code', '修改后的python代码', None))
+    EARLY_STOP_FIELD = 'python_code'
+    PROMPT_DATA = ("\n# 二、", "\n# 四、")
+
     def __init__(self, max_history: int = 10):
 
         self.max_history = max_history
@@ -910,88 +1704,34 @@ class AdjustmentAgent:
         '''# 初始化API
         dashscope.api_key = os.getenv('QWEN_API_KEY')
         self.api = dashscope.Generation'''
-        self.client = OpenAI(
-        base_url = base_url,
-        api_key = api_key
-        )
 
-    def process_query(self, database_info,previous_code, adjustment_request) -> str:
-        """处理输入"""
-        try:
-            # 生成完整prompt
-            system_prompt = Adjustment_prompt_format(database_info,previous_code, adjustment_request )
-            print(system_prompt)
-            messages = [
-                {"role": "user", "content": system_prompt}
-            ]
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.05,
-                top_p=0.3,
-                max_tokens=8192,
-                presence_penalty=0.5,
-                frequency_penalty=0.3,
-                stream=True
-            )
-            response = ""
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="")
-                    response += chunk.choices[0].delta.content
-            response = response.split('</think>')[-1].strip()
-            if '```你的回复固定格式' in response:
-                response = response.split('```你的回复固定格式')[-1].strip()
-                response = response.rstrip('```').strip()
-            '''# 调用API
-            response = self.api.call(
-                model='qwen-max-2025-01-25',
-                prompt=prompt
-            )'''
-
-            """# 定义完整思考过程
-            reasoning_content = ""
-            # 定义完整回复
-            answer_content = ""
-            # 判断是否结束思考过程并开始回复
-            is_answering = False
-            for chunk in response:
-                # 如果思考过程与回复皆为空，则忽略
-                if (chunk.output.choices[0].message.content == "" and 
-                    chunk.output.choices[0].message.reasoning_content == ""):
-                    pass
-                else:
-                    # 如果当前为思考过程
-                    if (chunk.output.choices[0].message.reasoning_content != "" and 
-                        chunk.output.choices[0].message.content == ""):
-
-                        reasoning_content += chunk.output.choices[0].message.reasoning_content
-                    # 如果当前为回复
-                    elif chunk.output.choices[0].message.content != "":
-                        if not is_answering:
-
-                            is_answering = True
-
-                        answer_content += chunk.output.choices[0].message.content"""
+    def build_messages(self, database_info, previous_code, adjustment_request):
+        system_prompt = Adjustment_prompt_format(database_info,previous_code, adjustment_request )
+        return self.layout_messages(system_prompt)
 
-            response_text = response.split('正式的判断与代码')[-1].strip()
+    def parse_response(self, response_text, database_info, previous_code, adjustment_request):
+        response_text = response_text.split('正式的判断与代码')[-1].strip()
+        try:
+            pycode = re.search(r'修改后的python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+        except:
             try:
-                pycode = re.search(r'修改后的python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+                pycode = re.search(r'原因(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
             except:
-                try:
-                    pycode = re.search(r'原因(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
-                except:
-                    pycode = re.search(r'不可实现(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+                pycode = re.search(r'不可实现(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
 
+        response_dict = {
+            'feasibility': re.search(r'该调整任务是否可实现(.*?)修改后的python代码', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']'),
+            'python_code': pycode
+        }
+        return response_dict
 
-            response_dict = {
-                'feasibility': re.search(r'该调整任务是否可实现(.*?)修改后的python代码', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').lstrip('[').rstrip('\n3.').strip().rstrip(']'),
-                'python_code': pycode
-            }
-            return response_dict
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            return f"抱歉，处理您的请求时出现错误: {str(e)}"
+    async def aprocess_query(self, database_info,previous_code, adjustment_request) -> str:
+        """处理输入"""
+        return await self.aprocess(database_info, previous_code, adjustment_request)
+
+    def process_query(self, database_info,previous_code, adjustment_request) -> str:
+        """处理输入（同步版本）"""
+        return agent_loop.run(self.aprocess_query(database_info, previous_code, adjustment_request))
 
 
 
@@ -1006,7 +1746,13 @@ class AdjustmentAgent:
 
 
 
-def Draw_prompt_format(result_database_info: str, drawing_request) -> str:
+def Draw_prompt_format(result_database_info: str, drawing_request, compact: bool = False) -> str:
+    # compact 为 True 时用户请求只出现一遍
+    repeat_note = "" if compact else "，由于该部分的重要性，以下将重复强调两遍"
+    second_copy = "" if compact else f"""    ```用户请求（第二遍）
+    用户：{drawing_request}
+    ```
+"""
 
     return f"""
 # 一、任务背景：
@@ -1016,14 +1762,11 @@ def Draw_prompt_format(result_database_info: str, drawing_request) -> str:
     {result_database_info}
     ```
 # 三、用户想要如何绘制图表：
-    你需要重点关注以下用户的绘图需求，由于该部分的重要性，以下将重复强调两遍：
+    你需要重点关注以下用户的绘图需求{repeat_note}：
     ```用户请求
     用户：{drawing_request}
     ```
-    ```用户请求（第二遍）
-    用户：{drawing_request}
-    ```
-# 四、任务的具体执行要求（请在理解任务背景、df结构与内容、用户意图后，在执行任务时谨记并严格执行该要求）：
+{second_copy}# 四、任务的具体执行要求（请在理解任务背景、df结构与内容、用户意图后，在执行任务时谨记并严格执行该要求）：
     - 你非常乐意帮助用户来绘制图表，并且你是一个非常专业的程序员，你的代码经用户复制粘贴后可直接执行而不报错。
     - 若用户的绘制需求并不复杂，则你给出的绘图代码也遵循简单原则；若用户详细要求了绘图的各种细节，则你需要重点关注并尽力满足这些绘图细节要求。
     - **你需要重视中文和负号的显示问题，代码中一定包含这两段代码**：(1).plt.rcParams['font.sans-serif'] = ['SimHei']   (2).plt.rcParams['axes.unicode_minus'] = False 
@@ -1057,7 +1800,13 @@ def Draw_prompt_format(result_database_info: str, drawing_request) -> str:
     """
 
 
-class DrawAgent:
+class DrawAgent(AgentBase):
+    PIPELINE = "draw"
+    SECTIONS = (Section('python_code', 'python代码', None),)
+    EARLY_STOP_FIELD = 'python_code'
+    PROMPT_DATA = ("\n# 二、", "\n# 四、")
+    COMPACTABLE = True
+
     def __init__(self, max_history: int = 10):
 
         self.max_history = max_history
@@ -1066,88 +1815,33 @@ class DrawAgent:
         '''# 初始化API
         dashscope.api_key = os.getenv('QWEN_API_KEY')
         self.api = dashscope.Generation'''
-        self.client = OpenAI(
-        base_url = base_url,
-        api_key = api_key
-        )
 
-    def process_query(self, result_database_info,drawing_request) -> str:
-        """处理输入"""
-        try:
-            # 生成完整prompt
-            system_prompt = Draw_prompt_format(result_database_info,drawing_request )
-            print(system_prompt)
-            messages = [
-                {"role": "user", "content": system_prompt}
-            ]
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.05,
-                top_p=0.3,
-                max_tokens=8192,
-                presence_penalty=0.5,
-                frequency_penalty=0.3,
-                stream=True
-            )
-            response = ""
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="")
-                    response += chunk.choices[0].delta.content
-            response = response.split('</think>')[-1].strip()
-            if '```你的回复固定格式' in response:
-                response = response.split('```你的回复固定格式')[-1].strip()
-                response = response.rstrip('```').strip()
-            '''# 调用API
-            response = self.api.call(
-                model='qwen-max-2025-01-25',
-                prompt=prompt
-            )'''
-
-            """# 定义完整思考过程
-            reasoning_content = ""
-            # 定义完整回复
-            answer_content = ""
-            # 判断是否结束思考过程并开始回复
-            is_answering = False
-            for chunk in response:
-                # 如果思考过程与回复皆为空，则忽略
-                if (chunk.output.choices[0].message.content == "" and 
-                    chunk.output.choices[0].message.reasoning_content == ""):
-                    pass
-                else:
-                    # 如果当前为思考过程
-                    if (chunk.output.choices[0].message.reasoning_content != "" and 
-                        chunk.output.choices[0].message.content == ""):
+    def build_messages(self, result_database_info, drawing_request):
+        system_prompt = self.format_prompt(Draw_prompt_format, result_database_info, drawing_request)
+        return self.layout_messages(system_prompt)
 
-                        reasoning_content += chunk.output.choices[0].message.reasoning_content
-                    # 如果当前为回复
-                    elif chunk.output.choices[0].message.content != "":
-                        if not is_answering:
-
-                            is_answering = True
-
-                        answer_content += chunk.output.choices[0].message.content"""
-
-            response_text = response.strip()
+    def parse_response(self, response_text, result_database_info, drawing_request):
+        response_text = response_text.strip()
+        try:
+            pycode = re.search(r' python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+        except:
             try:
-                pycode = re.search(r' python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+                pycode = re.search(r'python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
             except:
-                try:
-                    pycode = re.search(r'python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
-                except:
-                    pycode = re.search(r'python code(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+                pycode = re.search(r'python code(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
 
+        response_dict = {
+            'python_code': pycode
+        }
+        return response_dict
 
-            response_dict = {
-                'python_code': pycode
-            }
-            return response_dict
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            return f"抱歉，处理您的请求时出现错误: {str(e)}"
+    async def aprocess_query(self, result_database_info,drawing_request) -> str:
+        """处理输入"""
+        return await self.aprocess(result_database_info, drawing_request)
 
+    def process_query(self, result_database_info,drawing_request) -> str:
+        """处理输入（同步版本）"""
+        return agent_loop.run(self.aprocess_query(result_database_info, drawing_request))
 
 
 
@@ -1160,7 +1854,14 @@ class DrawAgent:
 
 
 
-def Draw_Adjustment_prompt_format(result_database_info: str, drawing_request, last_code) -> str:
+
+def Draw_Adjustment_prompt_format(result_database_info: str, drawing_request, last_code, compact: bool = False) -> str:
+    # compact 为 True 时用户请求只出现一遍
+    repeat_note = "" if compact else "，由于该部分的重要性，以下将重复强调两遍"
+    second_copy = "" if compact else f"""    ```用户请求（第二遍）
+    用户：{drawing_request}
+    ```
+"""
 
     return f"""
 # 一、任务背景：
@@ -1170,14 +1871,11 @@ def Draw_Adjustment_prompt_format(result_database_info: str, drawing_request, la
     {result_database_info}
     ```
 # 三、用户想要如何进一步修改绘图代码：
-    你需要重点关注以下用户的修改需求，由于该部分的重要性，以下将重复强调两遍：
+    你需要重点关注以下用户的修改需求{repeat_note}：
     ```用户请求
     用户：{drawing_request}
     ```
-    ```用户请求（第二遍）
-    用户：{drawing_request}
-    ```
-# 四、用户的原始绘图代码：
+{second_copy}# 四、用户的原始绘图代码：
     ```用户原始绘图代码
     {last_code}
     ```
@@ -1216,7 +1914,13 @@ def Draw_Adjustment_prompt_format(result_database_info: str, drawing_request, la
     """
 
 
-class DrawAdjustmentAgent:
+class DrawAdjustmentAgent(AgentBase):
+    PIPELINE = "draw"
+    SECTIONS = (Section('python_code', 'python代码', None),)
+    EARLY_STOP_FIELD = 'python_code'
+    PROMPT_DATA = ("\n# 二、", "\n# 五、")
+    COMPACTABLE = True
+
     def __init__(self, max_history: int = 10):
 
         self.max_history = max_history
@@ -1225,56 +1929,32 @@ class DrawAdjustmentAgent:
         '''# 初始化API
         dashscope.api_key = os.getenv('QWEN_API_KEY')
         self.api = dashscope.Generation'''
-        self.client = OpenAI(
-        base_url = base_url,
-        api_key = api_key
-        )
 
-    def process_query(self, result_database_info,drawing_request, last_code) -> str:
-        """处理输入"""
+    def build_messages(self, result_database_info, drawing_request, last_code):
+        system_prompt = self.format_prompt(Draw_Adjustment_prompt_format, result_database_info, drawing_request, last_code)
+        return self.layout_messages(system_prompt)
+
+    def parse_response(self, response_text, result_database_info, drawing_request, last_code):
+        response_text = response_text.strip()
         try:
-            # 生成完整prompt
-            system_prompt = Draw_Adjustment_prompt_format(result_database_info,drawing_request ,last_code)
-            print(system_prompt)
-            messages = [
-                {"role": "user", "content": system_prompt}
-            ]
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.05,
-                top_p=0.3,
-                max_tokens=8192,
-                presence_penalty=0.5,
-                frequency_penalty=0.3,
-                stream=True
-            )
-            response = ""
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="")
-                    response += chunk.choices[0].delta.content
-            response = response.split('</think>')[-1].strip()
-            if '```你的回复固定格式' in response:
-                response = response.split('```你的回复固定格式')[-1].strip()
-                response = response.rstrip('```').strip()
-
-            response_text = response.strip()
+            pycode = re.search(r' python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+        except:
             try:
-                pycode = re.search(r' python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+                pycode = re.search(r'python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
             except:
-                try:
-                    pycode = re.search(r'python代码(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
-                except:
-                    pycode = re.search(r'python code(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
+                pycode = re.search(r'python code(.*)', response_text, re.DOTALL).group(1).strip().lstrip(':').lstrip('：').strip()
 
+        response_dict = {
+            'python_code': pycode
+        }
+        print(response_dict)
+        return response_dict
 
-            response_dict = {
-                'python_code': pycode
-            }
-            print(response_dict)
-            return response_dict
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            return f"抱歉，处理您的请求时出现错误: {str(e)}"
+    async def aprocess_query(self, result_database_info,drawing_request, last_code) -> str:
+        """处理输入"""
+        return await self.aprocess(result_database_info, drawing_request, last_code)
+
+    def process_query(self, result_database_info,drawing_request, last_code) -> str:
+        """处理输入（同步版本）"""
+        return agent_loop.run(self.aprocess_query(result_database_info, drawing_request, last_code))
 
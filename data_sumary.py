@@ -2,13 +2,133 @@ import pandas as pd
 import numpy as np
 from langchain.docstore.document import Document
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy.sparse import csr_matrix
 from sklearn.feature_extraction.text import TfidfVectorizer
 import jieba
 import re
+import os
+import json
+import shutil
+import hashlib
+import appdirs
+import sys
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from sketches import HyperLogLog, KLLSketch, ReservoirSample, BoundedDistinct
+from token_budget import estimate_tokens, clip_text
 
-def preprocess_text(text):
-    """文本预处理：分词、去除标点等"""
+# --- 配置应用程序信息（与 settings.json 所在目录一致） ---
+APP_NAME = "DataConnie"
+APP_AUTHOR = "xiezhenyuan"
+
+# --- 数据概述相关设置的键名 ---
+KEY_RETRIEVAL_CACHE_MAX_MB = "retrieval_cache_max_mb"
+KEY_TOKEN_CACHE_MAX_MB = "token_cache_max_mb"
+KEY_SUMMARY_WORKERS = "summary_workers"
+KEY_APPROX_STATS_MIN_ROWS = "approx_stats_min_rows"
+KEY_ROW_RETRIEVER = "row_retriever"
+KEY_SUMMARY_TOKEN_BUDGET = "summary_token_budget"
+
+# 构建整行检索索引时，从去重后的行中抽样的行数
+ROW_SAMPLE_SIZE = 2000
+# 行数不少于 approx_stats_min_rows 时，各列元素检索索引只在这么多行的随机样本上构建
+ITEM_SAMPLE_SIZE = 200000
+# 检索索引磁盘缓存的格式版本，格式变化时递增以使旧缓存失效
+INDEX_CACHE_VERSION = 1
+# 近似统计时每次送入概要数据结构的行数
+SKETCH_CHUNK_SIZE = 1000000
+
+
+def load_user_settings():
+    """读取用户 settings.json（不存在或损坏时返回空字典，不负责创建文件）"""
+    config_path = os.path.join(appdirs.user_config_dir(APP_NAME, APP_AUTHOR), "settings.json")
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def _setting(settings, key, default):
+    """取设置值，未设置或为空字符串时使用默认值"""
+    value = settings.get(key)
+    return default if value in (None, "") else value
+
+user_settings = load_user_settings()
+# 检索索引磁盘缓存的容量上限（MB），设为 0 则不使用磁盘缓存
+retrieval_cache_max_mb = float(_setting(user_settings, KEY_RETRIEVAL_CACHE_MAX_MB, 512))
+# 分词缓存的内存上限（MB）
+token_cache_max_mb = float(_setting(user_settings, KEY_TOKEN_CACHE_MAX_MB, 64))
+# 并行构建各列检索索引的进程数，0 或 1 表示在当前进程中串行构建
+summary_workers = int(_setting(user_settings, KEY_SUMMARY_WORKERS, 0))
+# 行数不少于该值时列画像改用近似统计，设为 0 则始终精确统计
+approx_stats_min_rows = int(_setting(user_settings, KEY_APPROX_STATS_MIN_ROWS, 1000000))
+# 整行检索后端："tfidf" 对抽样行拟合 TF-IDF；"bm25" 对全部行建倒排索引
+row_retriever = _setting(user_settings, KEY_ROW_RETRIEVER, "tfidf")
+# 数据概述（database_info）的 token 预算，超出时按与查询的相关性压缩；设为 0 则不限制
+summary_token_budget = int(_setting(user_settings, KEY_SUMMARY_TOKEN_BUDGET, 6000))
+
+class TokenCache:
+    """按原始字符串缓存分词结果的 LRU 缓存，以内存占用（估算字节数）为上限，线程安全。
+
+    表格中的分类取值大量重复，缓存后同一取值在进程内只需分词一次。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self.current_bytes -= sys.getsizeof(old_key) + sys.getsizeof(old_value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes
+        }
+
+
+# 进程内共享的分词缓存，元素检索、整行检索与查询处理共用
+token_cache = TokenCache(int(token_cache_max_mb * 1024 * 1024))
+
+def _tokenize(text):
     # 转换为小写
     text = text.lower()
     # 将英文单词转换为小写并分开
@@ -17,113 +137,867 @@ def preprocess_text(text):
     words = jieba.cut(text)
     return ' '.join(words)
 
-def find_related_data(query, column_data, df, top_k=10):
-    """使用改进的TF-IDF方法进行相关数据检索"""
-    # 获取列数据，去重
+def preprocess_text(text):
+    """文本预处理：分词、去除标点等（结果按原始字符串缓存）"""
+    tokens = token_cache.get(text)
+    if tokens is None:
+        tokens = _tokenize(text)
+        token_cache.put(text, tokens)
+    return tokens
+
+def preprocess_cells(cells):
+    """逐个单元格分词后拼接。结巴按空白切分文本块，因此结果与对拼接后的整段文本分词一致，
+    但重复的单元格取值可以命中缓存"""
+    return ' '.join(preprocess_text(cell) for cell in cells)
+
+def _stringify_columns(df):
+    """按 iterrows 取值的方式（同一行先统一 dtype，再逐值 str）把 df 转成逐列的字符串数组"""
+    values = df.to_numpy()
+    return [pd.Series(values[:, j]).map(str).to_numpy() for j in range(values.shape[1])]
+
+def encode_frame(df):
+    """把 df 的每个单元格按 iterrows 取值方式转成字符串，并在全表范围内统一编码。
+
+    返回 (codes, table)：codes 为 行数×列数 的 int32 矩阵，table[codes[i, j]] 即第 i 行第 j 列的字符串。
+    同一字符串不论出现在哪一列都使用同一编码，后续按整数去重即可。
+    """
+    columns = _stringify_columns(df)
+    if not columns:
+        return np.empty((len(df), 0), dtype=np.int32), np.array([], dtype=object)
+    flat_codes, table = pd.factorize(np.concatenate(columns))
+    codes = np.ascontiguousarray(flat_codes.astype(np.int32).reshape(len(columns), len(df)).T)
+    return codes, np.asarray(table, dtype=object)
+
+def collect_item_features(item_codes, codes):
+    """按元素编码收集特征，返回 {元素编码: [特征字符串编码, ...]}，特征去重并按首次出现的行、列顺序排列。
+
+    item_codes 为该列 factorize 后的编码（缺失值为 -1，不参与收集）。
+    """
+    valid = item_codes >= 0
+    valid_codes = item_codes[valid]
+    valid_rows = np.flatnonzero(valid)
+
+    # 每列先在 (元素, 取值) 上去重，再合并成长表，避免构造 行数×列数 的完整长表
+    parts = []
+    for j in range(codes.shape[1]):
+        part = pd.DataFrame({
+            'code': valid_codes,
+            'row': valid_rows,
+            'col': j,
+            'feature': codes[valid, j]
+        })
+        parts.append(part.drop_duplicates(['code', 'feature']))
+    if not parts:
+        return {}
+    pairs = pd.concat(parts, ignore_index=True)
+    pairs = pairs.sort_values(['row', 'col'], kind='stable').drop_duplicates(['code', 'feature'])
+    return pairs.groupby('code', sort=False)['feature'].agg(list).to_dict()
+
+def _iter_item_features(item_is_null, feature_map, table):
+    """按 drop_duplicates 的元素顺序依次给出每个元素的特征字符串列表"""
+    next_code = 0
+    for is_null in item_is_null:
+        # 缺失值与自身不相等，原实现中筛选不到任何行，因此特征为空
+        if is_null:
+            yield []
+        else:
+            yield list(table[feature_map.get(next_code, [])])
+            next_code += 1
+
+def build_item_documents(column_data, df, encoded=None):
+    """一次向量化地为列中每个唯一元素构建特征文档，替代逐元素筛选 + iterrows 的做法。
+
+    每个元素的特征为该元素所在所有行的全部取值（去重），文档格式与原实现一致：
+    "元素: {item} 特征: {...}"。特征按首次出现的行、列顺序排列（原实现为集合，顺序不固定）。
+    encoded 为 encode_frame(df) 的结果，为多列构建时传入以免重复编码。
+    返回 (documents, texts)。
+    """
+    if encoded is None:
+        encoded = encode_frame(df)
+    codes, table = encoded
     unique_items = column_data.drop_duplicates()
-    
-    # 为每个元素创建文档
+    # factorize 的编码顺序与 drop_duplicates 一致（均按首次出现），缺失值编码为 -1
+    item_codes, _ = pd.factorize(column_data)
+    feature_map = collect_item_features(item_codes, codes)
+
     documents = []
     texts = []
-    
-    # 预处理元素
-    for item in unique_items:
-        # 获取该元素的所有行
-        item_data = df[column_data == item]
-        # 提取该元素的特征信息
-        features = set()  # 使用集合去重
-        for _, row in item_data.iterrows():
-            features.update([str(val) for val in row])  # 使用所有列的值作为特征
-        
-        # 创建元素描述文档
+    for item, features in zip(unique_items, _iter_item_features(unique_items.isna(), feature_map, table)):
         item_info = f"元素: {item} 特征: {' '.join(features)}"
-        # 对文本进行预处理
-        processed_text = preprocess_text(item_info)
-        
         documents.append(Document(
             page_content=item_info,
             metadata={"item": item}
         ))
-        texts.append(processed_text)
-
-    # 使用改进的TF-IDF向量化
-    vectorizer = TfidfVectorizer(
-        analyzer='word',
-        token_pattern=r'(?u)\b\w+\b',
-        ngram_range=(1, 2),
-        min_df=1,
-        max_features=5000
-    )
-    
-    # 构建TF-IDF矩阵
-    tfidf_matrix = vectorizer.fit_transform(texts)
-    
-    # 处理查询文本
-    processed_query = preprocess_text(query)
-    query_vec = vectorizer.transform([processed_query])
-    
-    # 计算相似度
-    similarities = cosine_similarity(query_vec, tfidf_matrix)[0]
-    
-    # 获取最相似的前 top_k 个索引
-    top_indices = np.argsort(similarities)[-top_k:][::-1]
-    
-    # 提取相关元素
-    related_items = [documents[i].metadata["item"] for i in top_indices]
-    # 获取最相关的前 top_k 个元素及其相似度
-    top_items_with_scores = sorted(zip(related_items, similarities), key=lambda x: x[1], reverse=True)[:top_k]
-    
-    # 只返回最相关的元素，不包括相似度
-    return [item for item, _ in top_items_with_scores]
+        texts.append(preprocess_cells(["元素:", str(item), "特征:"] + features))
+    return documents, texts
 
-def find_related_rows(query: str, df: pd.DataFrame, top_k: int = 10) -> list[str]:
-    documents = []
-    texts = []
+# 检索统一使用的TF-IDF配置；同时参与磁盘缓存键的计算
+TFIDF_SETTINGS = {
+    'analyzer': 'word',
+    'token_pattern': r'(?u)\b\w+\b',
+    'ngram_range': (1, 2),
+    'min_df': 1,
+    'max_features': 5000
+}
 
-    for idx, row in df.iterrows():
-        row_text = ' '.join(str(val) for val in row.values)
-        processed_text = preprocess_text(row_text)
-        
-        documents.append(Document(
-            page_content=row_text,
-            metadata={"index": idx}
-        ))
-        texts.append(processed_text)
-
-    vectorizer = TfidfVectorizer(
-        analyzer='word',
-        token_pattern=r'(?u)\b\w+\b',
-        ngram_range=(1, 2),
-        min_df=1,
-        max_features=5000
-    )
-    
-    tfidf_matrix = vectorizer.fit_transform(texts)
-    
-    processed_query = preprocess_text(query)
+# BM25 倒排索引与 TF-IDF 使用相同的词切分规则（只取单词，不取二元组）
+_WORD_PATTERN = re.compile(TFIDF_SETTINGS['token_pattern'])
+
+def _new_vectorizer(vocabulary=None):
+    """检索统一使用的TF-IDF向量化器；传入 vocabulary 时用于从缓存还原"""
+    return TfidfVectorizer(vocabulary=vocabulary, **TFIDF_SETTINGS)
+
+def top_k_indices(scores, top_k):
+    """返回得分最高的 top_k 个位置：得分从高到低，同分按位置从小到大，结果确定。
+
+    先用 argpartition 做部分选择（线性时间），只对选出的 top_k 个位置排序。
+    """
+    scores = np.asarray(scores)
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if top_k < len(scores):
+        threshold = scores[np.argpartition(-scores, top_k - 1)[top_k - 1]]
+        # 与第 top_k 名同分的位置只保留最靠前的几个，补足 top_k 个
+        above = np.flatnonzero(scores > threshold)
+        ties = np.flatnonzero(scores == threshold)[:top_k - len(above)]
+        candidates = np.concatenate([above, ties])
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
+
+def sparse_top_k(positions, values, size, top_k):
+    """稀疏得分的 top-k：positions 为得分非零的位置（升序），values 为对应得分（均为正数），
+    size 为总位置数。结果与对稠密得分调用 top_k_indices 相同，但只需处理非零项；
+    非零项不足 top_k 个时按位置从小到大补上得分为 0 的位置。返回 (位置, 得分)。
+    """
+    chosen = top_k_indices(values, top_k)
+    top, top_scores = positions[chosen], values[chosen]
+    if len(top) < top_k:
+        filler = np.setdiff1d(np.arange(min(size, top_k + len(positions))), positions)[:top_k - len(top)]
+        top = np.concatenate([top, filler])
+        top_scores = np.concatenate([top_scores, np.zeros(len(filler))])
+    return top, top_scores
+
+def _top_indices(vectorizer, tfidf_matrix, processed_query, top_k):
+    """对已分词的查询做 transform 与相似度计算，返回最相似的前 top_k 个索引及其相似度"""
     query_vec = vectorizer.transform([processed_query])
-    
-    similarities = cosine_similarity(query_vec, tfidf_matrix)[0]
-    
-    top_indices = np.argsort(similarities)[-top_k:][::-1]
-    
+    # TF-IDF 的行向量与查询向量都已做 L2 归一化，点积即余弦相似度，且不会复制（可能是内存映射的）矩阵；
+    # 结果保持稀疏，只在与查询有共同词的行中做 top-k
+    similarities = (tfidf_matrix @ query_vec.T).tocsc()
+    similarities.eliminate_zeros()
+    similarities.sort_indices()
+    return sparse_top_k(similarities.indices, similarities.data, tfidf_matrix.shape[0], top_k)
+
+def build_row_texts(df):
+    """将 df 的每一行（取值方式同 iterrows）逐单元格分词后拼接，返回分词后的文本列表"""
+    columns = _stringify_columns(df)
+    if not columns:
+        return [''] * len(df)
+    return [preprocess_cells(values) for values in zip(*columns)]
+
+def format_rows_markdown(df, indices, max_chars=None):
+    """将 df 中指定位置的行格式化为 markdown 表格行列表；max_chars 不为 None 时截断过长的单元格"""
     # 创建表头
     header = f"\n    | index | {' | '.join(df.columns)} |"
     # 创建分隔行
     separator = f"|{'---|' * (len(df.columns) + 1)}"
     # 创建数据行
     data_rows = []
-    for i, idx in enumerate(top_indices):
-        row_values = [str(val) for val in df.iloc[idx]]
+    for i, idx in enumerate(indices):
+        row_values = [clip_text(val, max_chars) for val in df.iloc[idx]]
         data_rows.append(f"| {i+1} | {' | '.join(row_values)} |")
-    
+
     # 组合所有行
-    related_rows = [header, separator] + data_rows
-    
-    return related_rows
+    return [header, separator] + data_rows
+
+
+class ItemIndex:
+    """单列的元素检索索引：每个唯一元素一篇特征文档，TF-IDF 只在构建时拟合一次。
+
+    item_rows 为每个元素在 df 中首次出现的行位置（元素到行的映射），用于从缓存还原元素。
+    """
+
+    def __init__(self, items, vectorizer, tfidf_matrix, item_rows):
+        self.items = items
+        self.vectorizer = vectorizer
+        self.tfidf_matrix = tfidf_matrix
+        self.item_rows = item_rows
+
+    @classmethod
+    def build(cls, column_data, df, encoded=None):
+        documents, texts = build_item_documents(column_data, df, encoded)
+        vectorizer = _new_vectorizer()
+        tfidf_matrix = vectorizer.fit_transform(texts)
+        # drop_duplicates 保留首次出现，与元素文档的顺序一致
+        item_rows = np.flatnonzero(~column_data.duplicated().to_numpy())
+        return cls([doc.metadata["item"] for doc in documents], vectorizer, tfidf_matrix, item_rows)
+
+    def related_items_with_scores(self, processed_query, top_k=10):
+        """返回最相关的前 top_k 个 (元素, 相似度)，按相似度从高到低排列"""
+        top_indices, similarities = _top_indices(self.vectorizer, self.tfidf_matrix, processed_query, top_k)
+        return [(self.items[i], float(score)) for i, score in zip(top_indices, similarities)]
+
+    def related_items(self, processed_query, top_k=10):
+        # 只返回最相关的元素，不包括相似度
+        return [item for item, _ in self.related_items_with_scores(processed_query, top_k)]
+
+
+# 子进程内共享的数据，由进程池初始化函数设置
+_worker_shared = {}
+
+def _init_item_worker(codes_name, codes_shape, items_name, items_shape, table):
+    """进程池初始化：挂载共享内存中的编码矩阵，字符串表只随初始化参数传递一次"""
+    codes_shm = shared_memory.SharedMemory(name=codes_name)
+    items_shm = shared_memory.SharedMemory(name=items_name)
+    _worker_shared.update(
+        shm=(codes_shm, items_shm),
+        codes=np.ndarray(codes_shape, dtype=np.int32, buffer=codes_shm.buf),
+        item_codes=np.ndarray(items_shape, dtype=np.int32, buffer=items_shm.buf),
+        table=table
+    )
+
+def _build_item_matrix(task):
+    """在子进程中为一列拟合 TF-IDF，只返回可序列化的数组，由主进程还原为 ItemIndex"""
+    position, labels, item_is_null = task
+    item_codes = _worker_shared['item_codes'][position]
+    feature_map = collect_item_features(item_codes, _worker_shared['codes'])
+    features = _iter_item_features(item_is_null, feature_map, _worker_shared['table'])
+    texts = [preprocess_cells(["元素:", label, "特征:"] + f) for label, f in zip(labels, features)]
+    vectorizer = _new_vectorizer()
+    tfidf_matrix = vectorizer.fit_transform(texts)
+    return vectorizer.vocabulary_, vectorizer.idf_, tfidf_matrix.data, tfidf_matrix.indices, tfidf_matrix.indptr, tfidf_matrix.shape
+
+def _copy_to_shared(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+def build_item_indexes_parallel(df, columns, encoded, workers):
+    """用进程池并行构建多列的 ItemIndex，返回按 columns 顺序排列的 {列名: ItemIndex}。
+
+    全表编码矩阵与各列的元素编码放在共享内存中，子进程只读不复制；
+    结果按列顺序收集，与串行构建完全一致。
+    """
+    codes, table = encoded
+    item_codes = np.empty((len(columns), len(df)), dtype=np.int32)
+    tasks = []
+    uniques = []
+    for position, col in enumerate(columns):
+        column_data = df[col]
+        item_codes[position], _ = pd.factorize(column_data)
+        unique_items = column_data.drop_duplicates()
+        uniques.append((unique_items, np.flatnonzero(~column_data.duplicated().to_numpy())))
+        tasks.append((position, [str(item) for item in unique_items], unique_items.isna().to_numpy()))
+
+    codes_shm = _copy_to_shared(codes)
+    items_shm = _copy_to_shared(item_codes)
+    try:
+        # 使用 spawn 启动子进程，避免在已有 Qt 线程的进程中 fork
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(columns)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_item_worker,
+            initargs=(codes_shm.name, codes.shape, items_shm.name, item_codes.shape, table)
+        ) as executor:
+            results = list(executor.map(_build_item_matrix, tasks))
+    finally:
+        for shm in (codes_shm, items_shm):
+            shm.close()
+            shm.unlink()
+
+    item_indexes = {}
+    for col, (unique_items, item_rows), (vocabulary, idf, data, indices, indptr, shape) in zip(columns, uniques, results):
+        vectorizer = _new_vectorizer(vocabulary)
+        vectorizer.idf_ = idf
+        tfidf_matrix = csr_matrix((data, indices, indptr), shape=shape)
+        item_indexes[col] = ItemIndex(list(unique_items), vectorizer, tfidf_matrix, item_rows)
+    return item_indexes
+
+
+class RowIndex:
+    """整行检索索引：对 df 中抽样的行拟合一次 TF-IDF。
+
+    row_positions 为抽样行在原 df 中的位置，df 为按该顺序取出的行（索引已重置）。
+    """
+
+    def __init__(self, df, vectorizer, tfidf_matrix, row_positions):
+        self.df = df
+        self.vectorizer = vectorizer
+        self.tfidf_matrix = tfidf_matrix
+        self.row_positions = row_positions
+
+    @classmethod
+    def build(cls, df, row_positions=None):
+        if row_positions is None:
+            row_positions = np.arange(len(df))
+        rows = df.iloc[row_positions].reset_index(drop=True)
+        vectorizer = _new_vectorizer()
+        tfidf_matrix = vectorizer.fit_transform(build_row_texts(rows))
+        return cls(rows, vectorizer, tfidf_matrix, row_positions)
+
+    def related_rows(self, processed_query, top_k=10, max_chars=None):
+        top_indices, _ = _top_indices(self.vectorizer, self.tfidf_matrix, processed_query, top_k)
+        return format_rows_markdown(self.df, top_indices, max_chars)
+
+
+class BM25RowIndex:
+    """整行检索的 BM25 后端：对全部行建倒排索引，接口与 RowIndex 相同。
+
+    行文本按批追加（add_texts），新增的倒排记录先暂存，首次查询时再并入倒排表。
+    倒排表以 词×行 的 CSR 矩阵保存，第 t 行即词 t 的倒排表（行号与词频）；
+    查询只访问查询词的倒排表，耗时取决于这些倒排表的长度，而不是总行数。
+    """
+
+    K1 = 1.5
+    B = 0.75
+    BATCH_SIZE = 10000
+
+    def __init__(self, df, row_positions, vocabulary=None, postings=None, doc_lengths=None):
+        self.df = df
+        self.row_positions = row_positions
+        self.vocabulary = {} if vocabulary is None else vocabulary
+        self.postings = postings
+        self.doc_lengths = np.empty(0, dtype=np.int64) if doc_lengths is None else doc_lengths
+        self._pending = []
+
+    @classmethod
+    def build(cls, df, row_positions=None):
+        if row_positions is None:
+            row_positions = np.arange(len(df))
+        rows = df.iloc[row_positions].reset_index(drop=True)
+        index = cls(rows, row_positions)
+        for start in range(0, len(rows), cls.BATCH_SIZE):
+            index.add_texts(build_row_texts(rows.iloc[start:start + cls.BATCH_SIZE]))
+        return index
+
+    def add_texts(self, texts):
+        """追加一批已分词的行文本，行号接在已有行之后"""
+        tokens = [_WORD_PATTERN.findall(text) for text in texts]
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        doc_ids = np.repeat(np.arange(len(self.doc_lengths), len(self.doc_lengths) + len(tokens)), lengths)
+        self.doc_lengths = np.concatenate([self.doc_lengths, lengths])
+        if len(doc_ids) == 0:
+            return
+        codes, terms = pd.factorize(np.array([token for doc in tokens for token in doc], dtype=object))
+        term_ids = np.array([self.vocabulary.setdefault(term, len(self.vocabulary)) for term in terms], dtype=np.int64)
+        self._pending.append((term_ids[codes], doc_ids))
+
+    def _merge_pending(self):
+        if not self._pending and self.postings is not None:
+            return
+        empty = np.empty(0, dtype=np.int64)
+        term_ids = [empty] + [terms for terms, _ in self._pending]
+        doc_ids = [empty] + [docs for _, docs in self._pending]
+        tfs = [np.ones(len(terms), dtype=np.float32) for terms in term_ids]
+        if self.postings is not None:
+            old = self.postings.tocoo()
+            term_ids.append(old.row)
+            doc_ids.append(old.col)
+            tfs.append(old.data)
+        # 同一 (词, 行) 的重复记录在构造时相加，即为词频
+        self.postings = csr_matrix(
+            (np.concatenate(tfs), (np.concatenate(term_ids), np.concatenate(doc_ids))),
+            shape=(len(self.vocabulary), len(self.doc_lengths))
+        )
+        self.postings.sort_indices()
+        self._pending = []
+
+    def score(self, processed_query):
+        """返回 (候选行号, BM25 得分)，候选行为至少包含一个查询词的行"""
+        self._merge_pending()
+        term_ids = {self.vocabulary[token] for token in _WORD_PATTERN.findall(processed_query) if token in self.vocabulary}
+        doc_count = len(self.doc_lengths)
+        if not term_ids or doc_count == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        average_length = max(self.doc_lengths.mean(), 1e-9)
+        candidates, contributions = [], []
+        indptr, indices, data = self.postings.indptr, self.postings.indices, self.postings.data
+        for term_id in term_ids:
+            docs = indices[indptr[term_id]:indptr[term_id + 1]]
+            tf = data[indptr[term_id]:indptr[term_id + 1]]
+            idf = np.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[docs] / average_length)
+            candidates.append(docs)
+            contributions.append(idf * tf * (self.K1 + 1) / (tf + norm))
+        rows, inverse = np.unique(np.concatenate(candidates), return_inverse=True)
+        return rows, np.bincount(inverse, weights=np.concatenate(contributions))
+
+    def top_rows(self, processed_query, top_k=10):
+        """得分从高到低、同分按行号从小到大取前 top_k 行；命中不足 top_k 行时按行号补足"""
+        rows, scores = self.score(processed_query)
+        top, _ = sparse_top_k(rows, scores, len(self.doc_lengths), top_k)
+        return top
+
+    def related_rows(self, processed_query, top_k=10, max_chars=None):
+        return format_rows_markdown(self.df, self.top_rows(processed_query, top_k), max_chars)
 
 
-def summarize_data(df: pd.DataFrame,ds,query) -> str:
+class RetrievalIndex:
+    """数据集级别的检索索引，在导入数据时构建一次，之后每次查询只需 transform 与相似度计算。
+
+    - 对唯一值多于 5 个的列，各建一个 ItemIndex（summarize_data 只对这些列做检索）；
+    - 对去重后的行抽样 row_sample_size 行建一个 RowIndex（去重后不超过 10 行时直接保留全部行）；
+      row_retriever 为 "bm25" 时改为对去重后的全部行建一个 BM25RowIndex。
+
+    行数不少于 approx_stats_min_rows 时（与 DatasetProfile 的近似统计一致）不再对全表做精确去重：
+    列的筛选用 BoundedDistinct 扫描（高基数列很快放弃），ItemIndex 只在 ITEM_SAMPLE_SIZE 行的随机样本上构建
+    （只出现在样本之外的取值检索不到），RowIndex 的行从随机抽取的行中去重得到。
+    """
+
+    def __init__(self, item_indexes, small_rows, row_index):
+        self.item_indexes = item_indexes
+        self.small_rows = small_rows
+        self.row_index = row_index
+
+    @classmethod
+    def build(cls, df: pd.DataFrame, row_sample_size: int = ROW_SAMPLE_SIZE, random_state=None, workers=None, retriever=None,
+              approximate=None):
+        """workers 为并行构建各列索引的进程数，retriever 为整行检索后端，未指定时分别使用设置项
+        summary_workers 与 row_retriever；approximate 为 None 时按行数自动选择（见类说明）。"""
+        if workers is None:
+            workers = summary_workers
+        if retriever is None:
+            retriever = row_retriever
+        if approximate is None:
+            approximate = 0 < approx_stats_min_rows <= len(df)
+        rng = np.random.default_rng(random_state)
+        if approximate:
+            item_columns = [col for col in df.columns if _has_many_values(df[col])]
+            item_positions = np.sort(rng.choice(len(df), size=min(ITEM_SAMPLE_SIZE, len(df)), replace=False))
+            item_df = df.iloc[item_positions].reset_index(drop=True)
+        else:
+            item_columns = [col for col in df.columns if len(df[col].unique()) > 5]
+            item_positions = None
+            item_df = df
+        encoded = encode_frame(item_df) if item_columns else None
+        item_indexes = None
+        if workers > 1 and len(item_columns) > 1:
+            try:
+                item_indexes = build_item_indexes_parallel(item_df, item_columns, encoded, workers)
+            except Exception as e:
+                print(f"[并行构建] 并行构建失败，改为串行构建: {e}")
+        if item_indexes is None:
+            item_indexes = {col: ItemIndex.build(item_df[col], item_df, encoded) for col in item_columns}
+        if item_positions is not None:
+            # 样本中的行位置换回原表中的位置，磁盘缓存按原表还原元素
+            for item_index in item_indexes.values():
+                item_index.item_rows = item_positions[item_index.item_rows]
+
+        unique_positions = None
+        if approximate and retriever != "bm25":
+            unique_positions = _sample_unique_positions(df, row_sample_size, rng)
+        if unique_positions is None:
+            # BM25 本就要处理每一行，精确去重的开销相对不大
+            unique_positions = np.flatnonzero(~df.duplicated().to_numpy())
+        if len(unique_positions) <= 10:
+            index = cls(item_indexes, df.iloc[unique_positions].reset_index(drop=True), None)
+        elif retriever == "bm25":
+            index = cls(item_indexes, None, BM25RowIndex.build(df, unique_positions))
+        else:
+            sample_positions = rng.choice(unique_positions, size=min(row_sample_size, len(unique_positions)), replace=False)
+            index = cls(item_indexes, None, RowIndex.build(df, sample_positions))
+        print(f"[分词缓存] {token_cache.stats()}")
+        return index
+
+    @classmethod
+    def load_or_build(cls, df: pd.DataFrame, source_path=None, row_sample_size: int = ROW_SAMPLE_SIZE):
+        """按源文件内容哈希查找磁盘缓存，命中则直接加载，否则构建并写入缓存。
+
+        source_path 为空或缓存被禁用（retrieval_cache_max_mb 为 0）时只在内存中构建。
+        """
+        if source_path is None or retrieval_cache_max_mb <= 0:
+            return cls.build(df, row_sample_size=row_sample_size)
+        try:
+            key = retrieval_cache_key(source_path, row_sample_size)
+        except OSError as e:
+            print(f"[检索缓存] 无法读取源文件计算哈希: {e}")
+            return cls.build(df, row_sample_size=row_sample_size)
+
+        entry_dir = os.path.join(get_retrieval_cache_dir(), key)
+        if os.path.isdir(entry_dir):
+            try:
+                index = _load_index(entry_dir, df)
+                # 更新访问时间，供 LRU 淘汰使用
+                os.utime(os.path.join(entry_dir, "meta.json"))
+                print(f"[检索缓存] 命中缓存: {entry_dir}")
+                return index
+            except Exception as e:
+                print(f"[检索缓存] 缓存读取失败，将重新构建: {e}")
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+        index = cls.build(df, row_sample_size=row_sample_size)
+        try:
+            _save_index(index, df, entry_dir)
+            evict_retrieval_cache(retrieval_cache_max_mb * 1024 * 1024)
+        except OSError as e:
+            print(f"[检索缓存] 写入缓存失败: {e}")
+        return index
+
+    def related_items(self, column, processed_query, top_k=10):
+        return self.item_indexes[column].related_items(processed_query, top_k=top_k)
+
+    def related_items_with_scores(self, column, processed_query, top_k=10):
+        return self.item_indexes[column].related_items_with_scores(processed_query, top_k=top_k)
+
+    def related_rows(self, processed_query, top_k=10, max_chars=None):
+        return self.row_index.related_rows(processed_query, top_k=top_k, max_chars=max_chars)
+
+
+def _has_many_values(series):
+    """列中（含缺失值）不同取值是否多于 5 个，分块扫描，高基数列通常只看开头一小段就能确定"""
+    distinct = BoundedDistinct(5)
+    values = series.to_numpy()
+    for start in range(0, len(values), SKETCH_CHUNK_SIZE):
+        distinct.update(values[start:start + SKETCH_CHUNK_SIZE])
+        if distinct.values is None:
+            return True
+    return False
+
+def _sample_unique_positions(df, row_sample_size, rng):
+    """随机抽取两倍于 row_sample_size 的行并在样本内去重，返回至多 row_sample_size 个互不重复的行位置；
+    样本内去重后不超过 10 行时（全表可能只有少数几种行）返回 None，由调用方对全表精确去重"""
+    candidates = rng.choice(len(df), size=min(2 * row_sample_size, len(df)), replace=False)
+    candidates = candidates[~df.iloc[candidates].duplicated().to_numpy()]
+    if len(candidates) <= 10:
+        return None
+    return candidates[:row_sample_size]
+
+def get_retrieval_cache_dir():
+    """检索索引的磁盘缓存目录，与 settings.json 同在 appdirs 用户配置目录下"""
+    return os.path.join(appdirs.user_config_dir(APP_NAME, APP_AUTHOR), "retrieval_cache")
+
+def retrieval_cache_key(source_path, row_sample_size=ROW_SAMPLE_SIZE):
+    """缓存键：源文件内容的 sha256 + 索引设置（设置变化时自动失效）"""
+    digest = hashlib.sha256()
+    with open(source_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    settings = json.dumps({
+        'version': INDEX_CACHE_VERSION,
+        'tfidf': TFIDF_SETTINGS,
+        'row_sample_size': row_sample_size,
+        'row_retriever': row_retriever,
+        'approx_stats_min_rows': approx_stats_min_rows
+    }, sort_keys=True)
+    digest.update(settings.encode('utf-8'))
+    return digest.hexdigest()
+
+def _save_matrix(entry_dir, prefix, vectorizer, tfidf_matrix):
+    with open(os.path.join(entry_dir, f"{prefix}_vocab.json"), 'w', encoding='utf-8') as f:
+        json.dump({term: int(i) for term, i in vectorizer.vocabulary_.items()}, f, ensure_ascii=False)
+    np.save(os.path.join(entry_dir, f"{prefix}_idf.npy"), vectorizer.idf_)
+    np.save(os.path.join(entry_dir, f"{prefix}_data.npy"), tfidf_matrix.data)
+    np.save(os.path.join(entry_dir, f"{prefix}_indices.npy"), tfidf_matrix.indices)
+    np.save(os.path.join(entry_dir, f"{prefix}_indptr.npy"), tfidf_matrix.indptr)
+
+def _load_matrix(entry_dir, prefix, shape):
+    with open(os.path.join(entry_dir, f"{prefix}_vocab.json"), 'r', encoding='utf-8') as f:
+        vocabulary = json.load(f)
+    vectorizer = _new_vectorizer(vocabulary)
+    vectorizer.idf_ = np.load(os.path.join(entry_dir, f"{prefix}_idf.npy"))
+    # 稀疏矩阵的三个数组以内存映射方式加载，不把整个矩阵读入内存
+    tfidf_matrix = csr_matrix((
+        np.load(os.path.join(entry_dir, f"{prefix}_data.npy"), mmap_mode='r'),
+        np.load(os.path.join(entry_dir, f"{prefix}_indices.npy"), mmap_mode='r'),
+        np.load(os.path.join(entry_dir, f"{prefix}_indptr.npy"), mmap_mode='r')
+    ), shape=tuple(shape))
+    return vectorizer, tfidf_matrix
+
+def _save_postings(entry_dir, bm25_index):
+    bm25_index._merge_pending()
+    with open(os.path.join(entry_dir, "bm25_vocab.json"), 'w', encoding='utf-8') as f:
+        json.dump(bm25_index.vocabulary, f, ensure_ascii=False)
+    np.save(os.path.join(entry_dir, "bm25_lengths.npy"), bm25_index.doc_lengths)
+    np.save(os.path.join(entry_dir, "bm25_data.npy"), bm25_index.postings.data)
+    np.save(os.path.join(entry_dir, "bm25_indices.npy"), bm25_index.postings.indices)
+    np.save(os.path.join(entry_dir, "bm25_indptr.npy"), bm25_index.postings.indptr)
+
+def _load_postings(entry_dir, rows, row_positions, shape):
+    with open(os.path.join(entry_dir, "bm25_vocab.json"), 'r', encoding='utf-8') as f:
+        vocabulary = json.load(f)
+    postings = csr_matrix((
+        np.load(os.path.join(entry_dir, "bm25_data.npy"), mmap_mode='r'),
+        np.load(os.path.join(entry_dir, "bm25_indices.npy"), mmap_mode='r'),
+        np.load(os.path.join(entry_dir, "bm25_indptr.npy"), mmap_mode='r')
+    ), shape=tuple(shape))
+    doc_lengths = np.load(os.path.join(entry_dir, "bm25_lengths.npy"))
+    return BM25RowIndex(rows, row_positions, vocabulary, postings, doc_lengths)
+
+def _save_index(index, df, entry_dir):
+    """先写入临时目录再整体改名，避免留下写了一半的缓存"""
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        meta = {'version': INDEX_CACHE_VERSION, 'columns': [str(col) for col in df.columns], 'items': [], 'rows': None}
+        for i, (col, item_index) in enumerate(index.item_indexes.items()):
+            prefix = f"item{i}"
+            _save_matrix(tmp_dir, prefix, item_index.vectorizer, item_index.tfidf_matrix)
+            np.save(os.path.join(tmp_dir, f"{prefix}_rows.npy"), item_index.item_rows)
+            meta['items'].append({'column': df.columns.get_loc(col), 'shape': item_index.tfidf_matrix.shape})
+        if isinstance(index.row_index, BM25RowIndex):
+            _save_postings(tmp_dir, index.row_index)
+            np.save(os.path.join(tmp_dir, "rows_positions.npy"), index.row_index.row_positions)
+            meta['rows'] = {'retriever': 'bm25', 'shape': index.row_index.postings.shape}
+        elif index.row_index is not None:
+            _save_matrix(tmp_dir, "rows", index.row_index.vectorizer, index.row_index.tfidf_matrix)
+            np.save(os.path.join(tmp_dir, "rows_positions.npy"), index.row_index.row_positions)
+            meta['rows'] = {'retriever': 'tfidf', 'shape': index.row_index.tfidf_matrix.shape}
+        with open(os.path.join(tmp_dir, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_dir, entry_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _load_index(entry_dir, df):
+    with open(os.path.join(entry_dir, "meta.json"), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta['version'] != INDEX_CACHE_VERSION or meta['columns'] != [str(col) for col in df.columns]:
+        raise ValueError("缓存与当前数据的列不一致")
+    item_indexes = {}
+    for i, item_meta in enumerate(meta['items']):
+        prefix = f"item{i}"
+        vectorizer, tfidf_matrix = _load_matrix(entry_dir, prefix, item_meta['shape'])
+        item_rows = np.load(os.path.join(entry_dir, f"{prefix}_rows.npy"))
+        series = df.iloc[:, item_meta['column']]
+        item_indexes[df.columns[item_meta['column']]] = ItemIndex(series.iloc[item_rows].tolist(), vectorizer, tfidf_matrix, item_rows)
+    if meta['rows'] is None:
+        unique_positions = np.flatnonzero(~df.duplicated().to_numpy())
+        return RetrievalIndex(item_indexes, df.iloc[unique_positions].reset_index(drop=True), None)
+    row_positions = np.load(os.path.join(entry_dir, "rows_positions.npy"))
+    rows = df.iloc[row_positions].reset_index(drop=True)
+    if meta['rows'].get('retriever') == 'bm25':
+        row_index = _load_postings(entry_dir, rows, row_positions, meta['rows']['shape'])
+    else:
+        vectorizer, tfidf_matrix = _load_matrix(entry_dir, "rows", meta['rows']['shape'])
+        row_index = RowIndex(rows, vectorizer, tfidf_matrix, row_positions)
+    return RetrievalIndex(item_indexes, None, row_index)
+
+def evict_retrieval_cache(max_bytes):
+    """按最近访问时间（meta.json 的修改时间）淘汰最久未用的缓存，直到总大小不超过 max_bytes"""
+    cache_dir = get_retrieval_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        meta_path = os.path.join(entry_dir, "meta.json")
+        if not os.path.isfile(meta_path):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+        entries.append((os.path.getmtime(meta_path), size, entry_dir))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        print(f"[检索缓存] 已淘汰: {entry_dir}")
+
+
+def find_related_data(query, column_data, df, top_k=10):
+    """使用改进的TF-IDF方法进行相关数据检索（单次使用；多次查询请使用 RetrievalIndex）"""
+    return ItemIndex.build(column_data, df).related_items(preprocess_text(query), top_k=top_k)
+
+def find_related_rows(query: str, df: pd.DataFrame, top_k: int = 10) -> list[str]:
+    """检索与查询最相关的行，返回 markdown 表格行（单次使用；多次查询请使用 RetrievalIndex）。
+
+    检索后端由设置项 row_retriever 决定。
+    """
+    row_index_class = BM25RowIndex if row_retriever == "bm25" else RowIndex
+    return row_index_class.build(df).related_rows(preprocess_text(query), top_k=top_k)
+
+
+def describe_column(series):
+    """生成单列与查询无关的描述（类型与统计信息），返回接在 "-'列名'一列的" 之后的文本"""
+    s = ""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        try:
+            date_min, date_max, date_median = series.min(), series.max(), series.median()
+            s += f"类型为日期。日期范围从 {date_min} 到 {date_max}，中位日期为 {date_median}。"
+        except Exception:
+            s += "日期数据无法计算统计信息。"
+    elif pd.api.types.is_numeric_dtype(series):
+        if series.dropna().between(0, 1).all() and series.max() <= 1:
+            s += "类型为百分比数值。"
+        else:
+            s += "类型为数值变量。"
+            try:
+                s += f"取值范围为 {series.min()} 到 {series.max()}，均值为 {series.mean():.2f}，中位数为 {series.median()}。"
+            except Exception:
+                s += "数值数据无法计算统计信息。"
+    elif pd.api.types.is_object_dtype(series):
+        unique_count = series.nunique(dropna=True)
+        if unique_count < 10:
+            try:
+                categories = series.dropna().unique()
+                s += "类型为分类变量，包含类别: " + ", ".join(map(str, categories)) + "等等。"
+            except Exception:
+                s += "分类信息无法提取。"
+        else:
+            s += "类型为文本数据。"
+    else:
+        s += "数据类型未识别。"
+    return s
+
+
+class ColumnSketch:
+    """单列的近似统计：分块扫描一次，同时更新不同取值计数、分位数、随机示例以及少量取值的精确集合"""
+
+    def __init__(self, series, chunk_size=SKETCH_CHUNK_SIZE, random_state=0):
+        self.distinct = HyperLogLog()
+        # 含缺失值，最多记录 10 个：够判断 unique() 不超过 5 个、以及非空取值少于 10 个
+        self.small_values = BoundedDistinct(10)
+        self.examples = ReservoirSample(5, random_state)
+        self.quantiles = None
+        present = series.dropna()
+        if pd.api.types.is_datetime64_any_dtype(series):
+            self.quantiles = KLLSketch(random_state=random_state)
+            quantile_values = pd.DatetimeIndex(present).asi8
+        elif pd.api.types.is_numeric_dtype(series):
+            self.quantiles = KLLSketch(random_state=random_state)
+            quantile_values = present.to_numpy(dtype=np.float64)
+
+        values = series.to_numpy()
+        present_values = present.to_numpy()
+        for start in range(0, len(values), chunk_size):
+            self.small_values.update(values[start:start + chunk_size])
+        for start in range(0, len(present_values), chunk_size):
+            chunk = present_values[start:start + chunk_size]
+            self.distinct.update(chunk)
+            self.examples.update(chunk)
+            if self.quantiles is not None:
+                self.quantiles.update(quantile_values[start:start + chunk_size])
+
+
+def describe_column_approx(series, sketch):
+    """describe_column 的近似版本。
+
+    min/max/mean 只需一次扫描，仍精确计算；中位数、不同取值个数来自概要数据结构，
+    文本中以"约……（近似）"标明。
+    """
+    s = ""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        try:
+            date_median = pd.Timestamp(int(sketch.quantiles.quantile(0.5)), tz=series.dt.tz)
+            s += f"类型为日期。日期范围从 {series.min()} 到 {series.max()}，中位日期约为 {date_median}（近似）。"
+        except Exception:
+            s += "日期数据无法计算统计信息。"
+    elif pd.api.types.is_numeric_dtype(series):
+        if series.min() >= 0 and series.max() <= 1:
+            s += "类型为百分比数值。"
+        else:
+            s += "类型为数值变量。"
+            try:
+                s += f"取值范围为 {series.min()} 到 {series.max()}，均值为 {series.mean():.2f}，中位数约为 {sketch.quantiles.quantile(0.5)}（近似）。"
+            except Exception:
+                s += "数值数据无法计算统计信息。"
+    elif pd.api.types.is_object_dtype(series):
+        small_values = sketch.small_values.values
+        categories = None if small_values is None else [v for v in small_values if not pd.isna(v)]
+        if categories is not None and len(categories) < 10:
+            s += "类型为分类变量，包含类别: " + ", ".join(map(str, categories)) + "等等。"
+        else:
+            s += f"类型为文本数据，约有 {sketch.distinct.count()} 个不同取值（近似），随机示例: " + ", ".join(map(str, sketch.examples.items)) + "。"
+    else:
+        s += "数据类型未识别。"
+    return s
+
+
+class DatasetProfile:
+    """数据集的列画像：每列的类型判断与 min/max/mean/median/nunique 等统计只依赖数据本身，
+    在导入数据时计算一次，之后每次生成概述时直接复用，只有检索相关样本的部分随查询重新计算。"""
+
+    def __init__(self, df: pd.DataFrame, approximate=None):
+        """approximate 为 None 时按行数自动选择：不少于 approx_stats_min_rows 行时使用近似统计。"""
+        if approximate is None:
+            approximate = 0 < approx_stats_min_rows <= len(df)
+        self.approximate = approximate
+        self.columns = list(df.columns)
+        self.row_count = len(df)
+        self.descriptions = {}
+        # 唯一值不超过 5 个的列直接展示全部取值，其余列为 None（需按查询检索）
+        self.small_values = {}
+        for col in df.columns:
+            series = df[col]
+            if approximate:
+                sketch = ColumnSketch(series)
+                self.descriptions[col] = describe_column_approx(series, sketch)
+                unique_values = sketch.small_values.values
+            else:
+                self.descriptions[col] = describe_column(series)
+                unique_values = series.unique()
+            self.small_values[col] = unique_values if unique_values is not None and len(unique_values) <= 5 else None
+
+
+# 超出 token 预算时依次尝试的压缩档位：(行样本数, 每列展示的取值个数, 单个取值与列描述的最大字符数)
+SUMMARY_COMPACT_LEVELS = [
+    (10, 5, None),
+    (5, 3, 60),
+    (3, 2, 30),
+]
+_CHINESE_COUNTS = {10: "十", 5: "五", 3: "三"}
+
+def _rank_columns(profile, retrieval_index, processed_query):
+    """为每列取展示的取值并给出与查询的相关性得分，返回 ({列名: 取值列表}, 按相关性从高到低排列的列名)。
+
+    相关性 = 列名是否包含查询词（命中记 1 分）+ 展示的取值是否包含查询词（命中记 1 分）+ 该列最相关元素的相似度。
+    元素的特征文档包含同一行其他列的取值，相似度在各列之间区分度不高，因此只作为同分时的参考。
+    """
+    query_terms = set(_WORD_PATTERN.findall(processed_query))
+
+    def mentioned(values):
+        return any(query_terms & set(_WORD_PATTERN.findall(preprocess_text(str(value)))) for value in values)
+
+    samples = {}
+    scores = {}
+    for position, col in enumerate(profile.columns):
+        sample_data = profile.small_values[col]
+        score = 0.0
+        if sample_data is None:
+            scored = retrieval_index.related_items_with_scores(col, processed_query, top_k=5)
+            sample_data = [item for item, _ in scored]
+            score = max((item_score for _, item_score in scored), default=0.0)
+        score += mentioned([col]) + mentioned(sample_data)
+        samples[col] = sample_data
+        scores[col] = (-score, position)
+    return samples, sorted(profile.columns, key=scores.get)
+
+def _render_summary(ds, profile, samples, row_lines, rows_k, shown_columns, max_values, max_chars, listed_names=None):
+    """按给定的压缩档位拼出概述文本。
+
+    shown_columns 为展开描述的列（其余列只出现在列名列表中）；listed_names 不为 None 时列名列表也只列出这些列；
+    row_lines 为 None 时省略行样本部分。
+    """
+    lines = []
+    lines.append(ds)
+    columns_count = len(profile.columns)
+    names = profile.columns if listed_names is None else listed_names
+    names_text = ", ".join(map(str, names)) + ("." if listed_names is None else f"等（共 {columns_count} 列）.")
+    lines.append(f"    由于数据集较大，以下只展示该数据集的结构和部分内容以供你理解。\n        -该数据集共有 {columns_count} 列，所有列名包括：" + names_text)
+    if profile.approximate:
+        lines.append("        -注意：该数据集行数较多，以下标注“约”或“近似”的统计信息（中位数、不同取值个数等）为基于抽样与概率算法的近似值，并非精确结果。")
+    for col in profile.columns:
+        if col not in shown_columns:
+            continue
+        s = f"        -'{col}'一列的" + clip_text(profile.descriptions[col], max_chars)
+        sample_data = samples[col]
+        values = [clip_text(value, max_chars) for value in list(sample_data)[:max_values]]
+        s += f"该列中{'包含的' if len(sample_data) <= 5 else '五条相关'}数据：{', '.join(values)}等等。"
+        lines.append(s)
+    omitted = columns_count - len(shown_columns)
+    if omitted:
+        lines.append(f"        -另有 {omitted} 列与当前问题相关性较低，因篇幅限制未展开描述。")
+    if row_lines is None:
+        lines.append(f"    该数据集共有 {profile.row_count} 行数据，因篇幅限制不展示数据样本。")
+        return "\n".join(lines)
+    lines.append(f"    仅靠以上对每一列的描述信息可能无法较为全面地展示该数据集的整体信息，以下我们再整体性地扫描一下该数据集。该数据集共有 {profile.row_count} 行数据，其中{_CHINESE_COUNTS[rows_k]}行最相关数据样本如下：")
+    sample_text = "\n    ".join(["".join(map(str, row)) for row in row_lines])
+    lines.append(f"{sample_text}\n    以上示例数据中，|为分列符，换行符为分行符，也即第i个元素与第i+k*{columns_count}（k为整数）个元素为一列")
+    return "\n".join(lines)
+
+def summarize_data(df: pd.DataFrame,ds,query, retrieval_index: RetrievalIndex = None, profile: DatasetProfile = None, token_budget: int = None) -> str:
     """生成一个关于输入 DataFrame 的概述性文字说明。
     说明内容包括：
     1. 该数据集的用途（每行数据代表一条记录，例如销售记录中的每台车数据）。
@@ -135,59 +1009,71 @@ def summarize_data(df: pd.DataFrame,ds,query) -> str:
        - 对象类型：若唯一值较少（< 10）视为分类变量，列出类别；否则视为文本，不进行统计。
     4. 总行数。
     5. 每列随机抽取5条数据进行展示。
+
+    retrieval_index 为该 df 预先构建的 RetrievalIndex；未提供时临时构建一个（TF-IDF 后端仅抽样 200 行，BM25 后端覆盖全部行）。
+    profile 为该 df 预先计算的 DatasetProfile；未提供时临时计算。
+    token_budget 为概述的 token 上限（按 token_budget.estimate_tokens 估算），未指定时使用设置项
+    summary_token_budget，0 表示不限制。超出时依次减少行样本、截断取值列表与过长的取值，
+    再按与查询的相关性从低到高收起各列的详细描述，最后只列出最相关的列名。
     """
-    lines = []
-    data_description = ds
-    lines.append(data_description)
-    columns_count = len(df.columns)
-    lines.append(f"    由于数据集较大，以下只展示该数据集的结构和部分内容以供你理解。\n        -该数据集共有 {columns_count} 列，所有列名包括：" + ", ".join(df.columns) + ".")
-    for col in df.columns:
-        series = df[col]
-        s = f"        -'{col}'一列的"
-        if pd.api.types.is_datetime64_any_dtype(series):
-            try:
-                date_min, date_max, date_median = series.min(), series.max(), series.median()
-                s += f"类型为日期。日期范围从 {date_min} 到 {date_max}，中位日期为 {date_median}。"
-            except Exception:
-                s += "日期数据无法计算统计信息。"
-        elif pd.api.types.is_numeric_dtype(series):
-            if series.dropna().between(0, 1).all() and series.max() <= 1:
-                s += "类型为百分比数值。"
-            else:
-                s += "类型为数值变量。"
-                try:
-                    s += f"取值范围为 {series.min()} 到 {series.max()}，均值为 {series.mean():.2f}，中位数为 {series.median()}。"
-                except Exception:
-                    s += "数值数据无法计算统计信息。"
-        elif pd.api.types.is_object_dtype(series):
-            unique_count = series.nunique(dropna=True)
-            if unique_count < 10:
-                try:
-                    categories = series.dropna().unique()
-                    s += "类型为分类变量，包含类别: " + ", ".join(map(str, categories)) + "等等。"
-                except Exception:
-                    s += "分类信息无法提取。"
+    if retrieval_index is None:
+        retrieval_index = RetrievalIndex.build(df, row_sample_size=200)
+    if profile is None:
+        profile = DatasetProfile(df)
+    if token_budget is None:
+        token_budget = summary_token_budget
+    processed_query = preprocess_text(query)
+    samples, ranked_columns = _rank_columns(profile, retrieval_index, processed_query)
+
+    def row_lines(top_k, max_chars):
+        if retrieval_index.row_index is None:
+            return retrieval_index.small_rows
+        return retrieval_index.related_rows(processed_query, top_k=top_k, max_chars=max_chars)
+
+    def render(level, shown_count=len(ranked_columns), listed_count=None, with_rows=True):
+        rows_k, max_values, max_chars = SUMMARY_COMPACT_LEVELS[level]
+        listed_names = None if listed_count is None else [col for col in profile.columns if col in set(ranked_columns[:listed_count])]
+        rows = row_lines(rows_k, max_chars) if with_rows else None
+        return _render_summary(ds, profile, samples, rows, rows_k, set(ranked_columns[:shown_count]),
+                               max_values, max_chars, listed_names)
+
+    def fits(text):
+        return estimate_tokens(text) <= token_budget
+
+    def largest_fitting(make_text, upper):
+        """二分查找使 make_text(n) 不超出预算的最大 n（0 <= n <= upper），均不满足时返回 0"""
+        low, high = 0, upper
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(make_text(middle)):
+                low = middle
             else:
-                s += "类型为文本数据。"
-        else:
-            s += "数据类型未识别。"
-        unique_values = series.unique()
-        if len(unique_values) <= 5:
-            sample_data = unique_values
-        else:
-            sample_data = find_related_data(query, series, df, top_k=5)
-        s += f"该列中{'包含的' if len(sample_data) <= 5 else '五条相关'}数据：{', '.join(map(str, sample_data))}等等。"
-        lines.append(s)
-    lines.append(f"    仅靠以上对每一列的描述信息可能无法较为全面地展示该数据集的整体信息，以下我们再整体性地扫描一下该数据集。该数据集共有 {len(df)} 行数据，其中十行最相关数据样本如下：")
-    unique_rows = df.drop_duplicates().reset_index(drop=True)
-    if len(unique_rows) <= 10:
-        sample_data = unique_rows
-    else:
-        sample_data = unique_rows.sample(n=min(200, len(unique_rows)), replace=False).reset_index(drop=True)
+                high = middle - 1
+        return low
 
-        sample_data = find_related_rows(query, sample_data, top_k=10)
-    sample_text = "\n    ".join(["".join(map(str, row)) for row in sample_data])
-    lines.append(f"{sample_text}\n    以上示例数据中，|为分列符，换行符为分行符，也即第i个元素与第i+k*{len(df.columns)}（k为整数）个元素为一列")
-    return "\n".join(lines)
+    summary = render(0)
+    if token_budget <= 0 or fits(summary):
+        return summary
+    full_tokens = estimate_tokens(summary)
 
+    last = len(SUMMARY_COMPACT_LEVELS) - 1
+    for level in range(1, len(SUMMARY_COMPACT_LEVELS)):
+        summary = render(level)
+        if fits(summary):
+            break
+    else:
+        # 仍超出预算：按相关性从低到高收起列的详细描述
+        shown_count = largest_fitting(lambda n: render(last, n), len(ranked_columns))
+        summary = render(last, shown_count)
+        if not fits(summary):
+            # 宽表的行样本本身就很长：去掉行样本，优先保留列的描述
+            shown_count = largest_fitting(lambda n: render(last, n, with_rows=False), len(ranked_columns))
+            summary = render(last, shown_count, with_rows=False)
+        if not fits(summary):
+            # 极宽的表：连列名列表也只保留最相关的部分
+            listed_count = largest_fitting(lambda n: render(last, 0, n, with_rows=False), len(ranked_columns))
+            summary = render(last, 0, max(listed_count, 1), with_rows=False)
 
+    final_tokens = estimate_tokens(summary)
+    print(f"[概述预算] 预算 {token_budget} tokens，完整概述约 {full_tokens} tokens，压缩后约 {final_tokens} tokens，节省约 {full_tokens - final_tokens} tokens")
+    return summary
@@ -16,6 +16,7 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from PyQt5.QtGui import QMovie
 import json
 import appdirs
+import multiprocessing
 from qfluentwidgets import ( SegmentedWidget, PipsPager, PipsScrollButtonDisplayMode,InfoBar, InfoBarManager)
 
 # --- 配置应用程序信息 ---
@@ -26,6 +27,7 @@ APP_AUTHOR = "xiezhenyuan"
 KEY_MODEL = "model"
 KEY_BASE_URL = "base_url"
 KEY_API_KEY = "api_key"
+KEY_METRICS_PANEL = "metrics_panel"
 # 添加其他设置的键名...
 
 # --- 初始空设置 (当配置文件不存在时创建) ---
@@ -133,27 +135,52 @@ print(f"[应用] API Key: {api_key if api_key else '未设置'}") # 不直接显
 
 
 
-from my_workflow import Workflow, WorkflowThread, AdjustmentWorkflow, AdjustmentThread, DrawWorkflow , DrawThread, DrawAdjustmentThread, DrawAdjustmentWorkflow
+from my_workflow import Workflow, WorkflowThread, AdjustmentWorkflow, AdjustmentThread, DrawWorkflow , DrawThread, DrawAdjustmentThread, DrawAdjustmentWorkflow, clean_column_names, prepare_import
+from createAgentsOPENAI import parse_bool
 # 全局工作流实例
-global workflow_thread
-workflow_instance = Workflow()
-workflow_thread = WorkflowThread(workflow_instance)
-workflow_thread.start()
+# 并行构建检索索引时子进程会重新导入本模块，子进程中不启动工作流线程
+if multiprocessing.parent_process() is None:
+    global workflow_thread
+    workflow_instance = Workflow()
+    workflow_thread = WorkflowThread(workflow_instance)
+    workflow_thread.start()
+
+    global adjustment_workflow_thread
+    adjustment_workflow_instance = AdjustmentWorkflow()
+    adjustment_workflow_thread = AdjustmentThread(adjustment_workflow_instance)
+    adjustment_workflow_thread.start()
+
+    global draw_workflow_thread
+    draw_workflow_instance = DrawWorkflow()
+    draw_workflow_thread = DrawThread(draw_workflow_instance)
+    draw_workflow_thread.start()
 
-global adjustment_workflow_thread
-adjustment_workflow_instance = AdjustmentWorkflow()
-adjustment_workflow_thread = AdjustmentThread(adjustment_workflow_instance)
-adjustment_workflow_thread.start()
+    global draw_adjustment_workflow_thread
+    draw_adjustment_workflow_instance = DrawAdjustmentWorkflow()
+    draw_adjustment_workflow_thread = DrawAdjustmentThread(draw_adjustment_workflow_instance)
+    draw_adjustment_workflow_thread.start()
 
-global draw_workflow_thread
-draw_workflow_instance = DrawWorkflow()
-draw_workflow_thread = DrawThread(draw_workflow_instance)
-draw_workflow_thread.start()
 
-global draw_adjustment_workflow_thread
-draw_adjustment_workflow_instance = DrawAdjustmentWorkflow()
-draw_adjustment_workflow_thread = DrawAdjustmentThread(draw_adjustment_workflow_instance)
-draw_adjustment_workflow_thread.start()
+class DataImportWorker(QObject):
+    """在后台线程中构建检索索引与列画像（大表需要较长时间），结果由界面线程交给各工作流"""
+    finished = pyqtSignal()
+    success = pyqtSignal(int, object, object)  # (导入序号, 检索索引, 列画像)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, generation, df, source_path):
+        super().__init__()
+        self.generation = generation
+        self.df = df
+        self.source_path = source_path
+
+    def run(self):
+        try:
+            retrieval_index, data_profile = prepare_import(self.df, self.source_path)
+            self.success.emit(self.generation, retrieval_index, data_profile)
+        except Exception as e:
+            self.failed.emit(self.generation, str(e))
+        finally:
+            self.finished.emit()
 
 
 # 在ChatPanel类定义前添加APIWorker类定义
@@ -1166,9 +1193,88 @@ class ChatPanel(QWidget):
         # 使用绝对定位放置配置按钮
         self.config_button.setParent(self.content)  # 确保父组件正确
         self.config_button.move(590, 245) 
+
+        # 调用指标面板按钮（设置 metrics_panel 为 true 时显示）
+        if parse_bool(current_config.get(KEY_METRICS_PANEL, False)):
+            self.metrics_button = QPushButton("📊")
+            self.metrics_button.setFixedWidth(44)
+            self.metrics_button.setFixedHeight(int(initial_height))
+            self.metrics_button.setStyleSheet(self.config_button.styleSheet())
+            self.metrics_button.setToolTip("调用指标")
+            self.metrics_button.clicked.connect(self.show_metrics_dialog)
+            self.metrics_button.setParent(self.content)
+            self.metrics_button.move(540, 245)
     
     
         
+    def show_metrics_dialog(self):
+        """显示调用指标面板：按工作流状态与智能体汇总的首字延迟、生成速度、耗时等，每 2 秒刷新"""
+        import createAgentsOPENAI
+
+        dialog = QDialog(self.parent())
+        dialog.setWindowTitle("调用指标")
+        dialog.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)  # 关闭时一并停止刷新
+        dialog.resize(1000, 420)
+        layout = QVBoxLayout(dialog)
+
+        headers = ["工作流状态", "智能体 / 步骤", "次数", "重试", "失败", "平均提示 tokens",
+                   "平均首字 s", "平均生成 tokens/s", "平均耗时 s", "总耗时 s"]
+        table = QTableWidget(0, len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        table.verticalHeader().setVisible(False)
+        table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        layout.addWidget(table)
+
+        def cell(value, digits=2):
+            if value is None:
+                return "-"
+            return f"{value:.{digits}f}" if isinstance(value, float) else str(value)
+
+        def refresh():
+            stats = createAgentsOPENAI.call_metrics.stats()
+            rows = []
+            for key, entry in stats['calls'].items():
+                stage, agent = key.split(" | ", 1)
+                rows.append([stage, agent, entry['calls'], entry['retries'],
+                             entry['parse_errors'] + entry['request_errors'],
+                             cell(entry['avg_prompt_tokens'], 0), cell(entry['avg_ttft']),
+                             cell(entry['avg_tokens_per_second'], 1), cell(entry['avg_latency']),
+                             cell(entry['total_latency'])])
+            for key, entry in stats['steps'].items():
+                stage, name = key.split(" | ", 1)
+                rows.append([stage, name, entry['calls'], "-", entry['failures'], "-", "-", "-",
+                             cell(entry['avg_seconds']), cell(entry['total_seconds'])])
+            table.setRowCount(len(rows))
+            for row, values in enumerate(rows):
+                for column, value in enumerate(values):
+                    table.setItem(row, column, QTableWidgetItem(str(value)))
+
+        def export():
+            file_path, _ = QFileDialog.getSaveFileName(dialog, "导出调用指标", "", "JSON Lines (*.jsonl);;All Files (*)")
+            if file_path:
+                try:
+                    count = createAgentsOPENAI.call_metrics.export(file_path)
+                    print(f"[调用指标] 已导出 {count} 条记录到 {file_path}")
+                except OSError as e:
+                    QMessageBox.warning(dialog, "导出失败", str(e))
+
+        button_layout = QHBoxLayout()
+        button_layout.addStretch(1)
+        export_button = QPushButton("导出 JSONL")
+        export_button.clicked.connect(export)
+        close_button = QPushButton("关闭")
+        close_button.clicked.connect(dialog.close)
+        button_layout.addWidget(export_button)
+        button_layout.addWidget(close_button)
+        layout.addLayout(button_layout)
+
+        timer = QTimer(dialog)
+        timer.timeout.connect(refresh)
+        timer.start(2000)
+        refresh()
+        dialog.show()
+
     def show_api_config_dialog(self):
         """显示API配置对话框"""
         dialog = QDialog(self.parent())
@@ -1550,13 +1656,19 @@ class ChatPanel(QWidget):
                         current_base_url = base_url_input.text().strip()
                         current_api_key = api_key_input.text().strip()
 
-                        # 2. 创建包含这些值的字典
-                        settings_to_save = {
+                        # 2. 在已有设置的基础上更新这些值（保留缓存容量等其他高级设置项）
+                        settings_to_save = {}
+                        try:
+                            with open(get_user_config_path(), 'r', encoding='utf-8') as f:
+                                settings_to_save = json.load(f)
+                        except (OSError, json.JSONDecodeError):
+                            pass
+                        settings_to_save.update({
                             KEY_MODEL: current_model,
                             KEY_BASE_URL: current_base_url,
                             KEY_API_KEY: current_api_key
                             # 如果有其他设置项，也加入这里
-                        }
+                        })
 
                         # 3. 调用保存函数 (假设 save_settings 函数已定义好)
                         save_successful = save_settings(settings_to_save)
@@ -2051,8 +2163,15 @@ class MessageItem(QWidget):
 
 
 class ExcelPreviewPanel(QWidget):
+    # 后台导入完成（是否成功），完成后才允许对话
+    data_imported = pyqtSignal(bool)
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        # 每次上传递增；后台导入完成时序号已过期（期间又上传了新文件）则丢弃结果
+        self.import_generation = 0
+        self.import_df = None
+        self.import_jobs = []
 
         self.setFixedSize(700, 400)
         self.setAttribute(Qt.WidgetAttribute.WA_TranslucentBackground)
@@ -2254,9 +2373,9 @@ class ExcelPreviewPanel(QWidget):
     
     def load_excel(self, file_path):
         try:
-            df = pd.read_excel(file_path)
-            workflow_instance.import_data(df)  # 直接使用全局实例
-            adjustment_workflow_instance.import_data(df)
+            # 先在界面线程中清理列名，后台线程与下面的预览只读取 df
+            df = clean_column_names(pd.read_excel(file_path))
+            self.start_import(df, file_path)  # 检索索引与列画像在后台线程中构建（或从磁盘缓存加载）
             
             # 设置表格的行数和列数
             self.table.setRowCount(min(len(df), 100))  # 最多显示100行
@@ -2301,6 +2420,40 @@ class ExcelPreviewPanel(QWidget):
         except Exception as e:
             print(f"Error loading Excel file: {str(e)}")
             # 可以在这里添加错误提示UI
+            self.import_generation += 1
+            self.data_imported.emit(False)
+
+    def start_import(self, df, file_path):
+        """在后台线程中为取数与微调工作流准备检索索引与列画像，完成前禁用直接微调按钮"""
+        self.import_generation += 1
+        self.import_df = df
+        self.quick_action_button.setEnabled(False)
+        # 保留线程与 worker 的引用直到线程结束，避免运行中被回收
+        self.import_jobs = [(thread, worker) for thread, worker in self.import_jobs if thread.isRunning()]
+        thread = QThread()
+        worker = DataImportWorker(self.import_generation, df, file_path)
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        worker.finished.connect(thread.quit)
+        worker.success.connect(self.finish_import)
+        worker.failed.connect(self.fail_import)
+        self.import_jobs.append((thread, worker))
+        thread.start()
+
+    def finish_import(self, generation, retrieval_index, data_profile):
+        if generation != self.import_generation:
+            return
+        df = self.import_df
+        workflow_instance.import_data(df, retrieval_index, data_profile=data_profile)
+        adjustment_workflow_instance.import_data(df, retrieval_index, data_profile=data_profile)  # 复用同一份检索索引与列画像
+        self.quick_action_button.setEnabled(True)
+        self.data_imported.emit(True)
+
+    def fail_import(self, generation, error):
+        if generation != self.import_generation:
+            return
+        print(f"数据导入失败: {error}")
+        self.data_imported.emit(False)
 
     def show_with_animation(self):
         # 设置起始位置（在屏幕右侧外）
@@ -3635,6 +3788,7 @@ class MainWindow(QMainWindow):
         self.upload_panel = UploadPanel(self)
         self.chat_panel = ChatPanel(self)
         self.chart_panel = ChartPanel(self)
+        self.excel_preview.data_imported.connect(self.on_data_imported)
         
         # 设置面板位置
         self.upload_panel.move(710, 0)    # 上传面板
@@ -3721,6 +3875,9 @@ class MainWindow(QMainWindow):
             
         # 处理新文件
         try:
+            # 检索索引在后台构建，完成后（on_data_imported）才允许输入；读取失败时由 on_data_imported 改为失败提示
+            self.chat_panel.upload_label.setText("正在分析数据，请稍候...")
+            self.chat_panel.chat_input.setEnabled(False)
             # 加载Excel预览
             self.excel_preview.load_excel(file_name)
             self.excel_preview.show_with_animation()
@@ -3734,8 +3891,6 @@ class MainWindow(QMainWindow):
             self.upload_panel.hint_label.show()
             
             # 更新对话面板
-            self.chat_panel.upload_label.setText("为AI能更好地理解您的需求，您需要先介绍一下该excel的内容")
-            self.chat_panel.chat_input.setEnabled(True)
             self.chat_panel.chat_input.setPlaceholderText("例如：该数据集是......包含了......每一行数据是......")
             self.chat_panel.chat_input.setStyleSheet("""
                 QTextEdit {
@@ -3779,6 +3934,15 @@ class MainWindow(QMainWindow):
         except Exception as e:
             print(f"文件处理错误: {e}")
 
+    def on_data_imported(self, success):
+        """后台导入完成：成功时允许输入，失败时提示重新上传"""
+        if success:
+            self.chat_panel.upload_label.setText("为AI能更好地理解您的需求，您需要先介绍一下该excel的内容")
+            self.chat_panel.chat_input.setEnabled(True)
+        else:
+            self.chat_panel.upload_label.setText("数据导入失败，请重新上传")
+            self.chat_panel.chat_input.setEnabled(False)
+
 class App:
     def __init__(self):
         # 设置环境变量来调整DPI缩放
@@ -3798,6 +3962,7 @@ class App:
         return self.app.exec()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = App()
     sys.exit(app.run())
 
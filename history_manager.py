@@ -0,0 +1,94 @@
+"""客服对话历史的滚动压缩，控制每轮重复发送给客服与任务梳理智能体的历史长度。
+
+原始历史（agent.history）保持不变，工作流仍可直接追加或回退；只有写入提示词的视图经过压缩：
+- 最近若干条消息原样保留；
+- 更早的消息去掉代码块、表格等围栏内容（替换为一句引用说明），再截断为摘要，摘要按内容缓存；
+- 总长度超过 token 上限时，依次丢弃最早的消息、压缩最近的消息、截断最后一条，保证不超过上限。
+"""
+import re
+from collections import OrderedDict
+
+from token_budget import estimate_tokens, clip_text
+
+# ``` 围栏包裹的内容：代码、表格样例等
+_FENCED_BLOCK = re.compile(r'```([^\n`]*)\n(.*?)(?:```|$)', re.DOTALL)
+
+
+def _describe_block(match):
+    kind = match.group(1).strip() or "内容"
+    lines = match.group(2).strip('\n').count('\n') + 1
+    return f"[{kind}，{lines} 行，已省略]"
+
+
+def strip_payloads(text):
+    """把围栏包裹的代码与表格替换为引用说明"""
+    return _FENCED_BLOCK.sub(_describe_block, text)
+
+
+_OMITTED_ROLE = "    （系统）"
+
+
+def _omitted_note(count):
+    return {'role': _OMITTED_ROLE, 'content': f"更早的 {count} 条对话已省略"}
+
+
+def message_tokens(message):
+    return estimate_tokens(f"{message['role']}: {message['content']}")
+
+
+class HistoryCompactor:
+    # 缓存的摘要条数上限（远大于客服保留的历史条数）
+    CACHE_SIZE = 256
+
+    def __init__(self, recent_messages=6, max_tokens=3000, summary_chars=200):
+        self.recent_messages = recent_messages
+        self.max_tokens = max_tokens
+        self.summary_chars = summary_chars
+        self._summaries = OrderedDict()
+
+    def summarize(self, message):
+        """较早消息的摘要：去掉围栏内容后截断，按 (角色, 内容) 缓存"""
+        key = (message['role'], message['content'])
+        summary = self._summaries.get(key)
+        if summary is None:
+            summary = clip_text(strip_payloads(message['content']), self.summary_chars)
+            self._summaries[key] = summary
+            if len(self._summaries) > self.CACHE_SIZE:
+                self._summaries.popitem(last=False)
+        else:
+            self._summaries.move_to_end(key)
+        return {'role': message['role'], 'content': summary}
+
+    def render(self, history):
+        """返回写入提示词的历史（新列表，不修改 history）"""
+        split = max(len(history) - self.recent_messages, 0)
+        messages = [self.summarize(message) for message in history[:split]] + [dict(message) for message in history[split:]]
+        total = sum(message_tokens(message) for message in messages)
+        # 给可能插入的省略说明预留额度
+        limit = self.max_tokens - message_tokens(_omitted_note(len(history)))
+        dropped = 0
+        # 1. 丢弃最早的消息
+        while total > limit and len(messages) > 1 and dropped < split:
+            total -= message_tokens(messages.pop(0))
+            dropped += 1
+        # 2. 最近的消息也改用摘要（从早到晚）
+        index = 0
+        while total > limit and index < len(messages):
+            summary = self.summarize(messages[index])
+            total += message_tokens(summary) - message_tokens(messages[index])
+            messages[index] = summary
+            index += 1
+        # 3. 仍然超出时继续丢弃最早的消息，最后一条按剩余额度截断
+        while total > limit and len(messages) > 1:
+            total -= message_tokens(messages.pop(0))
+            dropped += 1
+        if total > limit and messages:
+            last = messages[-1]
+            # 按 token 占比估算保留的字符数，估算偏多时再逐步缩短
+            keep = len(last['content']) * limit // message_tokens(last)
+            last['content'] = clip_text(last['content'], keep)
+            while message_tokens(last) > limit and len(last['content']) > 1:
+                last['content'] = clip_text(last['content'], len(last['content']) * 9 // 10)
+        if dropped:
+            messages.insert(0, _omitted_note(dropped))
+        return messages
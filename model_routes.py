@@ -0,0 +1,104 @@
+"""按智能体选择模型：设置项 model_routes 把智能体类名映射到各自的模型、接口与采样参数，并给出备用链。
+
+settings.json 示例：
+    "model_routes": {
+        "CustomerServiceAgent": [
+            {"model": "qwen-turbo", "sampling": {"max_tokens": 1024}, "first_token_timeout": 15, "rpm": 300, "tpm": 200000},
+            {"model": "qwen-plus"}
+        ],
+        "default": {"first_token_timeout": 60}
+    }
+
+- 每个智能体取自己的条目，没有时取 "default"；条目可以是单个路由或按顺序尝试的路由列表；
+- 路由中未填写的 model / base_url / api_key 沿用全局设置，sampling 覆盖智能体自身的采样参数；
+- 全局设置的模型总是作为链的最后一环（已在链中时不重复添加），未配置 model_routes 时与原来完全相同；
+- first_token_timeout（秒）内没有收到首个回复片段、或请求失败（连接错误、超时、限流、服务端错误）时
+  改用下一条路由；已经开始输出后不再切换，链中最后一条路由不设首字超时；
+- rpm / tpm / max_in_flight 为该路由的客户端限流（见 rate_limiter.py），未填写时使用全局设置。
+"""
+import threading
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+
+
+class Route(NamedTuple):
+    model: str
+    base_url: str
+    api_key: str
+    sampling: dict = {}
+    first_token_timeout: Optional[float] = None
+    rpm: Optional[int] = None
+    tpm: Optional[int] = None
+    max_in_flight: Optional[int] = None
+
+    @property
+    def label(self):
+        host = urlparse(self.base_url).netloc or self.base_url or "默认接口"
+        return f"{self.model or '未设置'}@{host}"
+
+    @property
+    def endpoint(self):
+        return (self.model, self.base_url, self.api_key)
+
+
+def resolve_routes(table, agent_name, model, base_url, api_key):
+    """按 model_routes 设置生成某个智能体的路由链，全局设置 (model, base_url, api_key) 作为兜底"""
+    entry = (table or {}).get(agent_name, (table or {}).get("default"))
+    if entry is None:
+        entries = []
+    elif isinstance(entry, dict):
+        entries = [entry]
+    else:
+        entries = list(entry)
+    routes = []
+    for item in entries:
+        timeout = item.get("first_token_timeout")
+        routes.append(Route(
+            model=item.get("model") or model,
+            base_url=item.get("base_url") or base_url,
+            api_key=item.get("api_key") or api_key,
+            sampling=dict(item.get("sampling") or {}),
+            first_token_timeout=float(timeout) if timeout else None,
+            rpm=item.get("rpm"),
+            tpm=item.get("tpm"),
+            max_in_flight=item.get("max_in_flight")
+        ))
+    fallback = Route(model, base_url, api_key)
+    if all(route.endpoint != fallback.endpoint for route in routes):
+        routes.append(fallback)
+    return routes
+
+
+class RouteStats:
+    """按 (智能体, 路由) 统计调用次数、失败与改用备用路由的次数、平均首字延迟与总耗时"""
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, agent, label, ok, ttft=None, latency=None):
+        with self._lock:
+            entry = self._routes.setdefault((agent, label), {
+                'calls': 0, 'failures': 0, 'ttft_calls': 0, 'ttft': 0.0, 'latency_calls': 0, 'latency': 0.0
+            })
+            entry['calls'] += 1
+            if not ok:
+                entry['failures'] += 1
+            if ttft is not None:
+                entry['ttft_calls'] += 1
+                entry['ttft'] += ttft
+            if ok and latency is not None:
+                entry['latency_calls'] += 1
+                entry['latency'] += latency
+
+    def stats(self):
+        with self._lock:
+            return {
+                f"{agent} -> {label}": {
+                    'calls': entry['calls'],
+                    'failures': entry['failures'],
+                    'avg_ttft': entry['ttft'] / entry['ttft_calls'] if entry['ttft_calls'] else None,
+                    'avg_latency': entry['latency'] / entry['latency_calls'] if entry['latency_calls'] else None
+                }
+                for (agent, label), entry in self._routes.items()
+            }
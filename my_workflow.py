@@ -3,8 +3,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 import io
 from io import BytesIO
-from data_sumary import summarize_data
+from data_sumary import summarize_data, RetrievalIndex, DatasetProfile
 import createAgentsOPENAI
+import call_metrics
+from candidates import race_candidates
+from analysis_candidate import run_analysis_candidate
+from speculation import SpeculativePipeline
 import re
 import warnings
 import time
@@ -23,6 +27,19 @@ previous_code = None
 codesequence = []
 
 
+def clean_column_names(DF):
+    """去掉列名中的换行与制表符（与各工作流 import_data 中的处理相同），原地修改"""
+    DF.columns = DF.columns.str.replace(r'[\n\r\t]', '', regex=True)
+    return DF
+
+
+def prepare_import(DF, source_path=None):
+    """导入前的耗时准备：构建（或按 source_path 从磁盘缓存加载）检索索引与列画像。
+    DF 须已用 clean_column_names 清理列名；只读取 DF、不修改任何工作流，可在后台线程中调用，
+    返回的 (retrieval_index, data_profile) 交给各工作流的 import_data"""
+    return RetrievalIndex.load_or_build(DF, source_path), DatasetProfile(DF)
+
+
 class WorkflowThread(QThread):
     def __init__(self, workflow):
         super().__init__()
@@ -61,12 +78,16 @@ class Workflow(QObject):
         self.data_analysis_agent = createAgentsOPENAI.DataAnalysisAgent()
         self.bugfinder_agent = createAgentsOPENAI.BugFinderAgent()
         self.adjustment_agent = createAgentsOPENAI.AdjustmentAgent()
+        # 开启 speculative_pipeline 时提前启动的需求梳理与取数
+        self.speculation = SpeculativePipeline(self.customer_service_agent, self.task_summary_agent, self.data_analysis_agent)
         self.response_from_dataanalyst = None
         self.responseofda = None
         self.query_from_customer = None
         self.customer_service_response = None
         self.task_summary_response = None
         self.data_analysis_response = None
+        # 多候选取数时胜出候选的 (代码, result_df)，执行同一段代码时直接使用
+        self.precomputed_result = None
         self.double_check = 0
         self.status = 0
         self.last_status = None
@@ -75,6 +96,8 @@ class Workflow(QObject):
         self.result_df = None
         self.df = None
         self.ds = None
+        self.retrieval_index = None
+        self.data_profile = None
 
 
 
@@ -84,21 +107,26 @@ class Workflow(QObject):
         self.running = True
         self.query_from_customer = None
         self.status = 0
+        createAgentsOPENAI.agent_loop.run(self.speculation.close())
         self.customer_service_agent = createAgentsOPENAI.CustomerServiceAgent()
         self.task_summary_agent = createAgentsOPENAI.TaskSummaryAgent()
         self.data_analysis_agent = createAgentsOPENAI.DataAnalysisAgent()
         self.bugfinder_agent = createAgentsOPENAI.BugFinderAgent()
+        self.speculation = SpeculativePipeline(self.customer_service_agent, self.task_summary_agent, self.data_analysis_agent)
         self.response_from_dataanalyst = None
         self.responseofda = None
         self.customer_service_response = None
         self.task_summary_response = None
         self.data_analysis_response = None
+        self.precomputed_result = None
         self.double_check = 0
         self.last_status = None
         self.conversation_button = True
         self.result_df = None
         self.df = None
         self.ds = None
+        self.retrieval_index = None
+        self.data_profile = None
         self.conversation_mode_signal.emit(True)  # 新增重置信号
         self.database_information_signal.emit(None)
         self.previous_code_signal.emit(None)
@@ -107,38 +135,45 @@ class Workflow(QObject):
 
 
 
-    def import_data(self,DF):
+    def import_data(self,DF, retrieval_index=None, source_path=None, data_profile=None):
+        """导入数据并构建检索索引与列画像；若已有同一 DF 的索引与画像（例如另一工作流刚构建的），可直接传入复用。
+        提供 source_path 时按文件内容哈希使用磁盘缓存，再次打开同一文件无需重建索引。"""
         self.df = DF
         self.df.columns = self.df.columns.str.replace(r'[\n\r\t]', '', regex=True)
+        if retrieval_index is None:
+            retrieval_index = RetrievalIndex.load_or_build(self.df, source_path)
+        self.retrieval_index = retrieval_index
+        self.data_profile = data_profile if data_profile is not None else DatasetProfile(self.df)
 
     def set_ds(self,DS):
         self.ds = DS
 
-    @staticmethod
-    def api_call_with_retry(func, *args, **kwargs):
-        max_retries = 3
-        retry_count = 0
-        while retry_count < max_retries:
-            response = func(*args, **kwargs)
-            
-            # 检查返回值是否包含错误信息
-            if isinstance(response, dict):
-                # 检查所有值是否包含Error
-                has_error = any('rror: ' in str(value) or 'onnect' in str(value) for value in response.values())
-                if not has_error:
-                    return response
-            elif isinstance(response, str):
-                if 'rror: ' not in response and 'onnect' not in response:
-                    return response
-                
-            retry_count += 1
-            if retry_count == max_retries:
-                print(f"API调用失败，连续{max_retries}次返回错误")
-                return response
-            print(f"API返回错误，正在进行第{retry_count}次重试...")
-            time.sleep(2)  # 重试前等待2秒
+    def speculative_customer_service(self, database_info, query):
+        """开启 speculative_pipeline 时代替客服的 process_query，客服确定转交取数后提前启动需求梳理与取数；
+        多候选取数时只提前启动需求梳理"""
+        return createAgentsOPENAI.agent_loop.run(self.speculation.customer_service(
+            database_info, query, analysis=createAgentsOPENAI.best_of_n() <= 1
+        ))
+
+    def take_speculation(self, name, database_info, task):
+        """输入与提前启动时相同则返回其结果，否则返回 None（按原流程调用）"""
+        return createAgentsOPENAI.agent_loop.run(self.speculation.take(name, database_info, task))
+
+    def best_of_n_analysis(self, agents, database_info, task):
+        """并发生成多个取数候选，每个候选的代码一完整就在该候选的工作进程中执行，第一个得到非空 result_df 的候选胜出，
+        其余候选取消、工作进程结束。返回胜出候选的回复；没有候选通过时返回第一个成功解析的回复，按原流程执行与排错"""
+        race = createAgentsOPENAI.agent_loop.run(race_candidates(
+            agents, (database_info, task), 'python_code', run_analysis_candidate,
+            context=self.df, timeout=createAgentsOPENAI.best_of_n_timeout()
+        ))
+        if race.winner is None:
+            return next((result for result in race.results if isinstance(result, dict)), race.results[0])
+        self.precomputed_result = race.payload
+        return race.fields
 
     def run(self):
+        # 本线程的智能体调用与步骤记录按本工作流当时的状态标记（见 call_metrics.py）
+        call_metrics.workflow.set(self)
         while self.running:
             if self.status == 0:
                 # 发送会话模式信号
@@ -171,7 +206,8 @@ class Workflow(QObject):
                     f"{msg['role']}: {msg['content']}"
                     for msg in temp_history[-min(5, len(temp_history)):]
                 ])
-                database_info = summarize_data(self.df,self.ds,temp_query)
+                with createAgentsOPENAI.call_metrics.step("数据概况"):
+                    database_info = summarize_data(self.df,self.ds,temp_query,self.retrieval_index,self.data_profile)
 
                 database_information = database_info
                 self.database_information_signal.emit(database_information)
@@ -192,27 +228,25 @@ class Workflow(QObject):
                 print("AI思考中...")
                 self.back_to_thinking_mode_signal.emit()
                 
-                customer_service_response = Workflow.api_call_with_retry(
-                        self.customer_service_agent.process_query,
-                        database_info, 
-                        temp_query
-                    )                
+                if createAgentsOPENAI.speculative_pipeline():
+                    customer_service_response = createAgentsOPENAI.retry_engine.call(
+                            self.speculative_customer_service,
+                            database_info,
+                            temp_query
+                        )
+                else:
+                    customer_service_response = createAgentsOPENAI.retry_engine.call(
+                            self.customer_service_agent.process_query,
+                            database_info, 
+                            temp_query
+                        )                
                 # 发送信号
                 
-                if isinstance(customer_service_response, dict):
-                    # 检查所有值是否包含Error
-                    has_error = any('rror' in str(value) or 'onnect' in str(value) for value in customer_service_response.values())
-                    if has_error:
-                        self.status = 0
-                        self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                        self.last_status = 2
-                        continue
-                elif isinstance(customer_service_response, str):
-                    if 'rror' in customer_service_response and 'onnect' in customer_service_response:
-                        self.status = 0
-                        self.last_status = 2
-                        self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                        continue
+                if isinstance(customer_service_response, createAgentsOPENAI.AgentFailure):
+                    self.status = 0
+                    self.last_status = 2
+                    self.customer_service_agent.history = self.customer_service_agent.history[:-1]
+                    continue
                 if ('Y' in customer_service_response["need_clarity"]) and ('稍等' in customer_service_response["to_customer"]):
                     #print(customer_service_response["to_customer"])
                     self.status = 3
@@ -233,56 +267,49 @@ class Workflow(QObject):
 
 
             if self.status == 3:
-                conversation_history = self.customer_service_agent.history
+                conversation_history = self.customer_service_agent.prompt_history()
                 print("需求分析中...")
                 
-                task_summary_response = Workflow.api_call_with_retry(
-                        self.task_summary_agent.process_query,
-                        database_info, 
-                        conversation_history
-                    )
-                if isinstance(task_summary_response, dict):
-                    # 检查所有值是否包含Error
-                    has_error = any('rror' in str(value) or 'onnect' in str(value) for value in task_summary_response.values())
-                    if has_error:
-                        self.status = 0
-                        self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                        self.last_status = 3
-                        continue
-                elif isinstance(task_summary_response, str):
-                    if 'rror' in task_summary_response and 'onnect' in task_summary_response:
-                        self.status = 0
-                        self.last_status = 3
-                        self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                        continue
+                task_summary_response = self.take_speculation('task_summary', database_info, conversation_history)
+                if task_summary_response is None:
+                    task_summary_response = createAgentsOPENAI.retry_engine.call(
+                            self.task_summary_agent.process_query,
+                            database_info, 
+                            conversation_history
+                        )
+                if isinstance(task_summary_response, createAgentsOPENAI.AgentFailure):
+                    self.status = 0
+                    self.last_status = 3
+                    self.customer_service_agent.history = self.customer_service_agent.history[:-1]
+                    continue
                 self.status = 4
                 self.last_status = 3
             
             if self.status == 4:
                 print("尝试取数中...")
                 self.operating_mode_signal.emit()
-                data_analysis_response = Workflow.api_call_with_retry(
-                        self.data_analysis_agent.process_query,
-                        database_info, 
-                        task_summary_response['task_summary']
-                    )
+                candidate_agents = createAgentsOPENAI.data_analysis_candidates()
+                if candidate_agents:
+                    data_analysis_response = createAgentsOPENAI.retry_engine.call(
+                            self.best_of_n_analysis,
+                            candidate_agents,
+                            database_info,
+                            task_summary_response['task_summary']
+                        )
+                else:
+                    data_analysis_response = self.take_speculation('analysis', database_info, task_summary_response['task_summary'])
+                    if data_analysis_response is None:
+                        data_analysis_response = createAgentsOPENAI.retry_engine.call(
+                                self.data_analysis_agent.process_query,
+                                database_info, 
+                                task_summary_response['task_summary']
+                            )
                 print(data_analysis_response)
-                if isinstance(data_analysis_response, dict):
-                    # 检查所有值是否包含Error
-                    print(1)
-                    has_error = any('rror' in str(value) or 'onnect' in str(value) for value in data_analysis_response.values())
-                    if has_error:
-                        self.status = 0
-                        self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                        self.last_status = 4
-                        continue
-                elif isinstance(data_analysis_response, str):
-                    print(2)
-                    if 'rror' in data_analysis_response and 'onnect' in data_analysis_response:
-                        self.status = 0
-                        self.last_status = 4
-                        self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                        continue
+                if isinstance(data_analysis_response, createAgentsOPENAI.AgentFailure):
+                    self.status = 0
+                    self.last_status = 4
+                    self.customer_service_agent.history = self.customer_service_agent.history[:-1]
+                    continue
                 print(3)
                 feasibility_result = data_analysis_response['feasibility'].strip()
                 if 'Y' in feasibility_result:
@@ -337,10 +364,15 @@ class Workflow(QObject):
                         
                         'df': self.df.copy() if self.df is not None else None
                     }
+                    precomputed, self.precomputed_result = self.precomputed_result, None
                     try:
-                        with warnings.catch_warnings():
-                            warnings.simplefilter("ignore")
-                            exec(code_to_execute, exec_namespace)
+                        if precomputed is not None and precomputed[0] == code_to_execute:
+                            # 多候选取数时已在工作线程中执行过这段代码
+                            exec_namespace['result_df'] = precomputed[1]
+                        else:
+                            with warnings.catch_warnings(), createAgentsOPENAI.call_metrics.step("执行代码"):
+                                warnings.simplefilter("ignore")
+                                exec(code_to_execute, exec_namespace)
 
                         # 检查result_df是否存在
                         if 'result_df' in exec_namespace:
@@ -391,10 +423,10 @@ class Workflow(QObject):
 
                                 self.customer_service_agent.history.append({
                                     "role": "数据库前台",
-                                    "content": f"数据分析师已经取好数据，前五行数据如下：\n    {sample_text}\n    取数ypthon代码如下：\n{code_to_execute}\n    您可以提出对该数据的修改意见，我们将在弄清您的进一步意向后为您重新提取数据；或者你想详细弄清这些数据是如何计算的，我也可以为您解释；又或者该数据已经满足了您的需求，您可以提出新的需求，我们将move on to your next task"
+                                    "content": f"数据分析师已经取好数据，前五行数据如下：\n```表格\n{sample_text}\n```\n    取数ypthon代码如下：\n```python\n{code_to_execute}\n```\n    您可以提出对该数据的修改意见，我们将在弄清您的进一步意向后为您重新提取数据；或者你想详细弄清这些数据是如何计算的，我也可以为您解释；又或者该数据已经满足了您的需求，您可以提出新的需求，我们将move on to your next task"
                                 })
                                 self.back_to_thinking_mode_signal.emit()
-                                customer_service_response = Workflow.api_call_with_retry(
+                                customer_service_response = createAgentsOPENAI.retry_engine.call(
                                         self.customer_service_agent.process_query,
                                         database_info, 
                                         '请您根据代码，简述你们取数或预测的思路与逻辑。'
@@ -445,7 +477,7 @@ class Workflow(QObject):
                     #返回为空
                     problemds = "返回为空"
                     self.back_to_thinking_mode_signal.emit()
-                    bugfinder_response = Workflow.api_call_with_retry(
+                    bugfinder_response = createAgentsOPENAI.retry_engine.call(
                             self.bugfinder_agent.process_query,
                             database_info, 
                             task_summary_response['task_summary'],
@@ -454,20 +486,11 @@ class Workflow(QObject):
                             code_to_execute
                         )
 
-                    if isinstance(bugfinder_response, dict):
-                        # 检查所有值是否包含Error
-                        has_error = any('rror' in str(value) or 'onnect' in str(value) for value in bugfinder_response.values())
-                        if has_error:
-                            self.status = 0
-                            self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                            self.last_status = 6
-                            continue
-                    elif isinstance(bugfinder_response, str):
-                        if 'rror' in bugfinder_response and 'onnect' in bugfinder_response:
-                            self.status = 0
-                            self.last_status = 6
-                            self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                            continue
+                    if isinstance(bugfinder_response, createAgentsOPENAI.AgentFailure):
+                        self.status = 0
+                        self.last_status = 6
+                        self.customer_service_agent.history = self.customer_service_agent.history[:-1]
+                        continue
 
                     if "不" in bugfinder_response["diagnose"]:
                         print("没有查找到合适的数据，返回数据集为空，这很可能是由于数据库中没有相关的数据，您可以再次尝试或者问问其他的问题。")
@@ -491,7 +514,7 @@ class Workflow(QObject):
                     #运行报错
                     problemds = f"代码执行失败,报错如下: {error_message}"
                     self.back_to_thinking_mode_signal.emit()
-                    bugfinder_response = self.api_call_with_retry(
+                    bugfinder_response = createAgentsOPENAI.retry_engine.call(
                             self.bugfinder_agent.process_query,
                             database_info, 
                             task_summary_response['task_summary'],
@@ -499,20 +522,11 @@ class Workflow(QObject):
                             problemds, 
                             code_to_execute
                         )
-                    if isinstance(bugfinder_response, dict):
-                        # 检查所有值是否包含Error
-                        has_error = any('rror' in str(value) or 'onnect' in str(value) for value in bugfinder_response.values())
-                        if has_error:
-                            self.status = 0
-                            self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                            self.last_status = 6
-                            continue
-                    elif isinstance(bugfinder_response, str):
-                        if 'rror' in bugfinder_response and 'onnect' in bugfinder_response:
-                            self.status = 0
-                            self.last_status = 6
-                            self.customer_service_agent.history = self.customer_service_agent.history[:-1]
-                            continue
+                    if isinstance(bugfinder_response, createAgentsOPENAI.AgentFailure):
+                        self.status = 0
+                        self.last_status = 6
+                        self.customer_service_agent.history = self.customer_service_agent.history[:-1]
+                        continue
                     if "不" in bugfinder_response["diagnose"]:
                         print("没有查找到合适的数据，返回数据集为空，这很可能是由于数据库中没有相关的数据，您可以再次尝试或者问问其他的问题。")
                         self.customer_service_agent.history.append({
@@ -577,36 +591,20 @@ class AdjustmentWorkflow(QObject):
         self.codesequence = []
         self.df = None
         self.ds = None
+        self.retrieval_index = None
+        self.data_profile = None
         
-    def import_data(self,DF):
+    def import_data(self,DF, retrieval_index=None, source_path=None, data_profile=None):
+        """导入数据并构建检索索引与列画像；若已有同一 DF 的索引与画像（例如另一工作流刚构建的），可直接传入复用。
+        提供 source_path 时按文件内容哈希使用磁盘缓存，再次打开同一文件无需重建索引。"""
         self.df = DF
         self.df.columns = self.df.columns.str.replace(r'[\n\r\t]', '', regex=True)
+        if retrieval_index is None:
+            retrieval_index = RetrievalIndex.load_or_build(self.df, source_path)
+        self.retrieval_index = retrieval_index
+        self.data_profile = data_profile if data_profile is not None else DatasetProfile(self.df)
     def set_ds(self,DS):
         self.ds = DS
-    @staticmethod
-    def api_call_with_retry(func, *args, **kwargs):
-        max_retries = 3
-        retry_count = 0
-        while retry_count < max_retries:
-            response = func(*args, **kwargs)
-            
-            # 检查返回值是否包含错误信息
-            if isinstance(response, dict):
-                # 检查所有值是否包含Error
-                has_error = any('rror: ' in str(value) or 'onnect' in str(value) for value in response.values())
-                if not has_error:
-                    return response
-            elif isinstance(response, str):
-                if 'rror: ' not in response and 'onnect' not in response:
-                    return response
-                
-            retry_count += 1
-            if retry_count == max_retries:
-                print(f"API调用失败，连续{max_retries}次返回错误")
-                return response
-            print(f"API返回错误，正在进行第{retry_count}次重试...")
-            time.sleep(2)  # 重试前等待2秒
-
     def clear_memory(self):
         """清理所有状态"""
         self.running = True
@@ -617,6 +615,8 @@ class AdjustmentWorkflow(QObject):
         self.database_information = None
         self.codesequence = []
         self.df = None
+        self.retrieval_index = None
+        self.data_profile = None
         # 发送重置信号
         self.conversation_mode_signal.emit(True)
         self.previous_code_signal.emit(None)
@@ -625,6 +625,8 @@ class AdjustmentWorkflow(QObject):
 
 
     def adjustment_run(self):
+        # 本线程的智能体调用与步骤记录按本工作流当时的状态标记（见 call_metrics.py）
+        call_metrics.workflow.set(self)
         while self.running:
             if self.status == 0:
 
@@ -637,30 +639,24 @@ class AdjustmentWorkflow(QObject):
 
                     self.seeking_mode_signal.emit()
 
-                    database_info = summarize_data(self.df,self.ds,self.adjustment_requirement)
+                    with createAgentsOPENAI.call_metrics.step("数据概况"):
+                        database_info = summarize_data(self.df,self.ds,self.adjustment_requirement,self.retrieval_index,self.data_profile)
                     self.database_information = database_info
                     self.database_information_signal.emit(database_info)
 
 
                 self.codesequence = self.codesequence[:self.currentpage+1]
                 self.operating_mode_signal.emit()
-                adjustment_response = self.api_call_with_retry(
+                adjustment_response = createAgentsOPENAI.retry_engine.call(
                     self.adjustment_agent.process_query,
                     self.database_information, 
                     self.codesequence[self.currentpage],
                     self.adjustment_requirement
                     )
                 self.conversation_mode_signal.emit(True)
-                if isinstance(adjustment_response, dict):
-                    # 检查所有值是否包含Error
-                    has_error = any('rror' in str(value) or 'onnect' in str(value) for value in adjustment_response.values())
-                    if has_error:
-                        self.status = 0
-                        continue
-                elif isinstance(adjustment_response, str):
-                    if 'rror' in adjustment_response and 'onnect' in adjustment_response:
-                        self.status = 0
-                        continue
+                if isinstance(adjustment_response, createAgentsOPENAI.AgentFailure):
+                    self.status = 0
+                    continue
                 #还需要检查代码、NY，然后再status = 1
                 feasibility_result = adjustment_response['feasibility'].strip()
                 if 'Y' in feasibility_result:
@@ -717,7 +713,7 @@ class AdjustmentWorkflow(QObject):
                         'df': self.df.copy() if self.df is not None else None
                     }
                     try:
-                        with warnings.catch_warnings():
+                        with warnings.catch_warnings(), createAgentsOPENAI.call_metrics.step("执行代码"):
                             warnings.simplefilter("ignore")
                             exec(code_to_execute, exec_namespace)
 
@@ -830,30 +826,6 @@ class DrawWorkflow(QObject):
         self.df = DF
         self.df.columns = self.df.columns.str.replace(r'[\n\r\t]', '', regex=True)
 
-    @staticmethod
-    def api_call_with_retry(func, *args, **kwargs):
-        max_retries = 3
-        retry_count = 0
-        while retry_count < max_retries:
-            response = func(*args, **kwargs)
-            
-            # 检查返回值是否包含错误信息
-            if isinstance(response, dict):
-                # 检查所有值是否包含Error
-                has_error = any('rror: ' in str(value) or 'onnect' in str(value) for value in response.values())
-                if not has_error:
-                    return response
-            elif isinstance(response, str):
-                if 'rror: ' not in response and 'onnect' not in response:
-                    return response
-                
-            retry_count += 1
-            if retry_count == max_retries:
-                print(f"API调用失败，连续{max_retries}次返回错误")
-                return response
-            print(f"API返回错误，正在进行第{retry_count}次重试...")
-            time.sleep(2)  # 重试前等待2秒
-
     def clear_memory(self):
         """清理所有状态"""
         self.running = True
@@ -872,6 +844,8 @@ class DrawWorkflow(QObject):
 
 
     def draw_run(self):
+        # 本线程的智能体调用与步骤记录按本工作流当时的状态标记（见 call_metrics.py）
+        call_metrics.workflow.set(self)
         while self.running:
             if self.status == 0:
 
@@ -888,26 +862,20 @@ class DrawWorkflow(QObject):
 
                 self.seeking_mode_signal.emit()
 
-                self.result_database_info = summarize_data(self.df,self.ds,temp_query)
+                with createAgentsOPENAI.call_metrics.step("数据概况"):
+                    self.result_database_info = summarize_data(self.df,self.ds,temp_query)
                 self.result_database_info_signal.emit(self.result_database_info)
                 
                 self.operating_mode_signal.emit()
-                draw_response = self.api_call_with_retry(
+                draw_response = createAgentsOPENAI.retry_engine.call(
                     self.draw_agent.process_query,
                     self.result_database_info, 
                     self.drawing_request
                     )
                 self.conversation_mode_signal.emit(True)
-                if isinstance(draw_response, dict):
-                    # 检查所有值是否包含Error
-                    has_error = any('rror' in str(value) or 'onnect' in str(value) for value in draw_response.values())
-                    if has_error:
-                        self.status = 0
-                        continue
-                elif isinstance(draw_response, str):
-                    if 'rror' in draw_response and 'onnect' in draw_response:
-                        self.status = 0
-                        continue
+                if isinstance(draw_response, createAgentsOPENAI.AgentFailure):
+                    self.status = 0
+                    continue
                 #还需要检查代码、NY，然后再status = 1
                 
   
@@ -950,7 +918,7 @@ class DrawWorkflow(QObject):
                         'df': self.df.copy() if self.df is not None else None
                     }
                     try:
-                        with warnings.catch_warnings():
+                        with warnings.catch_warnings(), createAgentsOPENAI.call_metrics.step("执行代码"):
                             warnings.simplefilter("ignore")
                             exec(code_to_execute, exec_namespace)
 
@@ -1072,30 +1040,6 @@ class DrawAdjustmentWorkflow(QObject):
         self.df = DF
         self.df.columns = self.df.columns.str.replace(r'[\n\r\t]', '', regex=True)
 
-    @staticmethod
-    def api_call_with_retry(func, *args, **kwargs):
-        max_retries = 3
-        retry_count = 0
-        while retry_count < max_retries:
-            response = func(*args, **kwargs)
-            
-            # 检查返回值是否包含错误信息
-            if isinstance(response, dict):
-                # 检查所有值是否包含Error
-                has_error = any('rror: ' in str(value) or 'onnect' in str(value) for value in response.values())
-                if not has_error:
-                    return response
-            elif isinstance(response, str):
-                if 'rror: ' not in response and 'onnect' not in response:
-                    return response
-                
-            retry_count += 1
-            if retry_count == max_retries:
-                print(f"API调用失败，连续{max_retries}次返回错误")
-                return response
-            print(f"API返回错误，正在进行第{retry_count}次重试...")
-            time.sleep(2)  # 重试前等待2秒
-
     def clear_memory(self):
         """清理所有状态"""
         self.running = True
@@ -1118,6 +1062,8 @@ class DrawAdjustmentWorkflow(QObject):
 
 
     def draw_run(self):
+        # 本线程的智能体调用与步骤记录按本工作流当时的状态标记（见 call_metrics.py）
+        call_metrics.workflow.set(self)
         while self.running:
             if self.status == 0:
                 print("正在等待调整需求")
@@ -1145,7 +1091,7 @@ class DrawAdjustmentWorkflow(QObject):
 
                 self.last_code = self.drawing_codesequence[self.current_plot]
                 self.operating_mode_signal.emit()
-                draw_response = self.api_call_with_retry(
+                draw_response = createAgentsOPENAI.retry_engine.call(
                     self.draw_adjustment_agent.process_query,
                     self.result_database_info, 
                     self.drawing_request,
@@ -1153,16 +1099,9 @@ class DrawAdjustmentWorkflow(QObject):
                     )
                 print(draw_response)
                 self.conversation_mode_signal.emit(True)
-                if isinstance(draw_response, dict):
-                    # 检查所有值是否包含Error
-                    has_error = any('rror' in str(value) or 'onnect' in str(value) for value in draw_response.values())
-                    if has_error:
-                        self.status = 0
-                        continue
-                elif isinstance(draw_response, str):
-                    if 'rror' in draw_response and 'onnect' in draw_response:
-                        self.status = 0
-                        continue
+                if isinstance(draw_response, createAgentsOPENAI.AgentFailure):
+                    self.status = 0
+                    continue
                 #还需要检查代码、NY，然后再status = 1
                 
   
@@ -1205,7 +1144,7 @@ class DrawAdjustmentWorkflow(QObject):
                         'df': self.df.copy() if self.df is not None else None
                     }
                     try:
-                        with warnings.catch_warnings():
+                        with warnings.catch_warnings(), createAgentsOPENAI.call_metrics.step("执行代码"):
                             warnings.simplefilter("ignore")
                             exec(code_to_execute, exec_namespace)
 
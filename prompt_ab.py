@@ -0,0 +1,97 @@
+"""提示词压缩（prompt_compaction）的 A/B 对比脚本
+
+用法：
+    python prompt_ab.py sessions.jsonl
+    python prompt_ab.py sessions.jsonl --repeat 3 --agents TaskSummaryAgent DrawAgent
+
+sessions.jsonl 由设置项 session_record_path 在正常使用时录制，每行是一次智能体调用的输入。
+脚本对其中支持压缩的智能体，分别在关闭、开启压缩时用同样的输入重新请求模型
+（模型与接口取自 settings.json），对比解析成功率与提示词的估算 token 数。
+
+注意：会产生真实的接口调用；脚本运行期间关闭回复缓存与会话录制。
+"""
+import argparse
+import contextlib
+import io
+import json
+
+import createAgentsOPENAI as agents
+from token_budget import estimate_tokens
+
+COMPACTABLE_AGENTS = {
+    cls.__name__: cls
+    for cls in (agents.TaskSummaryAgent, agents.DrawAgent, agents.DrawAdjustmentAgent)
+    if cls.COMPACTABLE
+}
+
+
+def load_sessions(path, names):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record['agent'] in names:
+                yield record
+
+
+def run_once(agent_cls, args, compact):
+    """以指定的压缩设置调用一次，返回 (提示词 token 数, 结果：ok / parse_failure / error)"""
+    agents.current_config[agents.KEY_PROMPT_COMPACTION] = compact
+    agent = agent_cls()
+    with contextlib.redirect_stdout(io.StringIO()):
+        messages = agent.build_messages(*args)
+        failures_before = _parse_failures(agent_cls.__name__)
+        result = agents.agent_loop.run(agent.aprocess(*args))
+        failures_after = _parse_failures(agent_cls.__name__)
+    prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+    if isinstance(result, dict):
+        return prompt_tokens, 'ok'
+    return prompt_tokens, 'parse_failure' if failures_after > failures_before else 'error'
+
+
+def _parse_failures(agent_name):
+    modes = agents.parse_stats.stats().get(agent_name, {})
+    return sum(entry['failures'] for mode, entry in modes.items() if isinstance(entry, dict))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="提示词压缩 A/B 对比")
+    parser.add_argument('sessions', help="session_record_path 录制的 jsonl 文件")
+    parser.add_argument('--agents', nargs='+', default=sorted(COMPACTABLE_AGENTS), help="参与对比的智能体类名")
+    parser.add_argument('--repeat', type=int, default=1, help="每条记录在每种设置下的调用次数")
+    options = parser.parse_args()
+
+    unknown = set(options.agents) - set(COMPACTABLE_AGENTS)
+    if unknown:
+        parser.error(f"以下智能体不支持提示词压缩: {sorted(unknown)}")
+
+    agents.response_cache.mode = "off"
+    agents.current_config[agents.KEY_SESSION_RECORD_PATH] = ""
+
+    results = {}
+    records = list(load_sessions(options.sessions, set(options.agents)))
+    print(f"[A/B] 共 {len(records)} 条记录，每条每种设置调用 {options.repeat} 次")
+    for index, record in enumerate(records, 1):
+        agent_cls = COMPACTABLE_AGENTS[record['agent']]
+        for _ in range(options.repeat):
+            # 交替先后顺序，避免服务端缓存或负载变化只偏向其中一种设置
+            for compact in ((False, True) if index % 2 else (True, False)):
+                prompt_tokens, outcome = run_once(agent_cls, record['args'], compact)
+                entry = results.setdefault((record['agent'], compact), {'calls': 0, 'ok': 0, 'parse_failure': 0, 'error': 0, 'prompt_tokens': 0})
+                entry['calls'] += 1
+                entry[outcome] += 1
+                entry['prompt_tokens'] += prompt_tokens
+        print(f"[A/B] {index}/{len(records)} {record['agent']}")
+
+    print(f"\n{'智能体':<22}{'压缩':<6}{'调用':>6}{'解析成功率':>12}{'解析失败':>10}{'其他错误':>10}{'平均提示 tokens':>18}")
+    for (agent_name, compact), entry in sorted(results.items()):
+        parsed = entry['ok'] + entry['parse_failure']
+        success_rate = f"{entry['ok'] / parsed:.1%}" if parsed else "-"
+        print(f"{agent_name:<22}{'开' if compact else '关':<6}{entry['calls']:>6}{success_rate:>12}"
+              f"{entry['parse_failure']:>10}{entry['error']:>10}{entry['prompt_tokens'] / entry['calls']:>18.0f}")
+
+
+if __name__ == "__main__":
+    main()
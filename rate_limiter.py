@@ -0,0 +1,159 @@
+"""客户端限流：在请求发出前按每分钟请求数（RPM）、每分钟 token 数（TPM）与同时进行的请求数排队，
+让并发的工作流与批量脚本的总请求量保持在服务商上限以内，而不是撞上 429 后再靠重试。
+
+- 每个路由（模型@接口）一个 RateLimiter，RPM / TPM 各是一个令牌桶，按每分钟的额度匀速补充；
+  请求占用的 token 按提示词估算加上预留的回复长度，拿到 usage 后按实际用量修正；
+- 排队按流水线（客服、取数、调整、绘图）轮转放行，同一流水线内先到先得，
+  某条流水线的大批请求不会让其他流水线一直等待；
+- 收到 429 时按 Retry-After（没有时默认 2 秒）暂停该路由的放行。
+所有方法都在 agent_loop 的事件循环中调用。
+"""
+import asyncio
+import time
+from collections import deque
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """还需等待的秒数（超过桶容量的请求按容量计，避免永远等不到）"""
+        self._refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, delta):
+        """按实际用量修正（delta 为实际多用的量，可为负），多用的部分从之后的额度中扣除"""
+        self.level = min(self.capacity, self.level - delta)
+
+
+class Permit:
+    """一次放行：tokens 为预估占用，调用方拿到 usage 后填入 used_tokens"""
+    __slots__ = ('pipeline', 'tokens', 'used_tokens', 'waited')
+
+    def __init__(self, pipeline, tokens, waited):
+        self.pipeline = pipeline
+        self.tokens = tokens
+        self.used_tokens = None
+        self.waited = waited
+
+
+class RateLimiter:
+    def __init__(self, name, rpm=0, tpm=0, max_in_flight=0):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._queues = {}
+        # 流水线的轮转顺序，刚被放行的流水线移到末尾
+        self._rotation = deque()
+        self._paused_until = 0.0
+        self._timer = None
+        self._waits = {}
+
+    async def acquire(self, pipeline, tokens):
+        future = asyncio.get_running_loop().create_future()
+        if pipeline not in self._queues:
+            self._queues[pipeline] = deque()
+            self._rotation.append(pipeline)
+        entry = (future, tokens, time.monotonic())
+        self._queues[pipeline].append(entry)
+        self._pump()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(future.result())
+            elif entry in self._queues[pipeline]:
+                self._queues[pipeline].remove(entry)
+                self._pump()
+            raise
+
+    def release(self, permit):
+        self.in_flight -= 1
+        if self.tokens is not None and permit.used_tokens is not None:
+            self.tokens.adjust(permit.used_tokens - permit.tokens)
+        self._pump()
+
+    def pause(self, seconds):
+        """暂停放行（收到 429 时）"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        print(f"\n[限流] {self.name} 触发服务端限流，暂停放行 {seconds:.1f} s")
+
+    def _wait_time(self, tokens, now):
+        """队首请求还需等待的秒数；并发已满时返回 None（等有请求结束再放行）"""
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return None
+        wait = max(0.0, self._paused_until - now)
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    def _next_pipeline(self):
+        for pipeline in self._rotation:
+            queue = self._queues[pipeline]
+            while queue and queue[0][0].done():
+                queue.popleft()
+            if queue:
+                return pipeline
+        return None
+
+    def _pump(self):
+        while True:
+            pipeline = self._next_pipeline()
+            if pipeline is None:
+                return
+            future, tokens, enqueued = self._queues[pipeline][0]
+            now = time.monotonic()
+            wait = self._wait_time(tokens, now)
+            if wait is None:
+                return
+            if wait > 0:
+                self._schedule(wait)
+                return
+            self._queues[pipeline].popleft()
+            self._rotation.remove(pipeline)
+            self._rotation.append(pipeline)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            self.in_flight += 1
+            waited = now - enqueued
+            entry = self._waits.setdefault(pipeline, {'calls': 0, 'waited': 0.0, 'max_wait': 0.0})
+            entry['calls'] += 1
+            entry['waited'] += waited
+            entry['max_wait'] = max(entry['max_wait'], waited)
+            future.set_result(Permit(pipeline, tokens, waited))
+
+    def _schedule(self, wait):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._pump()
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'pipelines': {
+                pipeline: {**entry, 'avg_wait': entry['waited'] / entry['calls'] if entry['calls'] else 0.0}
+                for pipeline, entry in self._waits.items()
+            }
+        }
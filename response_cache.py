@@ -0,0 +1,152 @@
+"""大模型回复的磁盘缓存（按内容寻址）。
+
+缓存键为模型名、采样参数与完整消息列表的 sha256，相同请求直接复用上次的完整回复。
+每条回复单独存为一个 json 文件，按最近访问时间（文件修改时间）淘汰，总大小不超过上限。
+
+三种模式：
+- off：不使用缓存；
+- readwrite：命中时直接返回，未命中时请求模型并写入缓存；
+- replay：只回放缓存，未命中时抛出 ResponseCacheMiss，不发出任何网络请求，
+  用于让整条工作流可重复运行（回归测试、离线演示）。
+"""
+import hashlib
+import json
+import os
+import threading
+
+RESPONSE_CACHE_VERSION = 1
+CACHE_MODES = ("off", "readwrite", "replay")
+
+
+class ResponseCacheMiss(Exception):
+    """回放模式下缓存未命中"""
+
+
+class ResponseCache:
+    def __init__(self, cache_dir, max_bytes, mode="off"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"未知的回复缓存模式: {mode}，可选 {CACHE_MODES}")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+        # 缓存目录总大小在首次写入时统计一次，之后增量维护
+        self._total_bytes = None
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    @staticmethod
+    def make_key(model, sampling, messages):
+        payload = json.dumps({
+            'version': RESPONSE_CACHE_VERSION,
+            'model': model,
+            'sampling': sampling,
+            'messages': messages
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """返回缓存的回复文本；未命中时返回 None，回放模式下抛出 ResponseCacheMiss"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                response = json.load(f)['response']
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            response = None
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if response is None and self.mode == "replay":
+            raise ResponseCacheMiss(f"回放模式下没有缓存的回复: {key[:12]}")
+        return response
+
+    def put(self, key, model, response):
+        if self.mode != "readwrite":
+            return
+        path = self._path(key)
+        data = json.dumps({'model': model, 'response': response}, ensure_ascii=False).encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_size()
+            if os.path.exists(path):
+                self._total_bytes -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self._total_bytes += len(data)
+            self.stores += 1
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for shard in os.listdir(self.cache_dir):
+            shard_dir = os.path.join(self.cache_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if name.endswith(".json"):
+                    path = os.path.join(shard_dir, name)
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """按最近访问时间淘汰，直到总大小不超过上限的九成（避免每次写入都触发整目录扫描）"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._total_bytes = total
+        print(f"[回复缓存] 已淘汰 {removed} 条，当前 {total / 1024 / 1024:.1f} MB")
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.stores = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'mode': self.mode,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'stores': self.stores,
+            'bytes': self._total_bytes
+        }
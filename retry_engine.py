@@ -0,0 +1,218 @@
+"""智能体调用失败时的统一重试：按错误类型决定是否重试，指数退避加随机抖动，遵守 Retry-After，
+按接口熔断，并用重试预算限制整体的重试量。
+
+- 智能体调用失败时返回 AgentFailure（错误文本的 str 子类，保留原来的返回形式），附带原始异常与分类：
+  - transient：连接错误、超时、限流（429）、服务端错误（5xx）、熔断中，退避后重试；
+  - parse：回复不符合固定格式，重新生成即可，立即重试；
+  - fatal：请求本身不合法、鉴权失败、回放缓存未命中等，重试也不会成功，直接返回。
+- CircuitBreaker 按路由（模型@接口）统计连续失败，达到阈值后在冷却时间内跳过该路由（改用备用路由），
+  冷却结束后放行一次试探请求，成功即恢复。
+- RetryBudget 是令牌桶：每次调用存入 ratio 个令牌，每次重试消耗 1 个，接口整体故障时重试量
+  被限制在调用量的 ratio 倍左右，避免重试放大故障。
+"""
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from openai import APIConnectionError, APIStatusError
+
+from call_metrics import attempt as metrics_attempt
+
+RETRYABLE_STATUS = (408, 409, 429)
+
+
+class AgentFailure(str):
+    """智能体调用失败时的返回值：内容与原来的错误文本相同，另带 error（原始异常）、kind 与 retry_after"""
+
+    def __new__(cls, text, error=None):
+        failure = super().__new__(cls, text)
+        failure.error = error
+        failure.kind, failure.retry_after = classify_error(error)
+        return failure
+
+    @property
+    def retryable(self):
+        return self.kind != "fatal"
+
+
+class CircuitOpenError(Exception):
+    """路由链中所有路由都处于熔断状态"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def classify_error(error):
+    """返回 (类别, Retry-After 秒数或 None)"""
+    if isinstance(error, CircuitOpenError):
+        return "transient", error.retry_after
+    if isinstance(error, (APIConnectionError, asyncio.TimeoutError)):
+        return "transient", None
+    if isinstance(error, APIStatusError):
+        if error.status_code in RETRYABLE_STATUS or error.status_code >= 500:
+            return "transient", _retry_after(error.response)
+        return "fatal", None
+    if isinstance(error, (AttributeError, KeyError, IndexError, TypeError, ValueError)):
+        # 固定格式解析失败（正则未匹配、缺少字段、JSON 不完整等）
+        return "parse", None
+    return "fatal", None
+
+
+def _retry_after(response):
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def allow(self, endpoint):
+        """返回 (是否放行, 熔断剩余秒数)；冷却结束后放行一次试探请求，同时把下一次试探推迟一个冷却时间"""
+        with self._lock:
+            state = self._endpoints.get(endpoint)
+            if state is None or state['open_until'] is None:
+                return True, 0.0
+            now = time.monotonic()
+            remaining = state['open_until'] - now
+            if remaining > 0:
+                return False, remaining
+            state['open_until'] = now + self.cooldown
+            return True, 0.0
+
+    def record_success(self, endpoint):
+        with self._lock:
+            state = self._endpoints.pop(endpoint, None)
+        if state is not None and state['open_until'] is not None:
+            print(f"\n[熔断] {endpoint} 已恢复")
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            state = self._endpoints.setdefault(endpoint, {'failures': 0, 'open_until': None})
+            state['failures'] += 1
+            if state['failures'] < self.failure_threshold:
+                return
+            state['open_until'] = time.monotonic() + self.cooldown
+            failures = state['failures']
+        print(f"\n[熔断] {endpoint} 连续失败 {failures} 次，{self.cooldown:g} s 内跳过该路由")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                endpoint: {
+                    'failures': state['failures'],
+                    'open': state['open_until'] is not None and state['open_until'] > now
+                }
+                for endpoint, state in self._endpoints.items()
+            }
+
+
+class RetryBudget:
+    def __init__(self, ratio=0.2, capacity=10.0):
+        self.ratio = ratio
+        self.capacity = capacity
+        self._tokens = capacity
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+
+class RetryEngine:
+    """各工作流共用的同步重试入口（在工作流线程中调用，等待时阻塞该线程）"""
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=30.0, budget=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self._counts = {'calls': 0, 'retries': 0, 'gave_up': 0, 'budget_exhausted': 0, 'not_retryable': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def backoff(self, attempt):
+        """第 attempt 次失败后的等待时间：指数增长，取其一半加上随机的另一半"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, func, *args, **kwargs):
+        attempt = 1
+        while True:
+            # 调用指标按第几次尝试标记（见 call_metrics.py）
+            token = metrics_attempt.set(attempt)
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                metrics_attempt.reset(token)
+            self._count('calls')
+            self.budget.record_call()
+            if not isinstance(result, AgentFailure):
+                return result
+            if not result.retryable:
+                self._count('not_retryable')
+                print(f"[重试] 调用失败且不可重试（{type(result.error).__name__}），不再重试")
+                return result
+            if attempt >= self.max_attempts:
+                self._count('gave_up')
+                print(f"[重试] 连续 {attempt} 次调用失败，放弃")
+                return result
+            if result.kind == "parse":
+                delay = 0.0
+            elif result.retry_after is not None:
+                if result.retry_after > self.max_delay:
+                    self._count('gave_up')
+                    print(f"[重试] 接口要求 {result.retry_after:.0f} s 后再试，超过最长等待 {self.max_delay:g} s，放弃")
+                    return result
+                delay = result.retry_after + random.uniform(0, self.base_delay / 2)
+            else:
+                delay = self.backoff(attempt)
+            if not self.budget.try_spend():
+                self._count('budget_exhausted')
+                print("[重试] 重试预算已用完，不再重试")
+                return result
+            self._count('retries')
+            print(f"[重试] 第 {attempt} 次调用失败（{result.kind}: {type(result.error).__name__}），{delay:.1f} s 后重试")
+            time.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._counts, 'budget_tokens': self.budget.tokens}
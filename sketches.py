@@ -0,0 +1,165 @@
+"""流式概要数据结构（sketch），用于超大表格的近似统计。
+
+每种结构都支持分块 update，内存占用与数据行数无关：
+- HyperLogLog：近似不同取值个数；
+- KLLSketch：近似分位数（中位数等）；
+- ReservoirSample：等概率随机抽取固定数量的示例值；
+- BoundedDistinct：不同取值较少时精确记录全部取值，超过上限即放弃。
+"""
+import numpy as np
+import pandas as pd
+
+
+def _mix64(x):
+    """splitmix64 的收尾混合，把分布不均的 64 位整数打散为近似均匀的哈希"""
+    x = x.astype(np.uint64, copy=True)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+
+def hash_values(values):
+    """把一组取值映射为 64 位哈希（同一进程内相同取值得到相同哈希）。
+
+    对象列使用 Python 内置 hash（字符串对象会缓存自身哈希，重复取值几乎没有额外开销），
+    其余类型使用 pandas 的向量化哈希。
+    """
+    values = np.asarray(values)
+    if values.dtype == object:
+        with np.errstate(over='ignore'):
+            return _mix64(np.fromiter(map(hash, values), dtype=np.int64, count=len(values)).view(np.uint64))
+    return pd.util.hash_array(values, categorize=False)
+
+
+class HyperLogLog:
+    """HyperLogLog 基数估计，p 为分桶位数，相对误差约为 1.04 / sqrt(2 ** p)"""
+
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def update(self, values):
+        if len(values) == 0:
+            return
+        hashes = hash_values(values)
+        buckets = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        remainder = hashes << np.uint64(self.p)
+        # 剩余位中第一个 1 的位置：frexp 的指数 e 满足 2**(e-1) <= x < 2**e
+        _, exponent = np.frexp(remainder.astype(np.float64))
+        ranks = np.where(remainder == 0, 64 - self.p + 1, 65 - exponent)
+        ranks = np.minimum(ranks, 64 - self.p + 1).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, ranks)
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # 基数较小时使用线性计数修正
+        if estimate <= 2.5 * self.m and zeros > 0:
+            estimate = self.m * np.log(self.m / zeros)
+        return int(round(estimate))
+
+
+class KLLSketch:
+    """KLL 分位数草图：第 h 层每个元素代表 2**h 个原始值，k 越大越精确"""
+
+    def __init__(self, k=200, random_state=None):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self._rng = np.random.default_rng(random_state)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # 奇数个时留一个在本层，其余两两配对，随机保留其中一半晋升到上一层
+                odd = len(items) % 2
+                promoted = items[odd:][self._rng.integers(2)::2]
+                self.levels[level] = items[:odd]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.int64) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        position = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        return items[order[min(position, len(order) - 1)]]
+
+
+class ReservoirSample:
+    """蓄水池抽样：在流式数据中等概率保留 size 个取值。
+
+    使用跳跃式的 Algorithm L，随机数个数约为 size * log(n / size)，与数据总量基本无关。
+    """
+
+    def __init__(self, size, random_state=None):
+        self.size = size
+        self.seen = 0
+        self.items = []
+        self._rng = np.random.default_rng(random_state)
+        self._weight = 1.0
+        self._next = None
+
+    def _advance(self):
+        self._weight *= np.exp(np.log(self._rng.random()) / self.size)
+        self._next += int(np.floor(np.log(self._rng.random()) / np.log1p(-self._weight))) + 1
+
+    def update(self, values):
+        start = self.seen
+        self.seen += len(values)
+        fill = min(self.size - len(self.items), len(values))
+        if fill > 0:
+            self.items.extend(values[:fill])
+            if len(self.items) == self.size:
+                self._next = start + fill - 1
+                self._advance()
+        # _next 为下一个被选入样本的值在整个数据流中的位置
+        while self._next is not None and self._next < self.seen:
+            self.items[self._rng.integers(self.size)] = values[self._next - start]
+            self._advance()
+
+
+class BoundedDistinct:
+    """按首次出现顺序精确记录不同取值，个数超过 limit 后放弃（values 置为 None）"""
+
+    # 先在数据块开头这么多倍 limit 的前缀上检查，高基数列可以不扫描整块就放弃
+    PREFIX_FACTOR = 100
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.values = np.empty(0, dtype=object)
+
+    def update(self, values):
+        if self.values is None or len(values) == 0:
+            return
+        for part in (values[:self.limit * self.PREFIX_FACTOR], values):
+            merged = pd.unique(np.concatenate([self.values, np.asarray(part, dtype=object)]))
+            if len(merged) > self.limit:
+                self.values = None
+                return
+        self.values = merged
@@ -0,0 +1,103 @@
+"""推测执行：客服、需求梳理、取数三步原本依次进行，开启 speculative_pipeline 后
+- 客服回复流中 pass_to_DA 一确定为 Y，就按本轮结束后的对话历史提前启动需求梳理
+  （转交取数时客服回复固定为 CONFIRM_REPLY，本轮结束后的历史此时已经确定）；
+- 需求梳理的“正式任务指令”一完整，就提前启动取数。
+工作流走到下一步时核对输入：与提前启动时相同则直接取用（尚未结束时等待）其结果，
+不同则取消并按原流程重新调用；提前启动的调用失败时同样按原流程重新调用（进入重试）。
+因此结果总是与依次执行相同，推测落空时最多多花一次调用的 token。
+所有协程都在 agent_loop 的事件循环中运行。
+"""
+import asyncio
+import time
+
+from stream_parser import FieldEvent
+
+
+class Speculation:
+    """一次提前启动的调用，inputs 为启动时使用的输入"""
+
+    def __init__(self, name, inputs, coro):
+        self.name = name
+        self.inputs = inputs
+        self.started = time.perf_counter()
+        self.task = asyncio.ensure_future(coro)
+
+    def cancel(self, reason):
+        if not self.task.done():
+            self.task.cancel()
+        print(f"\n[推测执行] {reason}，放弃提前启动的{self.name}")
+
+
+class SpeculativePipeline:
+    def __init__(self, customer_service_agent, task_summary_agent, data_analysis_agent):
+        self.customer_service_agent = customer_service_agent
+        self.task_summary_agent = task_summary_agent
+        self.data_analysis_agent = data_analysis_agent
+        self.task_summary = None
+        self.analysis = None
+
+    def cancel(self, reason):
+        for name in ('task_summary', 'analysis'):
+            speculation = getattr(self, name)
+            if speculation is not None:
+                setattr(self, name, None)
+                speculation.cancel(reason)
+
+    async def close(self):
+        """工作流重置时取消所有提前启动的调用"""
+        self.cancel("工作流已重置")
+
+    async def customer_service(self, database_info, query, analysis=True):
+        """代替客服的 process_query；analysis 为 False 时（例如多候选取数）只提前启动需求梳理"""
+        self.cancel("开始新一轮客服调用")
+        agent = self.customer_service_agent
+        result = None
+        async for event in agent.astream(database_info, query):
+            if isinstance(event, FieldEvent):
+                if event.field == 'need_clarity' and event.value == 'Y' and self.task_summary is None:
+                    history = agent.prompt_history(agent.history_after(query, agent.CONFIRM_REPLY))
+                    self.task_summary = Speculation(
+                        "需求梳理", (database_info, history), self._task_summary(database_info, history, analysis)
+                    )
+                    print("\n[推测执行] 客服已确定转交取数，提前启动需求梳理")
+            else:
+                result = event.result
+        if self.task_summary is not None and not (isinstance(result, dict) and result['need_clarity'] == 'Y'):
+            self.cancel("客服最终未转交取数")
+        return result
+
+    async def _task_summary(self, database_info, history, analysis):
+        result = None
+        async for event in self.task_summary_agent.astream(database_info, history):
+            if isinstance(event, FieldEvent):
+                if analysis and event.field == 'task_summary' and self.analysis is None:
+                    self.analysis = Speculation(
+                        "取数", (database_info, event.value), self.data_analysis_agent.aprocess(database_info, event.value)
+                    )
+                    print("\n[推测执行] 任务指令已完整，提前启动取数")
+            else:
+                result = event.result
+        if self.analysis is not None and not (
+                isinstance(result, dict) and result['task_summary'] == self.analysis.inputs[1]):
+            speculation, self.analysis = self.analysis, None
+            speculation.cancel("需求梳理的最终任务指令与提前取得的不同")
+        return result
+
+    async def take(self, name, database_info, task):
+        """取用提前启动的调用结果（name 为 'task_summary' 或 'analysis'）；
+        没有提前启动、输入不同或调用失败时返回 None，由工作流按原流程调用"""
+        speculation = getattr(self, name)
+        if speculation is None:
+            return None
+        setattr(self, name, None)
+        if speculation.inputs != (database_info, task):
+            speculation.cancel("输入与推测不同")
+            return None
+        ahead = time.perf_counter() - speculation.started
+        # 提前启动的需求梳理自身结束即可，它启动的取数留在 self.analysis 中继续进行
+        result = (await asyncio.gather(speculation.task, return_exceptions=True))[0]
+        if not isinstance(result, dict):
+            print(f"\n[推测执行] 提前启动的{speculation.name}失败，按原流程重新调用")
+            return None
+        print(f"\n[推测执行] 使用提前启动的{speculation.name}结果（提前 {ahead:.1f} s 启动）")
+        return result
@@ -0,0 +1,176 @@
+"""在流式回复到达的同时识别各智能体的固定回复格式，字段一完整就发出事件。
+
+各智能体的回复格式都是按顺序排列的若干段（例如 pass_to_DA / to_customer，
+该任务是否可实现 / python代码），每段以固定标记开头：
+- 非最后一段：读到下一段的标记时完整；
+- 最后一段：读到单独一行的 ``` 时完整（若该段本身以代码块开头，则是代码块的结束围栏），
+  否则等到流结束。
+
+字段取值的清理方式与各智能体 parse_response 中的正则解析一致，正常回复下两者结果相同。
+流式事件只是提前得到的结果，以流结束后的 ResultEvent 为准：
+遇到 </think> 或固定格式标记等重新定位标记时，之前发出的字段可能会以新的取值再次发出。
+"""
+import re
+from typing import NamedTuple, Optional
+
+
+class FieldEvent(NamedTuple):
+    """某个字段已在流中完整出现"""
+    field: str
+    value: str
+
+
+class ResultEvent(NamedTuple):
+    """流结束后的最终结果，与 process_query 的返回值相同（失败时为 AgentFailure 错误文本）"""
+    result: object
+
+
+class Section(NamedTuple):
+    field: str
+    marker: str
+    # 字段取值结尾要去掉的字符（与 parse_response 中 rstrip 的参数一致），None 表示代码字段
+    tail: Optional[str] = '\n3.'
+    # 结构化输出时该字段的可选取值（JSON schema 的 enum），None 表示任意文本
+    choices: Optional[tuple] = None
+
+
+_CODE_BLOCK = re.compile(r'```python(.*?)```', re.DOTALL)
+
+# 单独一行的 ```，且该行已经结束（避免把 ```python 的开头误认为结束围栏）
+_FENCE_LINE = re.compile(r'\n[ \t]*```[ \t]*\n')
+
+THINK_START = '<think>'
+THINK_END = '</think>'
+FORMAT_MARKER = '```你的回复固定格式'
+
+
+def clean_field(value, tail):
+    if tail is None:
+        return value.strip().lstrip(':').lstrip('：').strip()
+    return value.strip().lstrip(':').lstrip('：').lstrip('[').rstrip(tail).strip().rstrip(']')
+
+
+def code_compiles(value):
+    """代码字段取值（与工作流中相同的方式取出代码块）能否通过 compile，用于判断代码块已完整"""
+    match = _CODE_BLOCK.search(value)
+    if match is not None:
+        code = match.group(1).strip().lstrip('\n')
+    else:
+        code = value.split('```python')[-1].rstrip('```')
+    if not code.strip():
+        return False
+    try:
+        compile(code, '<agent>', 'exec')
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+class SectionParser:
+    """增量解析器：feed 每个新到达的文本片段，返回本次完整的字段事件列表"""
+
+    def __init__(self, sections, resets=()):
+        self.sections = list(sections)
+        self.resets = (THINK_END, FORMAT_MARKER) + tuple(resets)
+        self.text = ""
+        self.emitted = {}
+        # 最后一段完整时在 text 中的结束位置
+        self.end = None
+        # None 表示尚未确定回复是否以 <think> 开头
+        self._in_think = None
+        self._checked = 0
+        self._restart(0)
+
+    def _restart(self, start):
+        self._start = start
+        self._index = 0
+        self._value_start = None
+        self._search_from = start
+        self.end = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self._in_think is None:
+            head = self.text.lstrip()
+            if len(head) < len(THINK_START) and THINK_START.startswith(head):
+                return []
+            self._in_think = head.startswith(THINK_START)
+        self._apply_resets()
+        self._checked = len(self.text)
+        if self._in_think:
+            return []
+        return self._scan()
+
+    def _apply_resets(self):
+        start = None
+        for marker in self.resets:
+            pos = self.text.rfind(marker, max(self._start, self._checked - len(marker) + 1))
+            if pos >= 0 and (start is None or pos + len(marker) > start):
+                start = pos + len(marker)
+        if start is not None:
+            self._in_think = False
+            self._restart(start)
+
+    def _scan(self):
+        events = []
+        text = self.text
+        while self._index < len(self.sections):
+            section = self.sections[self._index]
+            if self._value_start is None:
+                pos = text.find(section.marker, self._search_from)
+                if pos < 0:
+                    self._search_from = max(self._start, len(text) - len(section.marker) + 1)
+                    break
+                self._value_start = self._search_from = pos + len(section.marker)
+            if self._index + 1 < len(self.sections):
+                next_marker = self.sections[self._index + 1].marker
+                pos = text.find(next_marker, self._search_from)
+                if pos < 0:
+                    self._search_from = max(self._value_start, len(text) - len(next_marker) + 1)
+                    break
+                events.append(self._emit(section, text[self._value_start:pos]))
+                self._index += 1
+                self._value_start = self._search_from = pos + len(next_marker)
+            else:
+                end = self._last_section_end()
+                if end is None:
+                    break
+                events.append(self._emit(section, text[self._value_start:end]))
+                self._index += 1
+                self.end = end
+        return events
+
+    def _last_section_end(self):
+        value = self.text[self._value_start:]
+        offset = len(value) - len(value.lstrip(' \t\n:：'))
+        search_from = self._value_start
+        if value[offset:].startswith('```'):
+            # 代码块：从开头围栏所在行之后找结束围栏，结束位置包含围栏本身
+            line_end = self.text.find('\n', self._value_start + offset)
+            if line_end < 0:
+                return None
+            match = _FENCE_LINE.search(self.text, line_end)
+            return None if match is None else match.end() - 1
+        match = _FENCE_LINE.search('\n' + self.text[search_from:])
+        return None if match is None else search_from + match.start()
+
+    def _emit(self, section, value):
+        event = FieldEvent(section.field, clean_field(value, section.tail))
+        self.emitted[section.field] = event.value
+        return event
+
+    def truncated_text(self):
+        """截至最后一段结束处的回复文本（提前结束流时使用），已打开的固定格式围栏补上结尾，
+        使解析结果与完整读完时一致"""
+        text = self.text[:self.end]
+        if FORMAT_MARKER in text:
+            text += '\n```'
+        return text
+
+    def finish(self, result):
+        """流结束后，为尚未发出的字段补发事件（取值来自最终解析结果）"""
+        if not isinstance(result, dict):
+            return []
+        return [FieldEvent(section.field, result[section.field])
+                for section in self.sections
+                if section.field not in self.emitted and section.field in result]
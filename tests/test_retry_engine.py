@@ -0,0 +1,188 @@
+"""retry_engine：退避时间范围、Retry-After 解析、重试预算耗尽与熔断的半开试探"""
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import retry_engine
+from retry_engine import AgentFailure, CircuitBreaker, CircuitOpenError, RetryBudget, RetryEngine, classify_error
+
+
+def status_error(cls, code, headers=None):
+    request = httpx.Request("POST", "http://example.invalid/v1/chat/completions")
+    return cls("x", response=httpx.Response(code, headers=headers or {}, request=request), body=None)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """记录 RetryEngine 的等待时间而不真正等待"""
+    recorded = []
+    monkeypatch.setattr(retry_engine.time, "sleep", recorded.append)
+    return recorded
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手动推进的 time.monotonic"""
+    now = [1000.0]
+    monkeypatch.setattr(retry_engine.time, "monotonic", lambda: now[0])
+    return now
+
+
+def failing(results):
+    """依次返回 results 中的结果，记录调用次数"""
+    results = list(results)
+    calls = []
+
+    def func():
+        calls.append(1)
+        return results.pop(0)
+    return func, calls
+
+
+def test_backoff_bounds():
+    engine = RetryEngine(base_delay=1.0, max_delay=8.0)
+    for attempt in range(1, 8):
+        delay = min(8.0, 2 ** (attempt - 1))
+        for _ in range(200):
+            assert delay / 2 <= engine.backoff(attempt) <= delay
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after": "3"}, 3.0),
+    ({"retry-after": "-2"}, 0.0),
+    ({"retry-after-ms": "abc", "retry-after": "4"}, 4.0),
+    ({"retry-after": "soon"}, None),
+    ({}, None),
+])
+def test_retry_after_headers(headers, expected):
+    assert retry_engine._retry_after(SimpleNamespace(headers=headers)) == expected
+
+
+def test_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    value = retry_engine._retry_after(SimpleNamespace(headers={"retry-after": format_datetime(when, usegmt=True)}))
+    assert 25 <= value <= 30
+
+
+def test_classify_error():
+    assert classify_error(status_error(openai.RateLimitError, 429, {"retry-after": "2"})) == ("transient", 2.0)
+    assert classify_error(status_error(openai.InternalServerError, 503)) == ("transient", None)
+    assert classify_error(status_error(openai.AuthenticationError, 401)) == ("fatal", None)
+    assert classify_error(status_error(openai.BadRequestError, 400)) == ("fatal", None)
+    assert classify_error(CircuitOpenError("open", 12.0)) == ("transient", 12.0)
+    assert classify_error(AttributeError("'NoneType' object has no attribute 'group'")) == ("parse", None)
+    assert classify_error(RuntimeError("x")) == ("fatal", None)
+
+
+def test_success_is_not_retried(sleeps):
+    func, calls = failing([{"ok": True}])
+    assert RetryEngine().call(func) == {"ok": True}
+    assert len(calls) == 1 and sleeps == []
+
+
+def test_fatal_is_not_retried(sleeps):
+    failure = AgentFailure("err", status_error(openai.AuthenticationError, 401))
+    func, calls = failing([failure])
+    engine = RetryEngine()
+    assert engine.call(func) is failure
+    assert len(calls) == 1 and sleeps == []
+    assert engine.stats()["not_retryable"] == 1
+
+
+def test_parse_error_retried_immediately(sleeps):
+    func, calls = failing([AgentFailure("err", AttributeError()), {"ok": True}])
+    assert RetryEngine().call(func) == {"ok": True}
+    assert len(calls) == 2 and sleeps == [0.0]
+
+
+def test_transient_backoff_until_max_attempts(sleeps):
+    failure = AgentFailure("err", status_error(openai.InternalServerError, 500))
+    func, calls = failing([failure] * 5)
+    engine = RetryEngine(max_attempts=3, base_delay=1.0, max_delay=30.0)
+    assert engine.call(func) is failure
+    assert len(calls) == 3
+    assert 0.5 <= sleeps[0] <= 1.0 and 1.0 <= sleeps[1] <= 2.0
+    assert engine.stats()["gave_up"] == 1
+
+
+def test_retry_after_is_respected(sleeps):
+    failure = AgentFailure("err", status_error(openai.RateLimitError, 429, {"retry-after": "5"}))
+    func, _ = failing([failure, {"ok": True}])
+    RetryEngine(base_delay=1.0).call(func)
+    assert 5.0 <= sleeps[0] <= 5.5
+
+
+def test_retry_after_longer_than_max_delay_gives_up(sleeps):
+    failure = AgentFailure("err", status_error(openai.RateLimitError, 429, {"retry-after": "100"}))
+    func, calls = failing([failure, {"ok": True}])
+    assert RetryEngine(max_delay=30.0).call(func) is failure
+    assert len(calls) == 1 and sleeps == []
+
+
+def test_budget_exhaustion():
+    budget = RetryBudget(ratio=0.5, capacity=2.0)
+    assert budget.try_spend() and budget.try_spend()
+    assert not budget.try_spend()
+    budget.record_call()
+    assert not budget.try_spend()
+    budget.record_call()
+    assert budget.try_spend()
+    for _ in range(10):
+        budget.record_call()
+    assert budget.tokens == 2.0
+
+
+def test_engine_stops_when_budget_exhausted(sleeps):
+    failure = AgentFailure("err", status_error(openai.InternalServerError, 500))
+    engine = RetryEngine(max_attempts=10, budget=RetryBudget(ratio=0.0, capacity=1.0))
+    func, calls = failing([failure] * 10)
+    assert engine.call(func) is failure
+    # 预算只够重试一次
+    assert len(calls) == 2
+    assert engine.stats()["budget_exhausted"] == 1
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=10.0)
+    for _ in range(2):
+        breaker.record_failure("r")
+    assert breaker.allow("r") == (True, 0.0)
+    breaker.record_failure("r")
+    allowed, remaining = breaker.allow("r")
+    assert not allowed and remaining == pytest.approx(10.0)
+    # 其他路由不受影响
+    assert breaker.allow("other") == (True, 0.0)
+
+
+def test_breaker_half_open_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=10.0)
+    breaker.record_failure("r")
+    clock[0] += 10.5
+    # 冷却结束后只放行一次试探，同时把下一次试探推迟一个冷却时间
+    assert breaker.allow("r") == (True, 0.0)
+    allowed, remaining = breaker.allow("r")
+    assert not allowed and remaining == pytest.approx(10.0)
+    # 试探失败：继续熔断
+    breaker.record_failure("r")
+    assert not breaker.allow("r")[0]
+    clock[0] += 10.5
+    assert breaker.allow("r")[0]
+    # 试探成功：恢复
+    breaker.record_success("r")
+    assert breaker.allow("r") == (True, 0.0)
+    assert breaker.allow("r") == (True, 0.0)
+    assert breaker.stats() == {}
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=10.0)
+    breaker.record_failure("r")
+    breaker.record_success("r")
+    breaker.record_failure("r")
+    assert breaker.allow("r") == (True, 0.0)
@@ -0,0 +1,88 @@
+"""top_k_indices / sparse_top_k：与完整排序的参照实现逐一比对，覆盖同分、top_k 超过长度、top_k 为 0、全零得分与稀疏列为空"""
+import numpy as np
+import pytest
+
+from data_sumary import sparse_top_k, top_k_indices
+
+
+def reference(scores, top_k):
+    """参照实现：按 (得分降序, 位置升序) 完整排序后取前 top_k 个"""
+    return sorted(range(len(scores)), key=lambda i: (-scores[i], i))[:max(top_k, 0)]
+
+
+def check(scores, top_k):
+    scores = np.asarray(scores, dtype=float)
+    expected = reference(scores, top_k)
+    assert top_k_indices(scores, top_k).tolist() == expected
+    positions = np.flatnonzero(scores)
+    top, top_scores = sparse_top_k(positions, scores[positions], len(scores), top_k)
+    assert top.tolist() == expected
+    assert top_scores.tolist() == scores[expected].tolist()
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_against_reference(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(100):
+        size = int(rng.integers(0, 60))
+        top_k = int(rng.integers(0, 70))
+        # 取值范围很小以制造大量同分；约一半的位置得分为 0
+        scores = rng.integers(0, 4, size) * (rng.random(size) < 0.5) / 4
+        check(scores, top_k)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_continuous_scores(seed):
+    rng = np.random.default_rng(seed)
+    scores = rng.random(5000)
+    for top_k in (1, 10, 100, 4999, 5000):
+        check(scores, top_k)
+
+
+def test_ties_keep_earliest_positions():
+    scores = [0.5, 1.0, 0.5, 1.0, 0.5, 0.2]
+    assert top_k_indices(scores, 3).tolist() == [1, 3, 0]
+    assert top_k_indices(scores, 4).tolist() == [1, 3, 0, 2]
+    check(scores, 3)
+    check([0.3] * 10, 4)
+
+
+@pytest.mark.parametrize("top_k", [5, 6, 100])
+def test_top_k_not_less_than_size(top_k):
+    scores = [0.1, 0.0, 0.7, 0.7, 0.2]
+    assert top_k_indices(scores, top_k).tolist() == [2, 3, 4, 0, 1]
+    check(scores, top_k)
+
+
+@pytest.mark.parametrize("scores", [[], [0.0, 0.0], [0.3, 0.9, 0.1]])
+def test_zero_top_k(scores):
+    result = top_k_indices(scores, 0)
+    assert result.tolist() == [] and result.dtype == np.intp
+    top, top_scores = sparse_top_k(np.flatnonzero(scores).astype(np.intp), np.asarray(scores)[np.flatnonzero(scores)], len(scores), 0)
+    assert top.tolist() == [] and top_scores.tolist() == []
+
+
+def test_all_zero_scores():
+    assert top_k_indices(np.zeros(8), 3).tolist() == [0, 1, 2]
+    check(np.zeros(8), 3)
+    check(np.zeros(8), 20)
+
+
+def test_empty_sparse_column():
+    """查询与任何行都没有共同词：没有非零项，全部按位置补 0 分"""
+    empty_positions = np.empty(0, dtype=np.int32)
+    empty_values = np.empty(0)
+    top, top_scores = sparse_top_k(empty_positions, empty_values, 6, 4)
+    assert top.tolist() == [0, 1, 2, 3] and top_scores.tolist() == [0.0] * 4
+    top, top_scores = sparse_top_k(empty_positions, empty_values, 3, 10)
+    assert top.tolist() == [0, 1, 2] and top_scores.tolist() == [0.0] * 3
+    top, top_scores = sparse_top_k(empty_positions, empty_values, 0, 5)
+    assert top.tolist() == [] and top_scores.tolist() == []
+
+
+def test_sparse_filler_skips_nonzero_positions():
+    positions = np.array([0, 2, 5])
+    values = np.array([0.4, 0.9, 0.4])
+    top, top_scores = sparse_top_k(positions, values, 8, 6)
+    assert top.tolist() == [2, 0, 5, 1, 3, 4]
+    assert top_scores.tolist() == [0.9, 0.4, 0.4, 0.0, 0.0, 0.0]
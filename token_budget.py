@@ -0,0 +1,26 @@
+"""提示词长度估算，供数据概述与各智能体共用。
+
+不依赖具体模型的分词器：中日韩字符按每字约 1 个 token 计，其余字符按约 4 个字符 1 个 token 计。
+与真实分词结果相比误差通常在三成以内，只用于预算控制和统计，不用于计费。
+"""
+import math
+import re
+
+# 中日韩统一表意文字、全角标点与假名
+_CJK_PATTERN = re.compile(r'[　-ヿ㐀-䶿一-鿿豈-﫿＀-￯]')
+
+
+def estimate_tokens(text):
+    """粗略估算文本的 token 数"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + math.ceil((len(text) - cjk_count) / 4)
+
+
+def clip_text(text, max_chars):
+    """超过 max_chars 个字符时截断并以省略号结尾；max_chars 为 None 时原样返回"""
+    text = str(text)
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    return text[:max(max_chars - 1, 0)] + "…"